@@ -6,64 +6,193 @@
 # July 2023
 
 import os
-from LatticeParser import LatticeParser
+import re
+from LatticeParser import LatticeParser, LineItem
+from LatticeParallel import ParseChunks, WorkerCount
 from LatticeData import *
+from LatticeLog import Log
+from LatticeProfile import Profile, Instrument
 from datetime import datetime
 
+_StatementName = re.compile(r'\s*(?:"([^"]*)"|([^\s:"]+))\s*:(.*)$', re.DOTALL)
+_Fields = re.compile(r'(?:[^,"]|"[^"]*")+')
+_TypeEnd = re.compile(r'[,=]')
+
+# ---------------------------------------------------------------------------
+def _StripComment(line):
+    if '!' not in line:
+        return line
+    if '"' not in line:
+        return line[:line.index('!')]
+    in_quotes = False
+    for index, character in enumerate(line):
+        if character == '"':
+            in_quotes = not in_quotes
+        elif character == '!' and not in_quotes:
+            return line[:index]
+    return line
+
+def _Continued(line):
+    return _StripComment(line).strip().endswith('&')
+
+# ---------------------------------------------------------------------------
+def _ParameterValue(value):
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    value = value.strip()
+    if value.startswith('"') and value.endswith('"') and len(value) > 1:
+        value = value[1:-1].strip()
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+# ---------------------------------------------------------------------------
+def TokenizeElegant(lines):
+    """Single pass over the lines of an ELEGANT lattice file, yielding (name, type, parameters) records.
+
+    Comments ('!') are removed and '&' continuations joined. Names may be quoted. Types and
+    parameter names are upper-cased; numeric values are converted to float and quotes are removed
+    from string values. For LINE statements the parameters are the list of line items. Commands
+    without a name (USE, RETURN, ...) are yielded with a name of None."""
+
+    statement = ''
+    for line in lines:
+        line = _StripComment(line).strip()
+        if line.endswith('&'):
+            statement += line[:-1] + ' '
+            continue
+        if statement:
+            line = statement + line
+            statement = ''
+        if not line:
+            continue
+
+        # Quotes need the slower regular-expression splitting
+        quoted = '"' in line
+        if quoted:
+            match = _StatementName.match(line)
+            named = match is not None
+            if named:
+                name = match.group(1) if match.group(1) is not None else match.group(2)
+                body = match.group(3)
+        else:
+            name, colon, body = line.partition(':')
+            name = name.strip()
+            named = bool(colon) and ' ' not in name
+        if not named:
+            fields = _Fields.findall(line) if quoted else line.split(',')
+            yield None, fields[0].strip().upper(), [_ParameterValue(field) for field in fields[1:]]
+            continue
+
+        separator = _TypeEnd.search(body)
+        element_type = (body[:separator.start()] if separator else body).strip().upper()
+        if element_type == "LINE":
+            items = body[body.find('(')+1:body.rfind(')')]
+            yield name, element_type, [item.strip().strip('"') for item in items.split(',') if item.strip()]
+            continue
+
+        parameters = {}
+        if separator:
+            fields = body[separator.start()+1:]
+            for field in _Fields.findall(fields) if quoted else fields.split(','):
+                key, equals, value = field.partition('=')
+                if equals:
+                    parameters[key.strip().upper()] = _ParameterValue(value)
+        yield name, element_type, parameters
+
 # ---------------------------------------------------------------------------
 class ElegantParser(LatticeParser):
     def __init__(self, **kwargs):
-        LatticeParser.__init__(self)
+        LatticeParser.__init__(self, **kwargs)
 
     # ---------------------------------------------------------------------------
-    def AddBeamline(self, elements, beamlines, line):
-        for line_element in beamlines[line]:
-            if line_element in beamlines:
-                self.AddBeamline(elements, beamlines, line_element)
-            elif line_element in elements:
-                self.Lattice.AddElement(elements[line_element])
-            else:
-                self.IgnoredElements.append(line_element)
+    def FlattenBeamline(self, elements, beamlines, line):
+        """Expand a beamline into its list of elements.
+        Each sub-line is flattened once and reused; 'N*ITEM' repeats an item and '-ITEM' reverses it."""
+
+        items = {}
+        flattened = {}
+        reversed_lines = {}
+        active = set()
+        stack = [line]
+        while stack:
+            current = stack[-1]
+            if current in flattened:
+                stack.pop()
+                continue
+            if current not in items:
+                items[current] = [LineItem(item) for item in beamlines[current]]
+
+            # Flatten the sub-lines first, without recursing
+            if current not in active:
+                active.add(current)
+                pending = [name for count, reverse, name in items[current]
+                           if name in beamlines and name not in flattened]
+                for name in pending:
+                    if name in active:
+                        raise RuntimeError("Beamline {} is defined recursively".format(name))
+                stack.extend(pending)
+                continue
+
+            stack.pop()
+            flat = []
+            for count, reverse, name in items[current]:
+                if name in beamlines:
+                    sub_line = flattened[name]
+                    if reverse:
+                        if name not in reversed_lines:
+                            reversed_lines[name] = sub_line[::-1]
+                        sub_line = reversed_lines[name]
+                elif name in elements:
+                    sub_line = [elements[name]]
+                else:
+                    self.IgnoredElements.append(name)
+                    continue
+                flat.extend(sub_line * count if count != 1 else sub_line)
+            flattened[current] = flat
+            active.discard(current)
+
+        return flattened[line]
 
     # ---------------------------------------------------------------------------
-    def ParseInput(self, **kwargs):
-        inputFile = kwargs.get('inputFile')
-        beamline = kwargs.get('beamline')
-        print('''
------------------------------------------------------
-Importing lattice in ELEGANT format from\n{}
-'''.format(inputFile))
+    def ReadDefinitions(self, inputFile, workers=None):
+        """Read the element and beamline definitions of a file, returning them as dictionaries
+        (name -> element, and name -> list of line items).  With more than one worker, the file
+        is parsed in chunks on a pool of processes (see LatticeParallel), with the same result."""
 
         self.Lattice.Name = os.path.basename(inputFile).strip('.lte')
 
+        with Profile.Phase("element construction"):
+            if WorkerCount(workers) == 1:
+                with open(inputFile, 'r') as inFile:
+                    return self.ReadStatements(inFile)
+
+            elements = {}
+            beamlines = {}
+            for chunk_elements, chunk_beamlines in ParseChunks(self, "ReadStatements", inputFile, 0,
+                                                               os.path.getsize(inputFile), WorkerCount(workers),
+                                                               continued=_Continued):
+                elements.update(chunk_elements)
+                beamlines.update(chunk_beamlines)
+        return elements, beamlines
+
+    # ---------------------------------------------------------------------------
+    def ReadStatements(self, lines):
+        """Build the element and beamline definitions from the lines of a file (or of a part of it
+        beginning and ending on statement boundaries)."""
+
         elements = {}
         beamlines = {}
-        line_buffer = ''
 
-        for line in open(inputFile, 'r'):
-            lte_line = line.strip()
-            if not lte_line or lte_line.startswith('!'): continue
-            if lte_line.endswith('&'):
-                line_buffer += lte_line.strip('&')
-                continue
-            if line_buffer:
-                lte_line = line_buffer + lte_line
-                line_buffer = ''
+        for element_name, element_type, element_params in Profile.Iterate("tokenize", TokenizeElegant(lines)):
 
-            if lte_line.startswith("USE") or lte_line.startswith("RETURN"):
+            # Commands (USE, RETURN, ...)
+            if element_name is None:
                 continue
 
-            line_split = lte_line.split(':')
-            element_name = line_split[0].strip().strip('\"')
-            element_variables = line_split[1].strip()
-            if element_variables.startswith("LINE"):
-                element_type = element_variables.split('=')[0].strip()
-                element_params = element_variables.split('=')[1]
-            else:
-                element_type = element_variables.split(',')[0].strip()
-                element_params = element_variables.split(',')[1:]
-                element_params = [e.strip() for e in element_params]
-
             if element_type == "DRIF" or element_type == "EDRIFT":
                 length = self.ElementParameter(element_params, 'L', default=0.)
                 drift = Drift(element_name, length=length)
@@ -111,28 +240,37 @@ Importing lattice in ELEGANT format from\n{}
 
             elif element_type == "SOLE":
                 length = self.ElementParameter(element_params, 'L')
-                solenoid = Solenoid(element_name, length=length)
+                ks = self.ElementParameter(element_params, 'KS', default=0.)
+                solenoid = Solenoid(element_name, length=length, ks=ks)
                 elements[element_name] = solenoid
 
             elif element_type == "LINE":
-                lattice_elements = element_params.strip().strip('(').strip(')').split(',')
-                for lattice_element in lattice_elements:
-                    lattice_element = lattice_element.strip()
-                if element_name == beamline:
-                    for lattice_element in lattice_elements:
-                        if lattice_element in beamlines:
-                            self.AddBeamline(elements, beamlines, lattice_element)
-                        elif lattice_element in elements:
-                            self.Lattice.AddElement(elements[lattice_element])
-                        else:
-                            self.IgnoredElements.append(lattice_element)
-                else:
-                    beamlines[element_name] = lattice_elements
+                beamlines[element_name] = element_params
 
             else:
                 if element_type not in self.IgnoredElementTypes:
                     self.IgnoredElementTypes.append(element_type)
 
+        return elements, beamlines
+
+    # ---------------------------------------------------------------------------
+    @Instrument("parse")
+    def ParseInput(self, **kwargs):
+        inputFile = kwargs.get('inputFile')
+        beamline = kwargs.get('beamline')
+        Log.info('''
+-----------------------------------------------------
+Importing lattice in ELEGANT format from\n{}
+'''.format(inputFile))
+
+        elements, beamlines = self.ReadDefinitions(inputFile, kwargs.get('parse_workers'))
+
+        # Expand the requested beamline
+        with Profile.Phase("sequence expansion"):
+            if beamline in beamlines:
+                for element in self.FlattenBeamline(elements, beamlines, beamline):
+                    self.Lattice.AddElement(element)
+
         # Measure the length of the lattice
         self.Lattice.MeasureLength()
 
@@ -141,22 +279,37 @@ Importing lattice in ELEGANT format from\n{}
 
         self.Lattice.MeasureLength()
 
-        print("Total lattice length {}m.".format(self.Lattice.Length))
+        Log.info("Total lattice length {}m.".format(self.Lattice.Length))
 
-        print('''
+        Log.info('''
 Completed.
 -----------------------------------------------------
 ''')
 
     # ---------------------------------------------------------------------------
-    def ElementParameter(self, elements, parameter, default=None):
-        value = default
-        for element in elements:
-            if element.startswith(parameter):
-                value = float(element.split('=')[1].strip().strip(','))
+    def Placements(self, **kwargs):
+        """Generate the placements of the beamline as (element, s) pairs while it is expanded,
+        without building the lattice."""
+
+        elements, beamlines = self.ReadDefinitions(kwargs.get('inputFile'), kwargs.get('parse_workers'))
+        beamline = kwargs.get('beamline')
+        if beamline not in beamlines:
+            return
+        location = 0.
+        for element in self.IterateBeamline(elements, beamlines, beamline):
+            yield element, location
+            location += element.Length
+
+    # ---------------------------------------------------------------------------
+    def ElementParameter(self, parameters, parameter, default=None):
+        value = parameters.get(parameter, default)
+        if isinstance(value, str):
+            self.InvalidExpressions.append("{}={}".format(parameter, value))
+            value = default
         return value
 
     # ---------------------------------------------------------------------------
+    @Instrument("write")
     def WriteLattice(self, **kwargs):
 
         if kwargs.get('outputFile', None) is not None:
@@ -164,86 +317,93 @@ Completed.
         else:
             outputFile = "{}.lte".format(self.Lattice.Name)
 
-        print('''
+        Log.info('''
 -----------------------------------------------------
 Writing lattice in ELEGANT format to\n{}
 '''.format(outputFile))
 
         access_mode = 'a' if kwargs.get('append', False) else 'w'
         outFile = open(outputFile, access_mode)
-        outFile.write('''
+        self.WriteText(outFile, self.FormatLattice(**kwargs))
+        outFile.close()
+        Log.info('''
+Completed.
+-----------------------------------------------------
+''')
+
+    # ---------------------------------------------------------------------------
+    def FormatLattice(self, **kwargs):
+        """Generate the text of the ELEGANT lattice file."""
+
+        layout = self.Layout(**kwargs)
+        yield '''
 ! Written by LatticeConvert. \n! {}\n
-'''.format(datetime.now()))
+'''.format(datetime.now())
 
         # Write drifts
-        outFile.write('! Drifts\n')
-        for drift in self.Lattice.Drifts:
-            self.Lattice.Drifts[drift].WriteElegant(outFile)
-        outFile.write('\n')
+        yield '! Drifts\n'
+        for drift in layout.Groups["Drifts"]:
+            yield drift.FormatElegant()
+        yield '\n'
 
         # Write dipoles
-        outFile.write('! Dipoles\n')
-        for dipole in self.Lattice.Dipoles:
-            self.Lattice.Dipoles[dipole].WriteElegant(outFile)
-        outFile.write('\n')
+        yield '! Dipoles\n'
+        for dipole in layout.Groups["Dipoles"]:
+            yield dipole.FormatElegant()
+        yield '\n'
 
         # Write quads
-        outFile.write('! Quads\n')
-        for quad in self.Lattice.Quads:
-            self.Lattice.Quads[quad].WriteElegant(outFile,
-                                                  kick=True, n_slices=10, synch_rad=True, k1_zero=kwargs.get("k1_zero", False))
-        outFile.write('\n')
+        yield '! Quads\n'
+        for quad in layout.Groups["Quads"]:
+            yield quad.FormatElegant(kick=True, n_slices=10, synch_rad=True, k1_zero=kwargs.get("k1_zero", False))
+        yield '\n'
 
         # Write skew quads
-        outFile.write('! Skew quads\n')
-        for squad in self.Lattice.SkewQuads:
-            self.Lattice.SkewQuads[squad].WriteElegant(outFile)
-        outFile.write('\n')
+        yield '! Skew quads\n'
+        for squad in layout.Groups["SkewQuads"]:
+            yield squad.FormatElegant()
+        yield '\n'
 
         # Write sextupoles
-        outFile.write('! Sextupoles\n')
-        for sext in self.Lattice.Sexts:
-            self.Lattice.Sexts[sext].WriteElegant(outFile)
-        outFile.write('\n')
-            
+        yield '! Sextupoles\n'
+        for sext in layout.Groups["Sexts"]:
+            yield sext.FormatElegant()
+        yield '\n'
+
         # Write octupoles
-        outFile.write('! Octupoles\n')
-        for octu in self.Lattice.Octus:
-            self.Lattice.Octus[octu].WriteElegant(outFile)
-        outFile.write('\n')
+        yield '! Octupoles\n'
+        for octu in layout.Groups["Octus"]:
+            yield octu.FormatElegant()
+        yield '\n'
 
         # Write RF
-        outFile.write('! RF\n')
-        for rf in self.Lattice.RF:
-            self.Lattice.RF[rf].WriteElegant(outFile)
-        outFile.write('\n')
+        yield '! RF\n'
+        for rf in layout.Groups["RF"]:
+            yield rf.FormatElegant()
+        yield '\n'
 
         # Write misc
         if kwargs.get('recirc', False):
-            self.WriteMiscElements(outFile)
-            outFile.write('\n')
+            yield self.FormatMiscElements()
+            yield '\n'
 
         # Write lattice
-        outFile.write('! Lines\n')
+        yield '! Lines\n'
         if kwargs.get('recirc', False):
-            outFile.write("{}: LINE = (rc, ".format(self.Lattice.Name))
+            yield "{}: LINE = (rc, ".format(layout.Name)
         else:
-            outFile.write("{}: LINE = (".format(self.Lattice.Name))
-        for element in self.Lattice.Sequence:
-            if element in self.Lattice.DipoleEdges:
-                continue
-            if self.Lattice.Sequence.index(element) != 0:
-                outFile.write(", ")
-            outFile.write("{}".format(element))
-        outFile.write(")\n")
+            yield "{}: LINE = (".format(layout.Name)
+        separator = ''
+        for element, location in layout.Beamline:
+            yield separator
+            yield element
+            separator = ', '
+        yield ")\n"
 
-        outFile.close()
-        print('''
-Completed.
------------------------------------------------------
-''')
+    # ---------------------------------------------------------------------------
+    def FormatMiscElements(self):
+        return '! Misc\nrc: RECIRC\n'
 
     # ---------------------------------------------------------------------------
     def WriteMiscElements(self, outFile):
-        outFile.write('! Misc\n')
-        outFile.write('rc: RECIRC\n')
+        outFile.write(self.FormatMiscElements())
@@ -0,0 +1,157 @@
+# LatticeBatch.py
+#
+# Batch conversion of many lattice files across a pool of worker processes.
+# Each worker imports the toolkit once and converts the files it is handed,
+# with its console output captured; the parent reports the status of each
+# file as it completes and aggregates the parse errors of the whole batch.
+
+import io
+import os
+import glob
+import time
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Default output file extension for each format
+FormatExtensions = {"elegant": ".lte", "madx": ".seq", "6dsim": ".6ds", "binary": ".ltb"}
+
+# ---------------------------------------------------------------------------
+def ReadManifest(manifestFile):
+    """Read a batch manifest: one 'input_file [output_file]' per line, with '#' comments.
+    Relative paths are taken relative to the manifest."""
+
+    entries = []
+    directory = os.path.dirname(manifestFile)
+    with open(manifestFile) as inFile:
+        for line in inFile:
+            fields = line.split('#')[0].split()
+            if not fields:
+                continue
+            if len(fields) > 2:
+                raise RuntimeError("Invalid manifest line in {}: {}".format(manifestFile, line.strip()))
+            entries.append(tuple(os.path.join(directory, field) for field in fields))
+    return entries
+
+# ---------------------------------------------------------------------------
+def BatchJobs(entries, output_formats, output_dir=None, **options):
+    """Build the conversion jobs for a list of (input_file,) or (input_file, output_file) entries.
+    Output files not given are named after the input, with the extension of each output format,
+    in output_dir (or alongside the input)."""
+
+    jobs = []
+    for entry in entries:
+        inputFile = entry[0]
+        if len(entry) > 1:
+            if len(output_formats) > 1:
+                raise RuntimeError("Manifest output file {} is ambiguous with several output formats.".format(entry[1]))
+            outputs = [(output_formats[0], entry[1])]
+        else:
+            stem = os.path.splitext(os.path.basename(inputFile))[0]
+            directory = output_dir if output_dir is not None else os.path.dirname(inputFile)
+            outputs = [(output_format, os.path.join(directory, stem + FormatExtensions[output_format]))
+                       for output_format in output_formats]
+        for output_format, outputFile in outputs:
+            if os.path.abspath(outputFile) == os.path.abspath(inputFile):
+                raise RuntimeError("Output file {} would overwrite its input.".format(outputFile))
+        jobs.append(dict(options, inputFile=inputFile, outputs=outputs))
+    return jobs
+
+# ---------------------------------------------------------------------------
+def ConvertFile(job):
+    """Convert one file in a worker process; returns the job with its status, error, parse errors and log."""
+
+    from LatticeConvert import LatticeConverter
+    from LatticeProfile import Profile
+
+    result = dict(job, status="ok", error=None, parse_errors={})
+    log = io.StringIO()
+    start = time.time()
+    if job.get('profile'):
+        Profile.Enable(memory=True)
+    try:
+        with contextlib.redirect_stdout(log):
+            converter = LatticeConverter(verbose=job.get('verbose'), quiet=True, columnar=job.get('columnar', False),
+                                         intern_tolerance=job.get('intern_tolerance'),
+                                         drift_tolerance=job.get('drift_tolerance'),
+                                         cache_dir=job.get('cache_dir'), cache_size=job.get('cache_size', 1<<30))
+            convert = converter.ConvertStream if job.get('stream') else converter.Convert
+            convert(job['input_format'], job['inputFile'], job['outputs'], job.get('beamline'))
+        result["parse_errors"] = converter.ParseErrors
+    except (Exception, SystemExit) as error:
+        # SystemExit too, so that a reader which exits fails its file rather than the batch
+        result["status"] = "failed"
+        result["error"] = "{}: {}".format(type(error).__name__, error)
+    if job.get('profile'):
+        Profile.Disable()
+        result["profile"] = Profile.Report()
+    result["time"] = time.time() - start
+    result["log"] = log.getvalue()
+    return result
+
+# ---------------------------------------------------------------------------
+def ConvertBatch(jobs, workers=None):
+    """Convert the jobs across a pool of worker processes, printing the status of each file as it finishes.
+    Returns the results in the order of the jobs."""
+
+    results = [None] * len(jobs)
+    if workers == 1 or len(jobs) <= 1:
+        for index, job in enumerate(jobs):
+            results[index] = ConvertFile(job)
+            PrintStatus(results[index], index+1, len(jobs))
+        return results
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(ConvertFile, job): index for index, job in enumerate(jobs)}
+        for done, future in enumerate(as_completed(futures)):
+            index = futures[future]
+            try:
+                results[index] = future.result()
+            except Exception as error:
+                # The worker itself died (e.g. killed), rather than the conversion failing
+                results[index] = dict(jobs[index], status="failed", error="{}: {}".format(type(error).__name__, error),
+                                      parse_errors={}, time=0., log="")
+            PrintStatus(results[index], done+1, len(jobs))
+    return results
+
+# ---------------------------------------------------------------------------
+def PrintStatus(result, done, total):
+    print("[{}/{}] {:6s} {} -> {} ({:.2f}s)".format(done, total, result["status"], result["inputFile"],
+                                                    ", ".join(outputFile for output_format, outputFile in result["outputs"]),
+                                                    result["time"]))
+    if result["error"] is not None:
+        print("    {}".format(result["error"]))
+
+# ---------------------------------------------------------------------------
+def ReportBatch(results):
+    """Print a summary of the batch, with the parse errors aggregated over all files.
+    Returns the number of files which failed to convert."""
+
+    failed = [result for result in results if result["status"] != "ok"]
+    print("\nConverted {} of {} files ({} failed).".format(len(results)-len(failed), len(results), len(failed)))
+    for result in failed:
+        print("  FAILED {}: {}".format(result["inputFile"], result["error"]))
+
+    aggregated = {}
+    for result in results:
+        for description, report in result["parse_errors"].items():
+            files = aggregated.setdefault(description, {})
+            for item in report:
+                files.setdefault(item, []).append(result["inputFile"])
+    for description, items in aggregated.items():
+        print("{} ({} distinct, in {} file(s)):".format(description, len(items),
+                                                     len({inputFile for files in items.values() for inputFile in files})))
+        for item, files in items.items():
+            print("  {} ({} file(s))".format(item, len(files)))
+    return len(failed)
+
+# ---------------------------------------------------------------------------
+def BatchInputs(manifest=None, patterns=()):
+    """Input entries from a manifest and/or glob patterns."""
+
+    entries = ReadManifest(manifest) if manifest is not None else []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        if not matches:
+            print("No input files match {}".format(pattern))
+        entries.extend((match,) for match in matches)
+    return entries
@@ -0,0 +1,185 @@
+# LatticeBinary.py
+#
+# Native binary format for lattices, which loads without tokenizing.
+# The file holds the columns of a ColumnarLattice: a fixed header, a JSON
+# directory of sections, then the sections themselves (64-byte aligned):
+# the per-placement arrays (definition index, s-start), the definition types
+# and table rows, the packed definition names ('\0'-terminated UTF-8), the
+# name codes of the table rows and the names only they use, and one parameter
+# table per element type.
+# Loading memory-maps the sections (copy-on-write), so a large lattice opens
+# without being read, and slices or s-ranges only touch the pages they need.
+
+import json
+import struct
+import numpy as np
+from array import array
+from LatticeParser import LatticeParser
+from LatticeColumns import ColumnarLattice, ElementTypes, _NameTable
+from LatticeLog import Log
+from LatticeProfile import Instrument
+
+Magic = b"LATTBIN\0"
+Version = 2
+
+# Magic, version, header size, directory offset and size
+_Header = struct.Struct("<8sIIQQ")
+_HeaderSize = 64
+_Alignment = 64
+
+# ---------------------------------------------------------------------------
+def SaveBinary(lattice, outputFile):
+    """Write a lattice (converted to columnar form if need be) to a binary lattice file."""
+
+    if not isinstance(lattice, ColumnarLattice):
+        lattice = ColumnarLattice.FromLattice(lattice)
+
+    shared_names = ''.join(name + '\0' for name in lattice._SharedNames).encode('utf-8')
+    sections = [("definitions", lattice.Definitions),
+                ("starts", lattice.Starts),
+                ("definition_types", np.array(lattice._DefinitionTypes, dtype=np.int8)),
+                ("definition_rows", np.array(lattice._DefinitionRows, dtype=np.int32)),
+                ("names", np.frombuffer(bytes(lattice._Names._Buffer), dtype=np.uint8)),
+                ("row_names", np.concatenate([np.array(names, dtype=np.int32) for names in lattice._TableNames])),
+                ("shared_names", np.frombuffer(shared_names, dtype=np.uint8))]
+    sections += [("table." + element_type, lattice.ParameterTable(element_type)) for element_type in ElementTypes]
+
+    # Lay out the sections after the header, then put the directory after them
+    directory = {"name": lattice.Name, "length": lattice.Length, "sequence_length": float(lattice.Lengths.sum()),
+                 "placements": len(lattice.Starts),
+                 "definitions": len(lattice._Names), "starts_sorted": lattice.StartsSorted(),
+                 "sections": {}}
+    offset = _HeaderSize
+    for section, array in sections:
+        directory["sections"][section] = {"offset": offset, "shape": list(array.shape),
+                                          "dtype": np.lib.format.dtype_to_descr(array.dtype)}
+        offset += -(-array.nbytes // _Alignment) * _Alignment
+    directory_bytes = json.dumps(directory).encode('utf-8')
+
+    with open(outputFile, 'wb') as outFile:
+        outFile.write(_Header.pack(Magic, Version, _HeaderSize, offset, len(directory_bytes)).ljust(_HeaderSize, b'\0'))
+        for section, array in sections:
+            data = np.ascontiguousarray(array).tobytes()
+            outFile.write(data)
+            outFile.write(b'\0' * (-len(data) % _Alignment))
+        outFile.write(directory_bytes)
+
+# ---------------------------------------------------------------------------
+def ReadDirectory(inputFile):
+    """Read the header and directory of a binary lattice file."""
+
+    with open(inputFile, 'rb') as inFile:
+        header = inFile.read(_Header.size)
+        if len(header) < _Header.size or header[:len(Magic)] != Magic:
+            raise RuntimeError("{} is not a binary lattice file.".format(inputFile))
+        magic, version, header_size, directory_offset, directory_size = _Header.unpack(header)
+        if version != Version:
+            raise RuntimeError("{} has binary lattice format version {}; this version reads {}."
+                               .format(inputFile, version, Version))
+        inFile.seek(directory_offset)
+        directory = inFile.read(directory_size)
+    try:
+        return json.loads(directory.decode('utf-8'))
+    except ValueError:
+        raise RuntimeError("{} is a truncated binary lattice file.".format(inputFile))
+
+def _Section(inputFile, entry):
+    dtype = np.lib.format.descr_to_dtype(entry["dtype"])
+    shape = tuple(entry["shape"])
+    if not np.prod(shape):
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(inputFile, mode='c', dtype=dtype, offset=entry["offset"], shape=shape)
+
+def LoadBinary(inputFile):
+    """Open a binary lattice file as a ColumnarLattice whose columns and parameter tables are
+    memory-mapped copy-on-write: nothing is read until it is used, and changes stay in memory."""
+
+    directory = ReadDirectory(inputFile)
+    sections = {section: _Section(inputFile, entry) for section, entry in directory["sections"].items()}
+
+    lattice = ColumnarLattice(capacity=1)
+    lattice.Name = directory["name"]
+    lattice._Definitions = sections["definitions"]
+    lattice._Starts = sections["starts"]
+    lattice._Size = directory["placements"]
+    lattice._StartsSorted = directory["starts_sorted"]
+
+    # The definition names and indices are needed for name lookups, so they are read in full
+    lattice._Names = _NameTable(bytes(sections["names"]))
+    lattice._DefinitionTypes = array('b', bytes(sections["definition_types"]))
+    lattice._DefinitionRows = array('i', np.ascontiguousarray(sections["definition_rows"], dtype=np.int32).tobytes())
+    shared_names = bytes(sections["shared_names"]).decode('utf-8')
+    lattice._SharedNames = shared_names[:-1].split('\0') if shared_names else []
+    row_names = np.asarray(sections["row_names"])
+    for code, element_type in enumerate(ElementTypes):
+        lattice._Tables[code] = sections["table." + element_type]
+        lattice._TableNames[code] = array('i', np.ascontiguousarray(row_names[:len(lattice._Tables[code])], dtype=np.int32).tobytes())
+        row_names = row_names[len(lattice._Tables[code]):]
+    lattice._IndexRows()
+
+    lattice._SequenceLength = directory["sequence_length"]
+    lattice.Length = directory["length"]
+    return lattice
+
+# ---------------------------------------------------------------------------
+class BinaryParser(LatticeParser):
+    """Reads and writes binary lattice files, so that the binary format can be used like the text formats."""
+
+    def __init__(self, **kwargs):
+        LatticeParser.__init__(self, **kwargs)
+
+    # ---------------------------------------------------------------------------
+    @Instrument("parse")
+    def ParseInput(self, **kwargs):
+        inputFile = kwargs.get('inputFile')
+        Log.info('''
+-----------------------------------------------------
+Opening binary lattice\n{}
+'''.format(inputFile))
+
+        self.Lattice = LoadBinary(inputFile)
+
+        self.AddDrifts(**kwargs)
+
+        Log.info("Total lattice length {}m.".format(self.Lattice.Length))
+
+        Log.info('''
+Completed.
+-----------------------------------------------------
+''')
+
+    # ---------------------------------------------------------------------------
+    def Placements(self, **kwargs):
+        """Generate the placements as (element, s) pairs, reading the memory-mapped columns in chunks."""
+
+        lattice = LoadBinary(kwargs.get('inputFile'))
+        self.Lattice.Name = lattice.Name
+        self.Lattice.Length = lattice.Length
+        views = {}
+        for first in range(0, len(lattice.Starts), 65536):
+            definitions = lattice.Definitions[first:first+65536].tolist()
+            for definition, location in zip(definitions, lattice.Starts[first:first+65536].tolist()):
+                view = views.get(definition)
+                if view is None:
+                    view = views[definition] = lattice._View(definition)
+                yield view, location
+
+    # ---------------------------------------------------------------------------
+    @Instrument("write")
+    def WriteLattice(self, **kwargs):
+
+        if kwargs.get('outputFile', None) is not None:
+            outputFile = kwargs.get('outputFile')
+        else:
+            outputFile = "{}.ltb".format(self.Lattice.Name)
+
+        Log.info('''
+-----------------------------------------------------
+Writing binary lattice to\n{}
+'''.format(outputFile))
+
+        SaveBinary(self.Lattice, outputFile)
+        Log.info('''
+Completed.
+-----------------------------------------------------
+''')
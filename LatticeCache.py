@@ -0,0 +1,88 @@
+# LatticeCache.py
+#
+# On-disk cache of parsed lattices.
+# Entries are keyed by the content hash of the input file, the parser options
+# and the package version, stored as pickles and evicted least-recently-used
+# once the cache directory grows beyond its size limit.
+
+import os
+import json
+import pickle
+import hashlib
+import tempfile
+
+class LatticeCache:
+    def __init__(self, directory, max_bytes=1<<30, version=''):
+        self.Directory = directory
+        self.MaxBytes = max_bytes
+        self.Version = version
+        os.makedirs(directory, exist_ok=True)
+
+    def Key(self, inputFile, **options):
+        """Hash of the input file contents, the parser options and the package version."""
+
+        digest = hashlib.sha256()
+        with open(inputFile, 'rb') as inFile:
+            for block in iter(lambda: inFile.read(1<<20), b''):
+                digest.update(block)
+        digest.update(json.dumps([self.Version, options], sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def Path(self, key):
+        return os.path.join(self.Directory, key + '.pkl')
+
+    def Load(self, key):
+        """Return the cached object for a key, or None if there is no usable entry."""
+
+        path = self.Path(key)
+        try:
+            with open(path, 'rb') as inFile:
+                cached = pickle.load(inFile)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            self.Remove(path)
+            return None
+        # Modification time records the last use, for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return cached
+
+    def Store(self, key, value):
+        """Write an entry atomically (safe when several processes share the cache), then evict old entries."""
+
+        handle, temporary = tempfile.mkstemp(dir=self.Directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as outFile:
+                pickle.dump(value, outFile, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, self.Path(key))
+        except BaseException:
+            self.Remove(temporary)
+            raise
+        self.Evict()
+
+    def Evict(self):
+        """Remove least-recently-used entries until the cache fits within its size limit."""
+
+        entries = []
+        for entry in os.scandir(self.Directory):
+            if entry.name.endswith('.pkl'):
+                try:
+                    status = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((status.st_mtime, status.st_size, entry.path))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.MaxBytes:
+                break
+            self.Remove(path)
+            total -= size
+
+    def Remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
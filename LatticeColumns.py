@@ -0,0 +1,739 @@
+# LatticeColumns.py
+#
+# Columnar storage mode for a lattice.
+# Placements are held in parallel NumPy arrays (definition index and s-start),
+# element definitions in per-type parameter tables and the names in one packed
+# buffer.  The type codes and lengths of the placements are derived from the
+# definitions.  The usual Lattice dictionaries and element attributes are thin
+# views over them.
+
+import numpy as np
+from array import array
+from collections.abc import Mapping, Sequence
+from LatticeData import *
+from LatticeLog import Log
+from LatticeProfile import Instrument
+
+# Type codes are indices into this tuple
+ElementTypes = tuple(ElementCollections)
+ElementTypeCodes = {element_type: code for code, element_type in enumerate(ElementTypes)}
+
+# Parameters stored in the per-type tables (None is stored as NaN)
+ElementParameters = {"Drift": ("Length",),
+                     "RF": ("Length", "Energy", "Frequency"),
+                     "Dipole": ("Length", "Angle", "K0", "K1", "Gap", "FringeK", "E1", "E2"),
+                     "DipoleEdge": ("Angle", "E1", "K0", "Gap", "FringeK"),
+                     "Quad": ("Length", "K1"),
+                     "SQuad": ("Length", "K1", "Tilt"),
+                     "Sext": ("Length", "K2"),
+                     "Octu": ("Length", "K3"),
+                     "Solenoid": ("Length", "KS")}
+
+# Dipoles also record their geometry and the definition indices of their edges (-1 if none)
+DipoleFields = [("Sector", np.bool_), ("UpEdge", np.int32), ("DownEdge", np.int32)]
+
+def ParameterDtype(element_type):
+    fields = [(parameter, np.float64) for parameter in ElementParameters[element_type]]
+    if element_type == "Dipole":
+        fields += DipoleFields
+    return np.dtype(fields)
+
+# ---------------------------------------------------------------------------
+def _ParameterProperty(code, parameter):
+    def getter(self):
+        value = self._Lattice._Tables[code][parameter][self._Row]
+        return None if np.isnan(value) else float(value)
+    def setter(self, value):
+        self._Lattice._Tables[code][parameter][self._Row] = np.nan if value is None else value
+    return property(getter, setter)
+
+def _EdgeProperty(code, parameter):
+    def getter(self):
+        index = self._Lattice._Tables[code][parameter][self._Row]
+        return None if index < 0 else self._Lattice._View(int(index))
+    def setter(self, edge):
+        self._Lattice._Tables[code][parameter][self._Row] = -1 if edge is None else self._Lattice._Define(edge)
+    return property(getter, setter)
+
+def _SectorProperty(code):
+    def getter(self):
+        return bool(self._Lattice._Tables[code]["Sector"][self._Row])
+    def setter(self, value):
+        self._Lattice._Tables[code]["Sector"][self._Row] = value
+    return property(getter, setter)
+
+def _NameProperty(code):
+    def getter(self):
+        if self._Index < 0:
+            return self._Lattice._RowName(code, self._Row)
+        return self._Lattice._Names[self._Index]
+    return property(getter)
+
+def _ViewEquals(self, other):
+    return (type(other) is type(self) and other._Lattice is self._Lattice
+            and other._Index == self._Index and other._Row == self._Row)
+
+def _ViewHash(self):
+    return hash((id(self._Lattice), self._Index, self._Row))
+
+def _ViewClass(element_type):
+    """Build a subclass of an element class whose attributes read and write a row of a parameter table.
+    A view of a name has its definition index; the view of the definition a row holds (its Definition)
+    has index -1.  Views are equal if they view the same name or definition of the same lattice."""
+
+    code = ElementTypeCodes[element_type]
+    namespace = {"__slots__": ("_Lattice", "_Index", "_Row"),
+                 "Name": _NameProperty(code),
+                 "Definition": property(lambda self: self._Lattice._RowView(code, self._Row)),
+                 "Center": property(lambda self: None),
+                 "__eq__": _ViewEquals,
+                 "__hash__": _ViewHash}
+    for parameter in ElementParameters[element_type]:
+        namespace[parameter] = _ParameterProperty(code, parameter)
+    if element_type == "Dipole":
+        namespace["Sector"] = _SectorProperty(code)
+        namespace["UpEdge"] = _EdgeProperty(code, "UpEdge")
+        namespace["DownEdge"] = _EdgeProperty(code, "DownEdge")
+    return type(element_type+"View", (globals()[element_type],), namespace)
+
+ViewClasses = [_ViewClass(element_type) for element_type in ElementTypes]
+
+# ---------------------------------------------------------------------------
+class _SequenceView(Sequence):
+    """Read-only list of placement names."""
+
+    def __init__(self, lattice):
+        self._Lattice = lattice
+
+    def __len__(self):
+        return self._Lattice._Size
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __getitem__(self, index):
+        names = self._Lattice._Names
+        definitions = self._Lattice.Definitions
+        if isinstance(index, slice):
+            return [names[definition] for definition in definitions[index].tolist()]
+        return names[definitions[index]]
+
+    def __iter__(self, chunk=65536):
+        names = self._Lattice._Names
+        definitions = self._Lattice.Definitions
+        for first in range(0, len(definitions), chunk):
+            for definition in definitions[first:first+chunk].tolist():
+                yield names[definition]
+
+    def __contains__(self, name):
+        definition = self._Lattice._Names.get(name)
+        return definition is not None and bool((self._Lattice.Definitions == definition).any())
+
+    def index(self, name, start=0, stop=None):
+        definition = self._Lattice._Names.get(name)
+        if definition is not None:
+            matches = np.flatnonzero(self._Lattice.Definitions[start:stop] == definition)
+            if len(matches):
+                return start + int(matches[0])
+        raise ValueError("{} is not in the sequence".format(name))
+
+    def count(self, name):
+        definition = self._Lattice._Names.get(name)
+        if definition is None:
+            return 0
+        return int(np.count_nonzero(self._Lattice.Definitions == definition))
+
+# ---------------------------------------------------------------------------
+class _DefinitionView(Mapping):
+    """Read-only name -> element mapping over all definitions, or those of one type."""
+
+    def __init__(self, lattice, code=None):
+        self._Lattice = lattice
+        self._Code = code
+
+    def __getitem__(self, name):
+        index = self._Lattice._Names.get(name)
+        if index is None:
+            raise KeyError(name)
+        if self._Code is not None and self._Lattice._DefinitionTypes[index] != self._Code:
+            raise KeyError(name)
+        return self._Lattice._View(index)
+
+    def __contains__(self, name):
+        index = self._Lattice._Names.get(name)
+        return index is not None and (self._Code is None or self._Lattice._DefinitionTypes[index] == self._Code)
+
+    def __iter__(self):
+        names = self._Lattice._Names
+        if self._Code is None:
+            return iter(names)
+        types = np.frombuffer(self._Lattice._DefinitionTypes, dtype=np.int8)
+        return (names[index] for index in np.flatnonzero(types == self._Code).tolist())
+
+    def __len__(self):
+        if self._Code is None:
+            return len(self._Lattice._Names)
+        return self._Lattice._DefinitionTypes.count(self._Code)
+
+# ---------------------------------------------------------------------------
+class _EdgePlacements(Mapping):
+    """Read-only dipole index -> (up edge index, down edge index) mapping over the sorted indices of the
+    dipole placements between two edges, whose edges are the placements either side of them."""
+
+    def __init__(self, dipoles):
+        self._Dipoles = dipoles
+
+    def __getitem__(self, index):
+        position = int(np.searchsorted(self._Dipoles, index))
+        if position == len(self._Dipoles) or self._Dipoles[position] != index:
+            raise KeyError(index)
+        return index-1, index+1
+
+    def __iter__(self):
+        return iter(self._Dipoles.tolist())
+
+    def __len__(self):
+        return len(self._Dipoles)
+
+# ---------------------------------------------------------------------------
+class _NameTable:
+    """The names of the definitions, packed into one buffer of '\0'-terminated UTF-8 strings with their
+    offsets, and looked up by an open-addressing hash table of name indices (-1 where empty) built when
+    first needed, rather than held as a list of strings and a dictionary of them."""
+
+    __slots__ = ('_Buffer', '_Offsets', '_Slots')
+
+    def __init__(self, buffer=b''):
+        self._Buffer = bytearray(buffer)
+        self._Offsets = array('i', [0])
+        ends = np.flatnonzero(np.frombuffer(bytes(buffer), dtype=np.uint8) == 0) + 1
+        self._Offsets.frombytes(ends.astype(np.int32).tobytes())
+        self._Slots = None
+
+    @classmethod
+    def FromNames(cls, names):
+        return cls(''.join(name + '\0' for name in names).encode('utf-8'))
+
+    def __len__(self):
+        return len(self._Offsets) - 1
+
+    def __getitem__(self, index):
+        return self._Buffer[self._Offsets[index]:self._Offsets[index+1]-1].decode('utf-8')
+
+    def __iter__(self):
+        return iter(self._Buffer[:-1].decode('utf-8').split('\0') if self._Buffer else ())
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def get(self, name, default=None):
+        """The index of a name, or the default."""
+
+        if self._Slots is None:
+            self._Rehash(len(self))
+        encoded = name.encode('utf-8')
+        mask = len(self._Slots) - 1
+        slot = hash(name) & mask
+        while True:
+            index = self._Slots[slot]
+            if index < 0:
+                return default
+            if self._Buffer[self._Offsets[index]:self._Offsets[index+1]-1] == encoded:
+                return index
+            slot = (slot + 1) & mask
+
+    def append(self, name):
+        index = len(self)
+        self._Buffer += name.encode('utf-8') + b'\0'
+        self._Offsets.append(len(self._Buffer))
+        if self._Slots is not None:
+            if 2*len(self) > len(self._Slots):
+                self._Rehash(len(self))
+            else:
+                self._Insert(name, index)
+        return index
+
+    def _Rehash(self, size):
+        # At most half full, so that probe sequences stay short
+        capacity = 8
+        while capacity < 2*size + 2:
+            capacity *= 2
+        self._Slots = array('i', [-1]) * capacity
+        for index, name in enumerate(self):
+            self._Insert(name, index)
+
+    def _Insert(self, name, index):
+        mask = len(self._Slots) - 1
+        slot = hash(name) & mask
+        while self._Slots[slot] >= 0:
+            slot = (slot + 1) & mask
+        self._Slots[slot] = index
+
+    def __getstate__(self):
+        # String hashes differ between processes, so the hash table is rebuilt rather than stored
+        return bytes(self._Buffer)
+
+    def __setstate__(self, buffer):
+        self.__init__(buffer)
+
+# ---------------------------------------------------------------------------
+class ColumnarLattice(Lattice):
+    """Lattice stored as NumPy columns rather than per-element Python objects.
+
+    Sequence, Locations, Elements and the per-type dictionaries are read-only views, and the
+    elements they return are views onto the parameter tables, so attribute changes (e.g. when
+    dipole edges are associated) are written back to the tables.  Parameter values are returned
+    as floats.  Locations lists the s-start of every placement of a name.  Names placed as the same
+    definition (e.g. MAD-X placements of a shared element) share its table row, as placements share
+    a definition in a Lattice."""
+
+    def __init__(self, capacity=1024):
+        # The containers set up by Lattice.__init__ are replaced by views
+        self.Name = "Lattice"
+        self.Length = 0.
+        self._SequenceLength = 0.
+        self._Size = 0
+        self._Definitions = np.empty(capacity, dtype=np.int32)
+        self._Starts = np.empty(capacity, dtype=np.float64)
+        self._Names = _NameTable()
+        self._DefinitionTypes = array('b')
+        self._DefinitionRows = array('i')
+        self._Tables = [np.zeros(16, dtype=ParameterDtype(element_type)) for element_type in ElementTypes]
+        # The name of the definition held by each table row, as the index of the same name, or if there is
+        # none, as -1 - its index in the shared names
+        self._TableNames = [array('i') for element_type in ElementTypes]
+        self._SharedNames = []
+        # (type code, definition name) -> row, for rows not named after one of the names they hold
+        self._SharedRows = {}
+        self._LocationCache = None
+        self._StartsSorted = None
+        self._Index = None
+        self.DipoleEdgePlacements = {}
+
+    @classmethod
+    def FromLattice(cls, lattice):
+        """Build a columnar copy of an existing lattice."""
+
+        columnar = cls(capacity=max(len(lattice.Sequence), 1))
+        columnar.Name = lattice.Name
+        occurrences = {}
+        for name in lattice.Sequence:
+            element = lattice.Elements[name]
+            occurrence = occurrences.get(name, 0)
+            occurrences[name] = occurrence + 1
+            locations = lattice.Locations.get(name, [])
+            start = locations[occurrence] if occurrence < len(locations) else columnar._SequenceLength
+            columnar._Place(columnar._Define(element), start, getattr(element, 'Length', 0.))
+        for name in lattice.Elements:
+            columnar._Define(lattice.Elements[name])
+        columnar.Length = lattice.Length
+        return columnar
+
+    # Placement columns, trimmed to the number of placements
+    @property
+    def Definitions(self):
+        return self._Definitions[:self._Size]
+
+    @property
+    def Starts(self):
+        return self._Starts[:self._Size]
+
+    # Type codes and lengths of the placements, derived from their definitions
+    @property
+    def Types(self):
+        return np.frombuffer(self._DefinitionTypes, dtype=np.int8)[self.Definitions]
+
+    @property
+    def Lengths(self):
+        return self.DefinitionLengths()[self.Definitions]
+
+    def DefinitionLengths(self):
+        """The length of every definition (zero for types without one), as an array."""
+
+        types = np.frombuffer(self._DefinitionTypes, dtype=np.int8)
+        rows = np.frombuffer(self._DefinitionRows, dtype=np.int32)
+        lengths = np.zeros(len(types))
+        for code, element_type in enumerate(ElementTypes):
+            if "Length" in ElementParameters[element_type]:
+                of_type = types == code
+                lengths[of_type] = self._Tables[code]["Length"][rows[of_type]]
+        return np.nan_to_num(lengths, nan=0.)
+
+    def ParameterTable(self, element_type):
+        """Parameter table for one element type, one row per definition in the order they were added."""
+
+        code = ElementTypeCodes[element_type]
+        return self._Tables[code][:len(self._TableNames[code])]
+
+    @property
+    def Sequence(self):
+        return _SequenceView(self)
+
+    @property
+    def Elements(self):
+        return _DefinitionView(self)
+
+    @property
+    def Locations(self):
+        if self._LocationCache is None:
+            definitions = self.Definitions
+            order = np.argsort(definitions, kind='stable')
+            grouped = definitions[order]
+            bounds = np.flatnonzero(np.diff(grouped)) + 1
+            keys = grouped[np.concatenate(([0], bounds))] if len(grouped) else grouped
+            groups = np.split(self.Starts[order], bounds)
+            self._LocationCache = {self._Names[key]: group.tolist()
+                                   for key, group in zip(keys.tolist(), groups)}
+        return self._LocationCache
+
+    def _View(self, index):
+        view = object.__new__(ViewClasses[self._DefinitionTypes[index]])
+        view._Lattice = self
+        view._Index = index
+        view._Row = self._DefinitionRows[index]
+        return view
+
+    def _RowView(self, code, row):
+        view = object.__new__(ViewClasses[code])
+        view._Lattice = self
+        view._Index = -1
+        view._Row = row
+        return view
+
+    def _Define(self, element):
+        """Return the definition index for an element, adding its parameters to the tables if it is new.
+        An element placed as a definition already held by a row (found by the definition's name, with
+        the same parameters) shares that row."""
+
+        index = self._Names.get(element.Name)
+        if index is not None:
+            return index
+        definition = element.Definition
+        definition_class = definition.__class__
+        if definition_class in ViewClasses:
+            definition_class = definition_class.__bases__[0]
+        element_type = definition_class.__name__
+        if element_type not in ElementTypeCodes:
+            raise TypeError("ColumnarLattice cannot store elements of type {}".format(element_type))
+        code = ElementTypeCodes[element_type]
+        values = self._Parameters(code, definition)
+        row = self._SharedRow(code, definition, values) if definition is not element else None
+        if row is None:
+            if definition.Name != element.Name:
+                row = self._AddRow(code, self._NameCode(definition.Name), values)
+                self._SharedRows[(code, definition.Name)] = row
+            else:
+                row = self._AddRow(code, len(self._Names), values)
+
+        index = self._Names.append(element.Name)
+        self._DefinitionTypes.append(code)
+        self._DefinitionRows.append(row)
+        return index
+
+    def _Parameters(self, code, definition):
+        """The values of a table row for a definition (defining the edges of a dipole)."""
+
+        element_type = ElementTypes[code]
+        values = []
+        for parameter in ElementParameters[element_type]:
+            value = getattr(definition, parameter, None)
+            values.append(np.nan if value is None else value)
+        if element_type == "Dipole":
+            values.append(definition.Sector)
+            values.append(-1 if definition.UpEdge is None else self._Define(definition.UpEdge))
+            values.append(-1 if definition.DownEdge is None else self._Define(definition.DownEdge))
+        return values
+
+    def _SharedRow(self, code, definition, values):
+        """The row already holding a definition, or None."""
+
+        if getattr(definition, '_Lattice', None) is self:
+            return definition._Row
+        row = self._SharedRows.get((code, definition.Name))
+        if row is None:
+            index = self._Names.get(definition.Name)
+            if index is None or self._DefinitionTypes[index] != code:
+                return None
+            row = self._DefinitionRows[index]
+        if self._RowName(code, row) != definition.Name:
+            return None
+        for value, stored in zip(values, self._Tables[code][row].tolist()):
+            if value != stored and not (value != value and stored != stored):
+                return None
+        return row
+
+    def _AddRow(self, code, name_code, values):
+        row = len(self._TableNames[code])
+        if row == len(self._Tables[code]):
+            table = np.zeros(max(2*row, 16), dtype=self._Tables[code].dtype)
+            table[:row] = self._Tables[code]
+            self._Tables[code] = table
+        self._TableNames[code].append(name_code)
+        self._Tables[code][row] = tuple(values)
+        return row
+
+    def _NameCode(self, name):
+        """The code of a table row name: the index of the same name, else -1 - its index in the shared names."""
+
+        index = self._Names.get(name)
+        if index is not None:
+            return index
+        self._SharedNames.append(name)
+        return -len(self._SharedNames)
+
+    def _RowName(self, code, row):
+        name_code = self._TableNames[code][row]
+        return self._Names[name_code] if name_code >= 0 else self._SharedNames[-1-name_code]
+
+    def _RowNames(self, code):
+        return [self._RowName(code, row) for row in range(len(self._TableNames[code]))]
+
+    def _IndexRows(self):
+        """Rebuild the lookup of the rows which are not named after one of the names they hold."""
+
+        self._SharedRows = {}
+        for code in range(len(ElementTypes)):
+            for row, name in enumerate(self._RowNames(code)):
+                index = self._Names.get(name)
+                if index is None or self._DefinitionTypes[index] != code or self._DefinitionRows[index] != row:
+                    self._SharedRows[(code, name)] = row
+
+    def _Place(self, index, start, length):
+        if self._Size == len(self._Starts):
+            # Grown by a quarter, so that little of the columns is left unused once a lattice is loaded
+            self._Reserve(self._Size + max(self._Size//4, 1024))
+        self._Definitions[self._Size] = index
+        self._Starts[self._Size] = start
+        self._Size += 1
+        self._SequenceLength += length
+        self._LocationCache = None
+        self._StartsSorted = None
+        self._Index = None
+
+    def _Reserve(self, capacity):
+        for column in ('_Definitions', '_Starts'):
+            old = getattr(self, column)
+            new = np.empty(max(capacity, 1), dtype=old.dtype)
+            new[:self._Size] = old[:self._Size]
+            setattr(self, column, new)
+
+    def AddElement(self, element, **kwargs):
+        new_definition = element.Name not in self._Names
+        index = self._Define(element)
+        length = element.Length if hasattr(element, 'Length') else 0.
+        if element.Center is not None:
+            start = element.Center - length/2.
+        else:
+            if new_definition:
+                self.Length = self._SequenceLength
+            start = self._SequenceLength
+        self._Place(index, start, length)
+
+    @Instrument("dipole edges")
+    def AssociateDipoleEdges(self):
+        """Associate dipole edges with the dipole elements, finding the neighbours of every dipole placement
+        by comparing the type column with itself shifted by one placement."""
+
+        self.DipoleEdgePlacements = {}
+        types = self.Types
+        dipoles = np.flatnonzero(types == ElementTypeCodes["Dipole"])
+        if not len(self._TableNames[ElementTypeCodes["DipoleEdge"]]):
+            return []
+        is_edge = np.zeros(len(types)+2, dtype=bool)
+        is_edge[1:-1] = types == ElementTypeCodes["DipoleEdge"]
+        with_edges = is_edge[dipoles] & is_edge[dipoles+2]
+        self.DipoleEdgePlacements = _EdgePlacements(dipoles[with_edges].astype(np.int32))
+        # Only the first placement with edges of each definition needs attaching
+        definitions, first = np.unique(self.Definitions[dipoles[with_edges]], return_index=True)
+        self.AttachDipoleEdges({index: (index-1, index+1) for index in np.sort(dipoles[with_edges][first]).tolist()})
+        return dipoles[~with_edges].tolist()
+
+    def AttachDipoleEdges(self, placements):
+        """Add the edges to each dipole, from the first of its placements that has edges.  As with EdgedDipoles,
+        names sharing a row but not their edges get a row for each (row, up edge, down edge) combination:
+        the first combination keeps the row if every name of the row has it, and otherwise each combination
+        is named after the first dipole it is found on."""
+
+        code = ElementTypeCodes["Dipole"]
+        definitions = self.Definitions
+        combinations = {}
+        attached = set()
+        for index, (up_index, down_index) in placements.items():
+            dipole, up, down = (int(definitions[placement]) for placement in (index, up_index, down_index))
+            if dipole in attached:
+                continue
+            attached.add(dipole)
+            Log.info("Adding edges {} and {} to dipole {}".format(self._Names[up], self._Names[down], self._Names[dipole]))
+            row = self._DefinitionRows[dipole]
+            table = self._Tables[code]
+            if table["UpEdge"][row] == up and table["DownEdge"][row] == down:
+                continue
+            key = (row, self._DefinitionRows[up], self._DefinitionRows[down])
+            combinations.setdefault(key, (up, down, []))[2].append(dipole)
+
+        rows = np.array(self._DefinitionRows, dtype=np.intp)[np.array(self._DefinitionTypes, dtype=np.int8) == code]
+        unedged = np.bincount(rows, minlength=len(self._TableNames[code]))
+        for (row, up_row, down_row), (up, down, dipoles) in combinations.items():
+            unedged[row] -= len(dipoles)
+        kept = set()
+        for (row, up_row, down_row), (up, down, dipoles) in combinations.items():
+            if not unedged[row] and row not in kept:
+                kept.add(row)
+                combination = row
+            else:
+                combination = self._AddRow(code, dipoles[0], self._Tables[code][row].tolist())
+            for dipole in dipoles:
+                self._DefinitionRows[dipole] = combination
+            view = self._RowView(code, combination)
+            view.AddUpEdge(self._View(up))
+            view.AddDownEdge(self._View(down))
+
+    @Instrument("drift insertion")
+    def InsertDrifts(self, mode, tolerance=DriftTolerance):
+        """Insert drifts into the gaps between placements, computed from the s-start and length columns.
+        Drifts whose lengths agree within the tolerance share a single definition."""
+
+        lattice_length = self.Length
+        order = np.argsort(self.Starts, kind='stable')
+        definitions = self.Definitions[order]
+        starts, lengths = self.Starts[order], self.Lengths[order]
+        positions, gaps, gap_starts = DriftGaps(starts, lengths)
+        drift_lengths, drift_groups = GroupLengths(gaps, tolerance)
+        drift_definitions = np.array([self._Define(Drift("drift"+str(drift_index), length=drift_length))
+                                      for drift_index, drift_length in enumerate(drift_lengths.tolist())], dtype=np.int32)
+
+        self._Definitions = np.insert(definitions, positions, drift_definitions[drift_groups]).astype(np.int32)
+        self._Starts = np.insert(starts, positions, gap_starts)
+        self._Size = len(self._Starts)
+        self._LocationCache = None
+        self._StartsSorted = None
+        self.MeasureLength()
+
+        ends_drift_length = lattice_length - self.Length
+        if mode == "both":
+            start_drift = self._Define(Drift("drift_start", length=ends_drift_length/2.))
+            self._Definitions = np.insert(self.Definitions, 0, start_drift).astype(np.int32)
+            self._Starts = np.insert(self.Starts + ends_drift_length/2., 0, 0.)
+            self._Size += 1
+            self.MeasureLength()
+            self._Place(self._Define(Drift("drift_end", length=ends_drift_length/2.)),
+                        self.Length, ends_drift_length/2.)
+        elif mode == "end":
+            self._Place(self._Define(Drift("drift_end", length=ends_drift_length)),
+                        self.Length, ends_drift_length)
+        self.MeasureLength()
+        Log.info("Length of lattice after adding drifts {} (defintion {})".format(self.Length, lattice_length))
+
+    @Instrument("definition interning")
+    def InternDefinitions(self, tolerance=0., keep_names=False):
+        """Merge definitions of the same type whose parameters agree (rounded to a multiple of the tolerance,
+        if it is not zero) into the first of them, by finding the unique rows of each parameter table, then
+        remap the rows of the names and compact the tables.  With keep_names every name is kept, sharing the
+        merged row; otherwise the names sharing a row are merged into the first of them, remapping the
+        definition column.  Returns the number of definitions merged."""
+
+        types = np.array(self._DefinitionTypes, dtype=np.intp)
+        rows = np.array(self._DefinitionRows, dtype=np.intp)
+        canonical = [np.arange(len(names)) for names in self._TableNames]
+
+        # Dipole edges first, so that dipoles can be compared by the shared definitions of their edges
+        codes = sorted(range(len(ElementTypes)), key=lambda code: ElementTypes[code] != "DipoleEdge")
+        for code in codes:
+            if len(canonical[code]) < 2:
+                continue
+            element_type = ElementTypes[code]
+            table = self.ParameterTable(element_type)
+            columns = []
+            for parameter in ElementParameters[element_type]:
+                values = table[parameter]
+                missing = np.isnan(values)
+                columns += [missing, np.where(missing, 0., np.round(values / tolerance) if tolerance else values)]
+            if element_type == "Dipole":
+                columns.append(table["Sector"])
+                edge_rows = canonical[ElementTypeCodes["DipoleEdge"]]
+                for edge in ("UpEdge", "DownEdge"):
+                    edges = table[edge].astype(np.intp)
+                    columns.append(np.where(edges < 0, -1, edge_rows[rows[np.maximum(edges, 0)]]))
+            keys = np.stack([np.asarray(column, dtype=np.float64) for column in columns], axis=1)
+            unique, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+            canonical[code] = first[inverse.reshape(-1)]
+
+        n_merged = sum(int((row_map != np.arange(len(row_map))).sum()) for row_map in canonical)
+        if n_merged:
+            for code, element_type in enumerate(ElementTypes):
+                kept = canonical[code] == np.arange(len(canonical[code]))
+                renumber = np.cumsum(kept) - 1
+                of_type = types == code
+                rows[of_type] = renumber[canonical[code][rows[of_type]]]
+                self._Tables[code] = np.array(self.ParameterTable(element_type)[kept])
+                self._TableNames[code] = array('i', np.asarray(self._TableNames[code])[kept].tolist())
+            self._DefinitionRows = array('i', rows.tolist())
+
+        # Without keep_names, every name is merged into the first name sharing its row
+        n_definitions = len(self._Names)
+        first_names = np.arange(n_definitions)
+        if not keep_names and n_definitions:
+            first, inverse = np.unique(np.stack([types, rows], axis=1), axis=0, return_index=True, return_inverse=True)[1:]
+            first_names = first[inverse.reshape(-1)]
+        kept = first_names == np.arange(n_definitions)
+        if not kept.all():
+            renumber = np.cumsum(kept) - 1
+            remap = renumber[first_names]
+            # All columns are trimmed to the placements, so that they keep the same capacity
+            self._Definitions = remap[self.Definitions].astype(np.int32)
+            self._Starts = np.array(self.Starts)
+            dipoles = self._Tables[ElementTypeCodes["Dipole"]]
+            for edge in ("UpEdge", "DownEdge"):
+                dipoles[edge] = np.where(dipoles[edge] < 0, -1, remap[np.maximum(dipoles[edge], 0)])
+            # The row names are re-encoded, as the names they were indices of may be gone
+            row_names = [self._RowNames(code) for code in range(len(ElementTypes))]
+            names = self._Names
+            self._Names = _NameTable.FromNames(names[index] for index in np.flatnonzero(kept).tolist())
+            self._SharedNames = []
+            self._TableNames = [array('i', [self._NameCode(name) for name in code_names]) for code_names in row_names]
+            self._DefinitionTypes = array('b', types[kept].tolist())
+            self._DefinitionRows = array('i', rows[kept].tolist())
+            self._LocationCache = None
+        self._IndexRows()
+        self._Index = None
+
+        Log.info("Merged {} element definitions into {} shared definitions"
+                 .format(n_merged, sum(len(names) for names in self._TableNames)))
+        return n_merged
+
+    def PlacementLocations(self):
+        return self.Starts.tolist()
+
+    def PlacementExtents(self):
+        return self.Starts, self.Lengths
+
+    def PlacementCodes(self):
+        return self.Definitions, self._Names
+
+    def StartsSorted(self):
+        """Whether the placements are in ascending order of s (checked once, then cached)."""
+
+        if self._StartsSorted is None:
+            starts = self.Starts
+            self._StartsSorted = bool((starts[1:] >= starts[:-1]).all())
+        return self._StartsSorted
+
+    def PlacementRange(self, s_min, s_max):
+        """Indices of the placements starting in [s_min, s_max).  When the placements are in order of s
+        they are found by binary search, so only the pages of memory-mapped columns that are needed are read."""
+
+        starts = self.Starts
+        if self.StartsSorted():
+            return np.arange(np.searchsorted(starts, s_min, 'left'), np.searchsorted(starts, s_max, 'left'))
+        return np.flatnonzero((starts >= s_min) & (starts < s_max))
+
+    def MeasureLength(self):
+        """Measure the length of the lattice as a single reduction over the length column."""
+
+        self.Length = float(self.Lengths.sum())
+        self._SequenceLength = self.Length
+        self._Index = None
+
+# Per-type definition views (Drifts, Dipoles, Quads, ...)
+for _code, _collection in enumerate(ElementCollections.values()):
+    setattr(ColumnarLattice, _collection, property(lambda self, code=_code: _DefinitionView(self, code)))
@@ -0,0 +1,162 @@
+# LatticeCompare.py
+#
+# Equivalence check between two lattices, e.g. a lattice and its conversion to
+# another format.  Each lattice is first reduced to a canonical form, so that
+# differences in how the formats describe the same beamline do not count:
+# drifts are dropped (the gaps are implied by the s-positions) and dipole edges
+# are folded into their dipoles' E1/E2.  The remaining placements are ordered by
+# s and compared column by column (type, s, length and strengths) with
+# vectorized tolerance checks, reporting the first divergences.
+
+import numpy as np
+from LatticeData import ElementType
+from LatticeLog import Log
+
+# Strength parameters compared, as columns of the canonical form (0 where a type does not have one)
+ComparedParameters = ("Angle", "K1", "K2", "K3", "Tilt", "E1", "E2")
+
+# Element types dropped from the canonical form
+FoldedTypes = ("Drift", "DipoleEdge")
+
+class CanonicalLattice:
+    """Placements of a lattice other than drifts and dipole edges, ordered by s, as columns:
+    Names, Types, Starts, Lengths and Parameters (one column per entry of ComparedParameters)."""
+
+    def __init__(self, lattice, relative=False):
+        # Edges not yet associated with their dipoles are folded in here, placement by placement,
+        # so that the lattice itself is left untouched
+        fold_edges = bool(lattice.DipoleEdges) and not lattice.DipoleEdgePlacements
+        self.Length = lattice.Length
+
+        # One row of parameters per definition, looked up once per name
+        elements = lattice.Elements
+        sequence = list(lattice.Sequence)
+        definition_rows = {}
+        rows = {}
+        types, lengths, parameters = [], [], []
+        edge_angles = {}
+        for name in sequence:
+            if name in rows:
+                continue
+            definition = elements[name].Definition
+            row = definition_rows.get(definition.Name)
+            if row is None:
+                element_type = ElementType(definition)
+                if element_type in FoldedTypes:
+                    row = -1
+                else:
+                    row = len(types)
+                    types.append(element_type)
+                    lengths.append(getattr(definition, 'Length', 0.) or 0.)
+                    parameters.append([getattr(definition, parameter, 0.) or 0. for parameter in ComparedParameters])
+                definition_rows[definition.Name] = row
+            rows[name] = row
+            if fold_edges and name in lattice.DipoleEdges:
+                edge_angles[name] = definition.E1
+        placement_rows = np.fromiter((rows[name] for name in sequence), dtype=np.intp, count=len(sequence))
+        starts = np.array(lattice.PlacementLocations(), dtype=float)
+
+        kept = np.flatnonzero(placement_rows >= 0)
+        kept = kept[np.argsort(starts[kept], kind='stable')]
+        placement_rows, starts = placement_rows[kept], starts[kept]
+        if relative and len(starts):
+            starts = starts - starts[0]
+
+        self.Names = np.array(sequence, dtype=object)[kept]
+        self.Types = np.array(types, dtype=object)[placement_rows]
+        self.Starts = starts
+        self.Lengths = np.array(lengths, dtype=float)[placement_rows]
+        self.Parameters = np.array(parameters, dtype=float).reshape(-1, len(ComparedParameters))[placement_rows]
+        if fold_edges:
+            self.FoldEdges(sequence, kept, edge_angles)
+
+    def FoldEdges(self, sequence, kept, edge_angles):
+        """Set the E1/E2 of every dipole placed between two edges from the edges' E1, as
+        Dipole.AddUpEdge/AddDownEdge would."""
+
+        e1, e2 = ComparedParameters.index("E1"), ComparedParameters.index("E2")
+        last = len(sequence) - 1
+        for position in np.flatnonzero(self.Types == "Dipole").tolist():
+            index = int(kept[position])
+            if not 0 < index < last:
+                continue
+            up_edge, down_edge = sequence[index-1], sequence[index+1]
+            if up_edge not in edge_angles or down_edge not in edge_angles:
+                continue
+            if edge_angles[up_edge] is not None:
+                self.Parameters[position, e1] = edge_angles[up_edge]
+            if edge_angles[down_edge] is not None:
+                self.Parameters[position, e2] = edge_angles[down_edge]
+
+    def __len__(self):
+        return len(self.Starts)
+
+def _Divergence(index, first, second, quantity, value_first, value_second):
+    return {"index": index, "name_first": first.Names[index], "name_second": second.Names[index],
+            "quantity": quantity, "first": value_first, "second": value_second}
+
+def CompareLattices(first, second, rtol=1e-9, atol=1e-9, relative=False, max_divergences=10):
+    """Compare two lattices in canonical form, returning a list of divergences ordered by placement.
+
+    Each divergence is a dictionary with the canonical placement index, the names of the placements in
+    both lattices, the quantity that differs and its two values.  Placements are compared only up to the
+    first type mismatch, after which the sequences can no longer be aligned.  With relative, s-positions
+    are measured from the first canonical placement of each lattice."""
+
+    first, second = CanonicalLattice(first, relative), CanonicalLattice(second, relative)
+    divergences = []
+
+    n_common = min(len(first), len(second))
+    mismatched = np.flatnonzero(first.Types[:n_common] != second.Types[:n_common])
+    aligned = int(mismatched[0]) if len(mismatched) else n_common
+
+    # Differences in each quantity, within the aligned placements
+    columns = [("s", first.Starts[:aligned], second.Starts[:aligned]),
+               ("length", first.Lengths[:aligned], second.Lengths[:aligned])]
+    columns += [(parameter, first.Parameters[:aligned, column], second.Parameters[:aligned, column])
+                for column, parameter in enumerate(ComparedParameters)]
+    for quantity, values_first, values_second in columns:
+        differing = np.flatnonzero(~np.isclose(values_first, values_second, rtol=rtol, atol=atol))
+        for index in differing[:max_divergences].tolist():
+            divergences.append(_Divergence(index, first, second, quantity,
+                                           float(values_first[index]), float(values_second[index])))
+
+    if aligned < n_common:
+        divergences.append(_Divergence(aligned, first, second, "type", first.Types[aligned], second.Types[aligned]))
+    elif len(first) != len(second):
+        divergences.append({"index": n_common, "name_first": None, "name_second": None, "quantity": "placements",
+                            "first": len(first), "second": len(second)})
+    if not np.isclose(first.Length, second.Length, rtol=rtol, atol=atol):
+        divergences.append({"index": None, "name_first": None, "name_second": None, "quantity": "lattice length",
+                            "first": first.Length, "second": second.Length})
+
+    divergences.sort(key=lambda divergence: (divergence["index"] is None, divergence["index"] or 0))
+    return divergences[:max_divergences]
+
+def FormatDivergence(divergence):
+    if divergence["index"] is None or divergence["name_first"] is None:
+        return "{}: {} != {}".format(divergence["quantity"], divergence["first"], divergence["second"])
+    return ("placement {} ({} / {}): {} {} != {}"
+            .format(divergence["index"], divergence["name_first"], divergence["name_second"],
+                    divergence["quantity"], divergence["first"], divergence["second"]))
+
+def ReportDivergences(divergences):
+    """Log the divergences, returning True if the lattices are equivalent."""
+
+    if not divergences:
+        Log.info("Lattices are equivalent")
+        return True
+    Log.warning("Lattices differ; first divergences:")
+    for divergence in divergences:
+        Log.warning("  " + FormatDivergence(divergence))
+    return False
+
+def CompareFiles(first, second, beamline=None, columnar=False, **kwargs):
+    """Load two lattice files, each given as a (format, file name) or (format, file name, beamline)
+    tuple, and compare them with CompareLattices (to which the remaining arguments are passed).
+    The beamline argument is used for files given without one."""
+    from LatticeConvert import LatticeConverter
+
+    lattices = [LatticeConverter(columnar=columnar).LoadFormat(*(tuple(lattice) + (beamline,))[:3])
+                for lattice in (first, second)]
+    return CompareLattices(*lattices, **kwargs)
@@ -4,38 +4,92 @@
 # M Wallbank, Fermilab <wallbank@fnal.gov>
 # July 2023
 
-from LatticeData import Lattice
+import os
+from LatticeData import Lattice, LatticeLayout, StreamLayout
+from LatticeLog import Log, ConfigureLogging
+from LatticeProfile import Profile, Instrument
 from SixDSimParser import SixDSimParser
 from ElegantParser import ElegantParser
 from MADXParser import MADXParser
 
+# Bump when parsing changes, to invalidate lattice caches
+__version__ = "1.1"
+
+# Parser options that change the parsed lattice, and so form part of the cache key
+CacheOptions = ('beamline', 'add_drifts', 'drift_tolerance', 'length', 'columnar')
+
+# Formats which name placements separately from their definitions, so keep names when definitions are interned
+NamedPlacementFormats = ('madx',)
+
+# Formats which place elements at s-positions, and formats which only list them in order, so which need
+# the gaps between the placements of the former filled with drifts
+PositionedFormats = ('madx', 'binary')
+LineFormats = ('elegant', '6dsim')
+
+def BinaryParser(**kwargs):
+    # NumPy is only imported when binary lattices are used
+    from LatticeBinary import BinaryParser
+    return BinaryParser(**kwargs)
+
+# Parser used to read and write each format
+ParserClasses = {"elegant": ElegantParser, "madx": MADXParser, "6dsim": SixDSimParser, "binary": BinaryParser}
+
 class LatticeConverter:
     def __init__(self, **kwargs):
-        print('''
+        if 'quiet' in kwargs:
+            ConfigureLogging(quiet=kwargs.get('quiet'))
+        Log.info('''
         -----------------------------------------------------
         Welcome to LatticeConverter.
         -----------------------------------------------------
         ''')
         self.Verbose = kwargs.get('verbose')
+        self.Columnar = kwargs.get('columnar', False)
+        self.ParseWorkers = kwargs.get('parse_workers')
+        self.InternTolerance = kwargs.get('intern_tolerance')
+        self.DriftTolerance = kwargs.get('drift_tolerance')
         self.Lattice = Lattice()
+        self.ParseErrors = {}
+        self.Cache = None
+        if kwargs.get('cache_dir') is not None:
+            from LatticeCache import LatticeCache
+            self.Cache = LatticeCache(kwargs.get('cache_dir'),
+                                      max_bytes=kwargs.get('cache_size', 1<<30),
+                                      version=__version__)
 
-    def Load6DSim(self, **kwargs):
-        parser = SixDSimParser(kwargs)
+    @Instrument("load")
+    def Load(self, parserClass, **kwargs):
+        kwargs.setdefault('columnar', self.Columnar)
+        kwargs.setdefault('parse_workers', self.ParseWorkers)
+        kwargs.setdefault('drift_tolerance', self.DriftTolerance)
+        if self.Cache is not None:
+            key = self.Cache.Key(kwargs.get('inputFile'), format=parserClass.__name__,
+                                 **{option: kwargs.get(option) for option in CacheOptions})
+            lattice = self.Cache.Load(key)
+            if lattice is not None:
+                Log.info("Loaded lattice {} from cache".format(kwargs.get('inputFile')))
+                self.Lattice = lattice
+                self.ParseErrors = {}
+                return
+        parser = parserClass(**kwargs)
         parser.ParseInput(**kwargs,
                           verbose=self.Verbose)
         self.Lattice = parser.Lattice
+        self.ParseErrors = {description: list(report) for description, report in parser.ParseErrors().items() if report}
+        if self.Cache is not None:
+            self.Cache.Store(key, self.Lattice)
+
+    def Load6DSim(self, **kwargs):
+        self.Load(SixDSimParser, **kwargs)
 
     def LoadElegant(self, **kwargs):
-        parser = ElegantParser(**kwargs)
-        parser.ParseInput(**kwargs,
-                          verbose=self.Verbose)
-        self.Lattice = parser.Lattice
+        self.Load(ElegantParser, **kwargs)
 
     def LoadMADX(self, **kwargs):
-        parser = MADXParser()
-        parser.ParseInput(**kwargs,
-                          verbose=self.Verbose)
-        self.Lattice = parser.Lattice
+        self.Load(MADXParser, **kwargs)
+
+    def LoadBinary(self, **kwargs):
+        self.Load(BinaryParser, **kwargs)
 
     def Write6DSim(self, **kwargs):
         parser = SixDSimParser()
@@ -52,3 +106,103 @@ class LatticeConverter:
         parser.LoadLattice(self.Lattice)
         parser.WriteLattice(**kwargs)
 
+    def WriteBinary(self, **kwargs):
+        parser = BinaryParser()
+        parser.LoadLattice(self.Lattice)
+        parser.WriteLattice(**kwargs)
+
+    @Instrument("write all formats")
+    def WriteFormats(self, outputs, threads=None, **kwargs):
+        """Write the lattice in several formats from one load, given (format, outputFile) pairs.
+        The traversal of the lattice is shared between the writers, which run concurrently on threads,
+        except while memory is being profiled: the tracemalloc peak is process-wide, so the peak of a
+        writer would include the others.  A layout (e.g. a StreamLayout) may be given instead of the one
+        gathered from the lattice."""
+
+        layout = kwargs.pop('layout', None) or LatticeLayout(self.Lattice)
+        def write(output):
+            output_format, outputFile = output
+            parser = ParserClasses[output_format]()
+            parser.LoadLattice(self.Lattice)
+            parser.WriteLattice(outputFile=outputFile, layout=layout, **kwargs)
+        if len(outputs) == 1 or (Profile.Enabled and Profile.MemoryTraced):
+            for output in outputs:
+                write(output)
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=threads or len(outputs)) as executor:
+            for future in [executor.submit(write, output) for output in outputs]:
+                future.result()
+
+    @Instrument("convert")
+    def Convert(self, input_format, inputFile, outputs, beamline):
+        """Load a lattice in one format and write it to each of the (format, outputFile) outputs."""
+
+        kwargs = {}
+        if input_format in PositionedFormats and any(output_format in LineFormats for output_format, outputFile in outputs):
+            # Drifts are inserted up to the length of the lattice (e.g. the L of a MAD-X SEQUENCE)
+            kwargs['add_drifts'] = "end"
+        self.LoadFormat(input_format, inputFile, beamline, **kwargs)
+        if self.InternTolerance is not None:
+            self.InternDefinitions([output_format for output_format, outputFile in outputs])
+        self.WriteFormats(outputs, beamline=beamline)
+
+    def InternDefinitions(self, output_formats):
+        """Merge the element definitions of the lattice which agree within the intern tolerance, keeping the
+        placement names if every output format can name placements of a shared definition."""
+
+        keep_names = all(output_format in NamedPlacementFormats for output_format in output_formats)
+        return self.Lattice.InternDefinitions(self.InternTolerance, keep_names=keep_names)
+
+    def LoadFormat(self, input_format, inputFile, beamline=None, **kwargs):
+        """Load a lattice file given the name of its format, passing any other options (e.g. add_drifts)
+        to its parser."""
+
+        if not inputFile or not os.path.isfile(inputFile):
+            raise RuntimeError("Unable to open input file {}.".format(inputFile))
+        if input_format == "elegant":
+            self.LoadElegant(inputFile=inputFile, beamline=beamline, **kwargs)
+        elif input_format == "madx":
+            self.LoadMADX(inputFile=inputFile, beamline=beamline, **kwargs)
+        elif input_format == "6dsim":
+            self.Load6DSim(inputFile=inputFile, **kwargs)
+        elif input_format == "binary":
+            self.LoadBinary(inputFile=inputFile, **kwargs)
+        else:
+            raise RuntimeError("Unknown lattice format {}.".format(input_format))
+        return self.Lattice
+
+    def Placements(self, input_format, inputFile, beamline=None):
+        """Generate the placements of a lattice file as (element, s) pairs as it is parsed, without
+        building the lattice (see PlacementRecords for (name, type, s, length, parameters) records)."""
+
+        if not inputFile or not os.path.isfile(inputFile):
+            raise RuntimeError("Unable to open input file {}.".format(inputFile))
+        return ParserClasses[input_format]().Placements(inputFile=inputFile, beamline=beamline,
+                                                        parse_workers=self.ParseWorkers)
+
+    @Instrument("convert")
+    def ConvertStream(self, input_format, inputFile, outputs, beamline):
+        """Convert without building the lattice: the placements are streamed from the reader into
+        a StreamLayout, from which each output is written.  Memory is bounded by the number of
+        element definitions rather than of placements."""
+
+        if 'binary' in [output_format for output_format, outputFile in outputs]:
+            raise RuntimeError("Binary lattices are written from the whole lattice, so cannot be streamed.")
+        if self.InternTolerance is not None:
+            raise RuntimeError("Definitions are interned over the whole lattice, so cannot be streamed.")
+        if input_format in PositionedFormats and any(output_format in LineFormats for output_format, outputFile in outputs):
+            raise RuntimeError("The gaps between the placements of a {} lattice are filled with drifts over the "
+                               "whole lattice, so cannot be streamed to a line format.".format(input_format))
+        if not inputFile or not os.path.isfile(inputFile):
+            raise RuntimeError("Unable to open input file {}.".format(inputFile))
+        parser = ParserClasses[input_format]()
+        layout = StreamLayout(parser.Placements(inputFile=inputFile, beamline=beamline, parse_workers=self.ParseWorkers))
+        try:
+            layout.Name = parser.Lattice.Name
+            if parser.Lattice.Length:
+                layout.Length = parser.Lattice.Length
+            self.ParseErrors = {description: list(report) for description, report in parser.ParseErrors().items() if report}
+            self.WriteFormats(outputs, layout=layout, beamline=beamline)
+        finally:
+            layout.Close()
@@ -4,38 +4,88 @@
 # M Wallbank, Fermilab <wallbank@fnal.gov>
 # July 2023
 
-import numpy as np
+import copy
+import math
+from LatticeLog import Log
+from LatticeProfile import Instrument
 
 class Element:
+    __slots__ = ('Name', 'Center')
+
     def __init__(self, name, **kwargs):
         self.Name = name
         self.Center = kwargs.get('center') if 'center' in kwargs else None
 
+    @property
+    def Definition(self):
+        """The element holding this element's parameters (the element itself, unless it is a Placement)."""
+        return self
+
+    def WriteElegant(self, outFile, **kwargs):
+        outFile.write(self.FormatElegant(**kwargs))
+
+    def WriteMADX(self, outFile):
+        outFile.write(self.FormatMADX())
+
+class Placement(Element):
+    """A named occurrence of a shared element definition, e.g. one entry of a MAD-X sequence.
+    Parameters and methods are taken from the definition, which is never copied; setting a
+    parameter on a placement therefore sets it on every placement of the same definition."""
+
+    __slots__ = ('Definition',)
+
+    def __init__(self, name, definition, **kwargs):
+        # Set directly, as there is one placement per occurrence and __setattr__ is slow
+        object.__setattr__(self, 'Name', name)
+        object.__setattr__(self, 'Center', kwargs.get('center'))
+        object.__setattr__(self, 'Definition', definition.Definition)
+
+    def __getattr__(self, attribute):
+        if attribute.startswith('__') or attribute in Placement.__slots__:
+            raise AttributeError(attribute)
+        value = getattr(self.Definition, attribute)
+        if hasattr(value, '__func__'):
+            # Bind methods to the placement so that they see its name
+            return value.__func__.__get__(self)
+        return value
+
+    def __setattr__(self, attribute, value):
+        if attribute in Element.__slots__ or attribute in Placement.__slots__:
+            object.__setattr__(self, attribute, value)
+        else:
+            setattr(self.Definition, attribute, value)
+
 class Drift(Element):
+    __slots__ = ('Length',)
+
     def __init__(self, name, **kwargs):
         super().__init__(name, **kwargs)
         self.Length = kwargs.get('length')
 
-    def WriteElegant(self, outFile):
-        outFile.write("{}: DRIF, L={}\n".format(self.Name, self.Length))
+    def FormatElegant(self):
+        return "{}: DRIF, L={}\n".format(self.Name, self.Length)
 
-    def WriteMADX(self, outFile):
-        outFile.write("{}: DRIFT, L={};\n".format(self.Name, self.Length))
+    def FormatMADX(self):
+        return "{}: DRIFT, L={};\n".format(self.Name, self.Length)
 
 class RF(Element):
+    __slots__ = ('Length', 'Energy', 'Frequency')
+
     def __init__(self, name, **kwargs):
         super().__init__(name, **kwargs)
         self.Length = kwargs.get('length')
         self.Energy = kwargs.get('energy') if 'energy' in kwargs else None
         self.Frequency = kwargs.get('frequency') if 'frequency' in kwargs else None
 
-    def WriteElegant(self, outFile):
-        outFile.write("{}: RFCA, L={}, CHANGE_T=1\n".format(self.Name, self.Length))
+    def FormatElegant(self):
+        return "{}: RFCA, L={}, CHANGE_T=1\n".format(self.Name, self.Length)
 
-    def WriteMADX(self, outFile):
-        outFile.write("{}: RFCAVITY, L={}, VOLT=3e-5, LAG=0, HARMON=4;\n".format(self.Name, self.Length))
+    def FormatMADX(self):
+        return "{}: RFCAVITY, L={}, VOLT=3e-5, LAG=0, HARMON=4;\n".format(self.Name, self.Length)
 
 class DipoleEdge(Element):
+    __slots__ = ('Angle', 'E1', 'K0', 'Gap', 'FringeK')
+
     def __init__(self, name, **kwargs):
         super().__init__(name, **kwargs)
         self.Angle = kwargs.get('angle', None)
@@ -45,6 +95,8 @@ class DipoleEdge(Element):
         self.FringeK = kwargs.get('fringek', None)
 
 class Dipole(Element):
+    __slots__ = ('UpEdge', 'DownEdge', 'Sector', 'Length', 'Angle', 'K0', 'K1', 'Gap', 'FringeK', 'E1', 'E2')
+
     def __init__(self, name, **kwargs):
         super().__init__(name, **kwargs)
         self.UpEdge = None
@@ -75,92 +127,267 @@ class Dipole(Element):
         if self.FringeK == None: self.FringeK = edge.FringeK
         if edge.E1 is not None: self.E2 = edge.E1
 
-    def WriteElegant(self, outFile, n_slices=10, synch_rad=True):
+    def FormatElegant(self, n_slices=10, synch_rad=True):
         if self.Gap is None: self.Gap = 0.
         if self.FringeK is None: self.FringeK = 0.
         if self.Sector:
-            outFile.write("{}: CSBEND, L={}, ANGLE={}, K1={}, HGAP={}, FINT={}, INTEGRATION_ORDER=4, N_SLICES={}, SYNCH_RAD={}, ISR={}\n"
-                          .format(self.Name, self.Length, self.Angle, self.K1, self.Gap, self.FringeK, n_slices, int(synch_rad), int(synch_rad)))
+            return ("{}: CSBEND, L={}, ANGLE={}, K1={}, HGAP={}, FINT={}, INTEGRATION_ORDER=4, N_SLICES={}, SYNCH_RAD={}, ISR={}\n"
+                    .format(self.Name, self.Length, self.Angle, self.K1, self.Gap, self.FringeK, n_slices, int(synch_rad), int(synch_rad)))
         else:
-            length = self.Length * np.sin(self.Angle) / self.Angle
+            length = self.Length * math.sin(self.Angle) / self.Angle
             edge_angle = self.Angle
-            outFile.write("{}: CSBEND, L={}, ANGLE={}, K1={}, HGAP={}, FINT={}, E1={}, E2={}, INTEGRATION_ORDER=4, N_SLICES={}, SYNCH_RAD={}, ISR={}\n"
-                          .format(self.Name, length, self.Angle, self.K1, self.Gap, self.FringeK, edge_angle, edge_angle,
-                                  n_slices, int(synch_rad), int(synch_rad)))
-
-    def WriteMADX(self, outFile):
-        outFile.write("IN{}: DIPEDGE, H={}, HGAP={}, FINT={}, E1={};\n"
-                      .format(self.Name, self.Angle/self.Length, self.Gap, self.FringeK, self.E1))
-        outFile.write("{}: SBEND, L={}, ANGLE={}, K1={};\n"
-                      .format(self.Name, self.Length, self.Angle, self.K1))
-        outFile.write("OUT{}: DIPEDGE, H={}, HGAP={}, FINT={}, E1={};\n"
-                      .format(self.Name, self.Angle/self.Length, self.Gap, self.FringeK, self.E2))
+            return ("{}: CSBEND, L={}, ANGLE={}, K1={}, HGAP={}, FINT={}, E1={}, E2={}, INTEGRATION_ORDER=4, N_SLICES={}, SYNCH_RAD={}, ISR={}\n"
+                    .format(self.Name, length, self.Angle, self.K1, self.Gap, self.FringeK, edge_angle, edge_angle,
+                            n_slices, int(synch_rad), int(synch_rad)))
+
+    def FormatMADX(self):
+        return ("IN{}: DIPEDGE, H={}, HGAP={}, FINT={}, E1={};\n"
+                .format(self.Name, self.Angle/self.Length, self.Gap, self.FringeK, self.E1) +
+                "{}: SBEND, L={}, ANGLE={}, K1={};\n"
+                .format(self.Name, self.Length, self.Angle, self.K1) +
+                "OUT{}: DIPEDGE, H={}, HGAP={}, FINT={}, E1={};\n"
+                .format(self.Name, self.Angle/self.Length, self.Gap, self.FringeK, self.E2))
 
 class Quad(Element):
+    __slots__ = ('Length', 'K1')
+
     def __init__(self, name, **kwargs):
         super().__init__(name, **kwargs)
         self.Length = kwargs.get('length')
         self.K1 = kwargs.get('k1', 0.)
 
-    def WriteElegant(self, outFile, **kwargs):
+    def FormatElegant(self, **kwargs):
         quadType = "KQUAD" if kwargs.get("kick", True) else "QUAD"
-        outFile.write("{}: {}, L={}, N_SLICES={}, SYNCH_RAD={}, K1={}\n"
-                      .format(self.Name, quadType, self.Length, kwargs.get("n_slices"), int(kwargs.get("synch_rad")),
-                              self.K1 if not kwargs.get("k1_zero") else 0.))
+        return ("{}: {}, L={}, N_SLICES={}, SYNCH_RAD={}, K1={}\n"
+                .format(self.Name, quadType, self.Length, kwargs.get("n_slices"), int(kwargs.get("synch_rad")),
+                        self.K1 if not kwargs.get("k1_zero") else 0.))
 
-    def WriteMADX(self, outFile):
-        outFile.write("{}: QUADRUPOLE, L={}, K1={};\n".format(self.Name, self.Length, self.K1))
+    def FormatMADX(self):
+        return "{}: QUADRUPOLE, L={}, K1={};\n".format(self.Name, self.Length, self.K1)
 
 class SQuad(Element):
+    __slots__ = ('Length', 'K1', 'Tilt')
+
     def __init__(self, name, **kwargs):
         super().__init__(name, **kwargs)
         self.Length = kwargs.get('length')
         self.K1 = kwargs.get('k1', 0.)
         self.Tilt = kwargs.get('tilt', 0.)
 
-    def WriteElegant(self, outFile, kick=True, n_slices=10, synch_rad=True):
+    def FormatElegant(self, kick=True, n_slices=10, synch_rad=True):
         quadType = "KQUAD" if kick else "QUAD"
-        outFile.write("{}: {}, L={}, N_SLICES={}, SYNCH_RAD={}, K1={}, TILT={}\n"
-                      .format(self.Name, quadType, self.Length, n_slices, int(synch_rad), self.K1, self.Tilt))
+        return ("{}: {}, L={}, N_SLICES={}, SYNCH_RAD={}, K1={}, TILT={}\n"
+                .format(self.Name, quadType, self.Length, n_slices, int(synch_rad), self.K1, self.Tilt))
 
-    def WriteMADX(self, outFile):
-        outFile.write("{}: QUADRUPOLE, L={}, K1S={};\n".format(self.Name, self.Length, self.K1))
+    def FormatMADX(self):
+        return "{}: QUADRUPOLE, L={}, K1={}, TILT={};\n".format(self.Name, self.Length, self.K1, self.Tilt)
 
 class Sext(Element):
+    __slots__ = ('Length', 'K2')
+
     def __init__(self, name, **kwargs):
         super().__init__(name, **kwargs)
         self.Length = kwargs.get('length')
         self.K2 = kwargs.get('k2', 0.)
 
-    def WriteElegant(self, outFile, kick=True, n_slices=10, synch_rad=True):
+    def FormatElegant(self, kick=True, n_slices=10, synch_rad=True):
         sextType = "KSEXT" if kick else "SEXT"
-        outFile.write("{}: {}, L={}, N_SLICES={}, SYNCH_RAD={}, K2={}\n"
-                      .format(self.Name, sextType, self.Length, n_slices, int(synch_rad), self.K2))
+        return ("{}: {}, L={}, N_SLICES={}, SYNCH_RAD={}, K2={}\n"
+                .format(self.Name, sextType, self.Length, n_slices, int(synch_rad), self.K2))
 
-    def WriteMADX(self, outFile):
-        outFile.write("{}: SEXTUPOLE, L={}, K2={};\n".format(self.Name, self.Length, self.K2))
+    def FormatMADX(self):
+        return "{}: SEXTUPOLE, L={}, K2={};\n".format(self.Name, self.Length, self.K2)
 
 class Octu(Element):
+    __slots__ = ('Length', 'K3')
+
     def __init__(self, name, **kwargs):
         super().__init__(name, **kwargs)
         self.Length = kwargs.get('length')
         self.K3 = kwargs.get('k3', 0.)
 
-    def WriteElegant(self, outFile, kick=True, n_slices=10, synch_rad=True):
+    def FormatElegant(self, kick=True, n_slices=10, synch_rad=True):
         octuType = "KOCT" if kick else "OCTU"
-        outFile.write("{}: {}, L={}, N_SLICES={}, SYNCH_RAD={}, K3={}\n"
-                      .format(self.Name, octuType, self.Length, n_slices, int(synch_rad), self.K3))
+        return ("{}: {}, L={}, N_SLICES={}, SYNCH_RAD={}, K3={}\n"
+                .format(self.Name, octuType, self.Length, n_slices, int(synch_rad), self.K3))
 
-    def WriteMADX(self, outFile):
-        outFile.write("{}: OCTUPOLE, L={}, K3={};\n".format(self.Name, self.Length, self.K3))
+    def FormatMADX(self):
+        return "{}: OCTUPOLE, L={}, K3={};\n".format(self.Name, self.Length, self.K3)
 
 class Solenoid(Element):
+    __slots__ = ('Length', 'KS')
+
     def __init__(self, name, **kwargs):
         super().__init__(name, **kwargs)
         self.Length = kwargs.get('length')
+        self.KS = kwargs.get('ks', 0.)
+
+    def FormatMADX(self):
+        return "{}: SOLENOID, L={}, KS={};\n".format(self.Name, self.Length, self.KS)
+
+def DriftGaps(starts, lengths):
+    """Find the gaps between consecutive placements, given their start locations and lengths.
+    Returns the placement indices the gaps precede, the gap lengths and the gap start locations."""
+    import numpy as np
+
+    ends = np.concatenate(([0.], (starts + lengths)[:-1]))
+    gaps = starts - ends
+    positions = np.flatnonzero(gaps > 0.)
+    return positions, gaps[positions], ends[positions]
+
+# Default tolerance (m) within which the lengths of inserted drifts share a definition
+DriftTolerance = 1e-9
+
+def GroupLengths(lengths, tolerance):
+    """Group lengths which lie within the tolerance of the smallest length of their group, so that
+    groups do not chain through neighbours and every length is within the tolerance of its group's.
+    Returns one length per group (its first occurrence), numbering groups in order of first
+    occurrence, and the group of every input length."""
+    import numpy as np
+
+    if not len(lengths):
+        return np.empty(0), np.empty(0, dtype=int)
+    order = np.argsort(lengths, kind='stable')
+    values = lengths[order]
+    is_start = np.concatenate(([True], np.diff(values) > tolerance))
+
+    # Runs of neighbours within the tolerance may still span more than it; split those from their first value
+    starts = np.flatnonzero(is_start)
+    ends = np.append(starts[1:], len(values))
+    for run in np.flatnonzero(values[ends-1] - values[starts] > tolerance).tolist():
+        start, end = int(starts[run]), int(ends[run])
+        while True:
+            start = int(np.searchsorted(values, values[start] + tolerance, side='right'))
+            if start >= end:
+                break
+            is_start[start] = True
+    sorted_groups = np.cumsum(is_start) - 1
+    groups = np.empty(len(lengths), dtype=int)
+    groups[order] = sorted_groups
+    first = np.full(sorted_groups[-1]+1, len(lengths))
+    np.minimum.at(first, groups, np.arange(len(lengths)))
+    renumber = np.empty(len(first), dtype=int)
+    renumber[np.argsort(first)] = np.arange(len(first))
+    return lengths[np.sort(first)], renumber[groups]
+
+def ElementType(element):
+    """Class name of an element's definition, e.g. "Quad" (also for subclasses such as columnar views)."""
+
+    definition_class = element.Definition.__class__
+    if definition_class.__name__ in ElementCollections:
+        return definition_class.__name__
+    for base in definition_class.__mro__:
+        if base.__name__ in ElementCollections:
+            return base.__name__
+    return definition_class.__name__
+
+def DefinitionParameters(element):
+    """The parameters of an element's definition, as a dictionary (attribute -> value)."""
+
+    definition = element.Definition
+    return {attribute: getattr(definition, attribute)
+            for cls in type(definition).__mro__ if cls is not Element
+            for attribute in getattr(cls, '__slots__', ()) if attribute not in ('UpEdge', 'DownEdge')}
+
+def DefinitionKey(element, tolerance=0.):
+    """Hashable key of the type and parameters of an element's definition, with float parameters
+    rounded to a multiple of the tolerance (if it is not zero).  Dipole edges are not included."""
+
+    key = [ElementType(element)]
+    for value in DefinitionParameters(element).values():
+        if tolerance and isinstance(value, float):
+            value = round(value / tolerance)
+        key.append(value)
+    return tuple(key)
+
+def SharedDefinitions(groups):
+    """Regroup per-type lists of elements (as in LatticeLayout.Groups) by definition, for formats which
+    can name placements separately from their definitions (MAD-X).  Returns the per-type lists with one
+    entry per distinct definition, and the definition name of every element name.  An element whose
+    definition name is taken by another definition (or another element) is kept under its own name.
+    Definitions are told apart by equality, which for columnar views compares the rows they view."""
+
+    owners = {}
+    for group in groups.values():
+        for element in group:
+            owners.setdefault(element.Name, element.Definition)
+    shared = {collection: [] for collection in groups}
+    names = {}
+    written = set()
+    for collection, group in groups.items():
+        for element in group:
+            definition = element.Definition
+            if owners.setdefault(definition.Name, definition) != definition:
+                names[element.Name] = element.Name
+                shared[collection].append(element)
+                continue
+            names[element.Name] = definition.Name
+            if definition not in written:
+                written.add(definition)
+                shared[collection].append(definition)
+    return shared, names
+
+class EdgedDipoles:
+    """Dipole definitions with their edges attached.  Edges belong to a placement of a dipole, so they
+    are never set on a definition the dipole may share with others: every distinct combination of
+    (definition, up edge, down edge) gets a copy of the definition of its own.  The first combination
+    of a definition keeps its name, and later ones are named after the dipole they are first found on."""
 
-    def WriteMADX(self, outFile):
-        outFile.write("{}: DRIFT, L={};\n".format(self.Name, self.Length))
+    def __init__(self):
+        self._Combinations = {}
+        # Definition id -> (definition, its first combination, the dipole it was found on); the
+        # definitions are kept so that their ids are not reused
+        self._Copied = {}
+
+    def Attach(self, dipole, upEdge, downEdge):
+        """Attach edges to a dipole, returning the dipole with them: the dipole itself with its
+        definition replaced if it is a Placement, else the copy of its definition."""
+
+        definition = dipole.Definition
+        if definition.UpEdge is upEdge and definition.DownEdge is downEdge:
+            return dipole
+        key = (id(definition), id(upEdge.Definition), id(downEdge.Definition))
+        combination = self._Combinations.get(key)
+        if combination is None:
+            combination = copy.copy(definition)
+            if id(definition) in self._Copied:
+                combination.Name = dipole.Name
+            else:
+                self._Copied[id(definition)] = (definition, combination, dipole.Name)
+            combination.AddUpEdge(upEdge)
+            combination.AddDownEdge(downEdge)
+            self._Combinations[key] = combination
+        if dipole is definition:
+            return combination
+        dipole.Definition = combination
+        return dipole
+
+    def Distinguish(self, elements):
+        """Rename the first combination of every definition still used by one of the elements (placed
+        without edges) after its dipole, so that no two definitions have the same name."""
+
+        used = {id(element.Definition) for element in elements}
+        for definition_id, (definition, combination, name) in self._Copied.items():
+            if definition_id in used:
+                combination.Name = name
+
+def PlacementRecords(placements):
+    """Turn a stream of (element, s) placements into (name, type, s, length, parameters) records."""
+
+    for element, location in placements:
+        yield (element.Name, ElementType(element), location,
+               getattr(element, 'Length', 0.), DefinitionParameters(element))
+
+# Per-type definition dictionaries held by a lattice, keyed by element class name
+ElementCollections = {"Drift": "Drifts",
+                      "RF": "RF",
+                      "Dipole": "Dipoles",
+                      "DipoleEdge": "DipoleEdges",
+                      "Quad": "Quads",
+                      "SQuad": "SkewQuads",
+                      "Sext": "Sexts",
+                      "Octu": "Octus",
+                      "Solenoid": "Solenoids"}
 
 class Lattice:
     def __init__(self):
@@ -168,6 +395,10 @@ class Lattice:
         self.Sequence = []
         self.Locations = {}
         self.Length = 0.
+        self._SequenceLength = 0.
+        self._LastOccurrence = {}
+        self.DipoleEdgePlacements = {}
+        self._Index = None
         self.Elements = {}
         self.Drifts = {}
         self.RF = {}
@@ -180,110 +411,414 @@ class Lattice:
         self.Solenoids = {}
 
     def AddElement(self, element, **kwargs):
+        self._Index = None
 
         # Log the location of the element in the beamline
         if element.Center is not None:
-            if hasattr(element, 'Length'):
-                self.Locations[element.Name] = [element.Center - element.Length/2.]
+            location = element.Center - element.Length/2. if hasattr(element, 'Length') else element.Center
+            if element.Name in self._LastOccurrence:
+                self.Locations[element.Name].append(location)
             else:
-                self.Locations[element.Name] = [element.Center]
+                self.Locations[element.Name] = [location]
         else:
-            if element.Name in self.Sequence:
-                self.Locations[element.Name].append(self.Locations[element.Name][-1])
-                last_occurance = max(i for i,e in enumerate(self.Sequence) if e == element.Name)
-                for index in range(len(self.Sequence)-last_occurance):
-                    inter_lattice_element = self.Elements[self.Sequence[last_occurance+index]]
-                    if hasattr(inter_lattice_element, 'Length'):
-                        self.Locations[element.Name][-1] += inter_lattice_element.Length
+            if element.Name in self._LastOccurrence:
+                # Advance the previous location by everything added since the last occurrence
+                last_location = self.Locations[element.Name][-1]
+                last_sequence_length = self._LastOccurrence[element.Name][1]
+                if last_location == last_sequence_length:
+                    self.Locations[element.Name].append(self._SequenceLength)
+                else:
+                    self.Locations[element.Name].append(last_location + self._SequenceLength - last_sequence_length)
             else:
-                self.MeasureLength()
+                self.Length = self._SequenceLength
                 self.Locations[element.Name] = [self.Length]
 
         # Add element to the sequence
         self.Elements[element.Name] = element
+        self._LastOccurrence[element.Name] = (len(self.Sequence), self._SequenceLength)
         self.Sequence.append(element.Name)
+        if hasattr(element, 'Length'):
+            self._SequenceLength += element.Length
 
         # Add element to the definitions
-        if element.__class__.__name__ == "Drift": self.Drifts[element.Name] = element
-        if element.__class__.__name__ == "RF": self.RF[element.Name] = element
-        if element.__class__.__name__ == "Dipole": self.Dipoles[element.Name] = element
-        if element.__class__.__name__ == "DipoleEdge": self.DipoleEdges[element.Name] = element
-        if element.__class__.__name__ == "Quad": self.Quads[element.Name] = element
-        if element.__class__.__name__ == "SQuad": self.SkewQuads[element.Name] = element
-        if element.__class__.__name__ == "Sext": self.Sexts[element.Name] = element
-        if element.__class__.__name__ == "Octu": self.Octus[element.Name] = element
-        if element.__class__.__name__ == "Solenoid": self.Solenoids[element.Name] = element
+        collection = ElementCollections.get(element.Definition.__class__.__name__)
+        if collection is not None:
+            getattr(self, collection)[element.Name] = element
 
+    @Instrument("dipole edges")
     def AssociateDipoleEdges(self):
-        """Associate dipole edges with the dipole elements through their locations in a lattice sequence."""
+        """Associate dipole edges with the dipole elements through their locations in a lattice sequence.
+        Every dipole placement is paired with its neighbouring edge placements in one sweep over the sequence;
+        the pairs are kept in DipoleEdgePlacements (dipole index -> (up edge index, down edge index)) and the
+        sequence indices of dipole placements without edges are returned."""
 
         non_edge_dipoles = []
+        self.DipoleEdgePlacements = {}
         if not self.DipoleEdges:
-            return
-        for dipole in self.Dipoles:
-            try:
-                index = self.Sequence.index(dipole)
-            except ValueError:
-                continue
-            if index-1 < 0 or index+1 >= len(self.Sequence):
-                non_edge_dipoles.append(dipole)
-                continue
-            upEdge = self.Sequence[index-1]
-            downEdge = self.Sequence[index+1]
-            if upEdge not in self.DipoleEdges or downEdge not in self.DipoleEdges:
-                non_edge_dipoles.append(dipole)
+            return non_edge_dipoles
+        sequence = self.Sequence
+        last = len(sequence) - 1
+        for index, element in enumerate(sequence):
+            if element not in self.Dipoles:
                 continue
-            self.Dipoles[dipole].AddUpEdge(self.DipoleEdges[upEdge])
-            self.Dipoles[dipole].AddDownEdge(self.DipoleEdges[downEdge])
-            print("Adding edges {} and {} to dipole {}".format(upEdge, downEdge, dipole))
+            if 0 < index < last and sequence[index-1] in self.DipoleEdges and sequence[index+1] in self.DipoleEdges:
+                self.DipoleEdgePlacements[index] = (index-1, index+1)
+            else:
+                non_edge_dipoles.append(index)
+        self.AttachDipoleEdges(self.DipoleEdgePlacements)
         return non_edge_dipoles
 
-    def InsertDrifts(self, mode):
-        """Insert drifts into a lattice defined as a line."""
+    def AttachDipoleEdges(self, placements):
+        """Add the edges to each dipole, from the first of its placements that has edges.  Dipoles sharing a
+        definition but not their edges get definitions of their own (see EdgedDipoles)."""
+
+        edged = EdgedDipoles()
+        attached = set()
+        for index, (up_index, down_index) in placements.items():
+            dipole = self.Sequence[index]
+            if dipole in attached:
+                continue
+            attached.add(dipole)
+            upEdge = self.Sequence[up_index]
+            downEdge = self.Sequence[down_index]
+            element = edged.Attach(self.Dipoles[dipole], self.DipoleEdges[upEdge], self.DipoleEdges[downEdge])
+            self.Elements[dipole] = self.Dipoles[dipole] = element
+            Log.info("Adding edges {} and {} to dipole {}".format(upEdge, downEdge, dipole))
+        edged.Distinguish(self.Elements.values())
+
+    def DescribePlacements(self, indices):
+        """Name and sequence position of placements, for reports."""
+        return ["{} (position {})".format(self.Sequence[index], index) for index in indices]
+
+    @Instrument("drift insertion")
+    def InsertDrifts(self, mode, tolerance=DriftTolerance):
+        """Insert drifts into a lattice defined as a line.
+        The gaps between placements are found in one vectorized pass over their sorted locations, and
+        drifts whose lengths agree within the tolerance share a single definition."""
+        import numpy as np
 
         lattice_length = self.Length
-        lattice_coordinate = 0.
-        drift_index = 0
-        drifts = {}
-        for lte_index,lte_element in enumerate(self.Sequence):
-            lte_location = self.Locations[lte_element][0]
-            drift_length = lte_location - lattice_coordinate
-            if drift_length > 0.:
-                drift = Drift("drift"+str(drift_index), length=drift_length)
-                self.Elements[drift.Name] = drift
-                self.Drifts[drift.Name] = drift
-                drifts[drift.Name] = lte_index+drift_index
-                drift_index += 1
-            lattice_coordinate += drift_length
-            if hasattr(self.Elements[lte_element], 'Length'):
-                lattice_coordinate += self.Elements[lte_element].Length
-        for drift in drifts:
-            self.Sequence.insert(drifts[drift], drift)
+        starts, lengths = self.PlacementExtents()
+        order = np.argsort(starts, kind='stable')
+        sequence = [self.Sequence[index] for index in order.tolist()]
+        positions, gaps, gap_starts = DriftGaps(starts[order], lengths[order])
+        drift_lengths, drift_groups = GroupLengths(gaps, tolerance)
+
+        drifts = []
+        for drift_index, drift_length in enumerate(drift_lengths.tolist()):
+            drift = Drift("drift"+str(drift_index), length=drift_length)
+            self.Elements[drift.Name] = drift
+            self.Drifts[drift.Name] = drift
+            self.Locations[drift.Name] = []
+            drifts.append(drift.Name)
+
+        # Merge the drifts into the sequence in a single pass
+        merged = []
+        previous = 0
+        for position, group, gap_start in zip(positions.tolist(), drift_groups.tolist(), gap_starts.tolist()):
+            merged.extend(sequence[previous:position])
+            merged.append(drifts[group])
+            self.Locations[drifts[group]].append(gap_start)
+            previous = position
+        merged.extend(sequence[previous:])
+        self.Sequence = merged
         self.MeasureLength()
 
         ends_drift_length = lattice_length - self.Length
         if mode == "both":
+            for name in self.Locations:
+                self.Locations[name] = [location + ends_drift_length/2. for location in self.Locations[name]]
             start_drift = Drift("drift_start", length=ends_drift_length/2.)
             self.Elements[start_drift.Name] = start_drift
             self.Drifts[start_drift.Name] = start_drift
+            self.Locations[start_drift.Name] = [0.]
             self.Sequence.insert(0, start_drift.Name)
             end_drift = Drift("drift_end", length=ends_drift_length/2.)
             self.Elements[end_drift.Name] = end_drift
             self.Drifts[end_drift.Name] = end_drift
+            self.Locations[end_drift.Name] = [self.Length + ends_drift_length/2.]
             self.Sequence.append(end_drift.Name)
         elif mode == "end":
             end_drift = Drift("drift_end", length=ends_drift_length)
             self.Elements[end_drift.Name] = end_drift
             self.Drifts[end_drift.Name] = end_drift
+            self.Locations[end_drift.Name] = [self.Length]
             self.Sequence.append(end_drift.Name)
         self.MeasureLength()
-        print("Length of lattice after adding drifts {} (defintion {})".format(self.Length, lattice_length))
-        
+        Log.info("Length of lattice after adding drifts {} (defintion {})".format(self.Length, lattice_length))
+
+    @Instrument("definition interning")
+    def InternDefinitions(self, tolerance=0., keep_names=False):
+        """Merge element definitions of the same type whose parameters agree (see DefinitionKey) into the
+        first of them, e.g. the drifts of InsertDrifts or the per-magnet definitions of a 6DSim file.
+        With keep_names, every name is kept as a Placement of the shared definition, for formats which name
+        placements separately from their definitions (MAD-X); otherwise the placements of every name sharing
+        a definition are renamed after the first of them, and the other names are removed, so that every
+        writer emits one definition.  Returns the number of definitions merged into others."""
+
+        # Dipole edges first, so that dipoles can be compared by the shared definitions of their edges
+        names = sorted(self.Elements, key=lambda name: ElementType(self.Elements[name]) != "DipoleEdge")
+        shared = {}
+        canonical = {}
+        for name in names:
+            definition = self.Elements[name].Definition
+            if id(definition) in canonical:
+                continue
+            key = DefinitionKey(definition, tolerance)
+            if isinstance(definition, Dipole):
+                key += tuple(id(canonical[id(edge)]) if id(edge) in canonical else id(edge)
+                             for edge in (definition.UpEdge, definition.DownEdge) if edge is not None)
+            canonical[id(definition)] = shared.setdefault(key, definition)
+        n_merged = len(canonical) - len(shared)
+
+        for dipole in shared.values():
+            if isinstance(dipole, Dipole):
+                if dipole.UpEdge is not None:
+                    dipole.UpEdge = canonical.get(id(dipole.UpEdge), dipole.UpEdge)
+                if dipole.DownEdge is not None:
+                    dipole.DownEdge = canonical.get(id(dipole.DownEdge), dipole.DownEdge)
+
+        if keep_names:
+            for name, element in self.Elements.items():
+                definition = canonical[id(element.Definition)]
+                if definition is not element.Definition:
+                    placement = Placement(name, definition, center=element.Center)
+                    self.Elements[name] = placement
+                    getattr(self, ElementCollections[ElementType(placement)])[name] = placement
+            # Lengths may have changed within the tolerance
+            self._Index = None
+        else:
+            first_names = {}
+            renamed = {}
+            for name, element in self.Elements.items():
+                first_name = first_names.setdefault(id(canonical[id(element.Definition)]), name)
+                if first_name != name:
+                    renamed[name] = first_name
+            if renamed:
+                locations = self.PlacementLocations()
+                self.Sequence = [renamed.get(name, name) for name in self.Sequence]
+                merged_locations = {name: element_locations for name, element_locations in self.Locations.items()
+                                    if name not in renamed}
+                for name in set(self.Sequence):
+                    merged_locations[name] = []
+                for name, location in zip(self.Sequence, locations):
+                    merged_locations[name].append(location)
+                self.Locations = merged_locations
+                for name in renamed:
+                    element = self.Elements.pop(name)
+                    getattr(self, ElementCollections[ElementType(element)]).pop(name, None)
+                # The placements are unchanged, so only the running index needs resynchronizing
+                length = self.Length
+                self.MeasureLength()
+                self.Length = length
+
+        Log.info("Merged {} element definitions into {} shared definitions".format(n_merged, len(shared)))
+        return n_merged
+
+    def PlacementLocations(self):
+        """List the location of every placement in the sequence, in a single pass.
+        Placements without a logged location are placed at the end of the preceding element."""
+
+        locations = []
+        occurrences = {}
+        previous = None
+        for element in self.Sequence:
+            occurrence = occurrences.get(element, 0)
+            occurrences[element] = occurrence + 1
+            element_locations = self.Locations.get(element, ())
+            if occurrence < len(element_locations):
+                location = element_locations[occurrence]
+            elif previous is None:
+                location = 0.
+            else:
+                # Only measured when needed, as lengths may be looked up through placements
+                location = locations[-1] + getattr(self.Elements[previous], 'Length', 0.)
+            locations.append(location)
+            previous = element
+        return locations
+
+    def PlacementExtents(self):
+        """The start locations and lengths of the placements, as arrays."""
+        import numpy as np
+
+        element_lengths = {name: getattr(element, 'Length', 0.) for name, element in self.Elements.items()}
+        starts = np.array(self.PlacementLocations(), dtype=float)
+        lengths = np.array([element_lengths[element] for element in self.Sequence], dtype=float)
+        return starts, lengths
+
+    def PlacementCodes(self):
+        """An integer code for the name of every placement, as an array, and the name -> code mapping."""
+        import numpy as np
+
+        codes = {}
+        placement_codes = np.fromiter((codes.setdefault(name, len(codes)) for name in self.Sequence),
+                                      dtype=np.intp, count=len(self.Sequence))
+        return placement_codes, codes
+
+    def Index(self):
+        """The query index of the lattice, built when first needed and discarded when the lattice changes."""
+
+        if self._Index is None:
+            self._Index = LatticeIndex(self)
+        return self._Index
+
+    def PlacementAt(self, s):
+        """Sequence index of the placement containing s, or None (see LatticeIndex.At)."""
+        return self.Index().At(s)
+
+    def PlacementsBetween(self, s_min, s_max):
+        """Sequence indices of the placements overlapping [s_min, s_max), in order of s."""
+        return self.Index().Between(s_min, s_max)
+
+    def PlacementsOf(self, name):
+        """Sequence indices of the placements of a name."""
+        return self.Index().Occurrences(name)
+
     def MeasureLength(self):
-        """Measure the length of the lattice by summing up all of the elements in the sequence."""
+        """Measure the length of the lattice by summing up all of the elements in the sequence.
+        Also resynchronizes the running index used by AddElement, and discards the query index, in case the
+        sequence was edited directly."""
 
         self.Length = 0.
-        for element in self.Sequence:
+        self._LastOccurrence = {}
+        self._Index = None
+        for index,element in enumerate(self.Sequence):
+            self._LastOccurrence[element] = (index, self.Length)
             if hasattr(self.Elements[element], 'Length'):
                 self.Length += self.Elements[element].Length
+        self._SequenceLength = self.Length
+
+
+class LatticeIndex:
+    """Sorted s-positions and name lookups of the placements of a lattice, answering queries in O(log n).
+
+    Placements are sorted by start; the running maximum of their ends is non-decreasing, so the first
+    placement that can reach a given s is also found by binary search, even if placements overlap.
+    Placements are looked up by name through their name codes, sorted."""
+
+    def __init__(self, lattice):
+        import numpy as np
+
+        starts, lengths = lattice.PlacementExtents()
+        self.Order = np.argsort(starts, kind='stable')
+        self.Starts = starts[self.Order]
+        self.Ends = self.Starts + lengths[self.Order]
+        self.ReachedEnds = np.maximum.accumulate(self.Ends) if len(self.Ends) else self.Ends
+
+        codes, self.Codes = lattice.PlacementCodes()
+        self.CodeOrder = np.argsort(codes, kind='stable')
+        self.SortedCodes = codes[self.CodeOrder]
+
+    def At(self, s):
+        """Sequence index of the placement with start <= s < end (the last starting one, if several
+        overlap), or None if s falls in a gap between placements or outside the lattice."""
+
+        last = int(self.Starts.searchsorted(s, 'right'))
+        first = int(self.ReachedEnds.searchsorted(s, 'right'))
+        if first >= last:
+            return None
+        containing = (self.Ends[first:last] > s).nonzero()[0]
+        return int(self.Order[first + containing[-1]]) if len(containing) else None
+
+    def Between(self, s_min, s_max):
+        """Sequence indices, in order of s, of the placements overlapping [s_min, s_max), including
+        zero-length placements within it."""
+
+        last = int(self.Starts.searchsorted(s_max, 'left'))
+        first = min(int(self.ReachedEnds.searchsorted(s_min, 'right')), int(self.Starts.searchsorted(s_min, 'left')))
+        if first >= last:
+            return self.Order[:0]
+        overlapping = (self.Ends[first:last] > s_min) | (self.Starts[first:last] >= s_min)
+        return self.Order[first:last][overlapping]
+
+    def Occurrences(self, name):
+        """Sequence indices of the placements of a name, in sequence order."""
+
+        code = self.Codes.get(name)
+        if code is None:
+            return self.CodeOrder[:0]
+        first = self.SortedCodes.searchsorted(code, 'left')
+        last = self.SortedCodes.searchsorted(code, 'right')
+        return self.CodeOrder[first:last]
+
+
+class LatticeLayout:
+    """What the writers need from a lattice, gathered in one traversal so that several writers can share it:
+    the placement locations, occurrence counts, per-type groupings of the definitions, and the beamline
+    (placements other than dipole edges, with their locations)."""
+
+    def __init__(self, lattice):
+        self.Name = lattice.Name
+        self.Length = lattice.Length
+        self.Sequence = list(lattice.Sequence)
+        self.Locations = list(lattice.PlacementLocations())
+        self.Groups = {collection: list(getattr(lattice, collection).values())
+                       for collection in ElementCollections.values()}
+        self.Dipoles = {dipole.Name: dipole for dipole in self.Groups["Dipoles"]}
+        dipole_edges = {edge.Name for edge in self.Groups["DipoleEdges"]}
+        self.Occurrences = {}
+        self.Beamline = []
+        for element, location in zip(self.Sequence, self.Locations):
+            self.Occurrences[element] = self.Occurrences.get(element, 0) + 1
+            if element not in dipole_edges:
+                self.Beamline.append((element, location))
+
+
+class StreamLayout:
+    """A LatticeLayout gathered from a stream of (element, s) placements (see LatticeParser.Placements),
+    for writers to consume without the lattice being built.  The definitions are kept, but the
+    beamline is spooled to a temporary file and read back each time it is iterated.  Dipole edges
+    are attached to their dipoles as the stream passes them.  The length is taken as the end of
+    the last placement; readers which know the lattice name and length (e.g. from a MAD-X
+    SEQUENCE) only do so once the stream is consumed, so both may be set afterwards.  Close
+    removes the spool file."""
+
+    def __init__(self, placements):
+        import tempfile
 
+        self.Name = "Lattice"
+        self.Groups = {collection: {} for collection in ElementCollections.values()}
+        self.Occurrences = {}
+        edges = self.Groups["DipoleEdges"]
+        dipoles = self.Groups["Dipoles"]
+        attached = set()
+        edged = EdgedDipoles()
+        end = 0.
+        window = (None, None)
+        with tempfile.NamedTemporaryFile('w', suffix='.beamline', delete=False) as spool:
+            self._Spool = spool.name
+            for element, location in placements:
+                name = element.Name
+                self.Occurrences[name] = self.Occurrences.get(name, 0) + 1
+                collection = ElementCollections.get(ElementType(element))
+                if collection is not None:
+                    self.Groups[collection].setdefault(name, element)
+                end = max(end, location + getattr(element, 'Length', 0.))
+
+                # Attach the edges of the first edge-dipole-edge run of each dipole
+                if name in edges:
+                    if window[1] in dipoles and window[0] in edges and window[1] not in attached:
+                        attached.add(window[1])
+                        dipoles[window[1]] = edged.Attach(dipoles[window[1]], edges[window[0]], element)
+                        Log.info("Adding edges {} and {} to dipole {}".format(window[0], name, window[1]))
+                else:
+                    spool.write("{}\t{}\n".format(name, location))
+                window = (window[1], name)
+        edged.Distinguish(element for group in self.Groups.values() for element in group.values())
+        self.Length = end
+        self.Groups = {collection: list(group.values()) for collection, group in self.Groups.items()}
+        self.Dipoles = {dipole.Name: dipole for dipole in self.Groups["Dipoles"]}
+
+    @property
+    def Beamline(self):
+        """The (element name, location) of every placement other than dipole edges."""
+
+        with open(self._Spool) as spool:
+            for line in spool:
+                name, location = line.rsplit('\t', 1)
+                yield name, float(location)
+
+    def Close(self):
+        import os
+        if os.path.exists(self._Spool):
+            os.remove(self._Spool)
@@ -0,0 +1,191 @@
+# LatticeExpression.py
+#
+# Small arithmetic expression engine used by the lattice parsers.
+# Each distinct expression is parsed once, checked against a whitelist of
+# syntax (numbers, variables, + - * / ** % //, and the functions and
+# constants of the math module, plus abs) and compiled; evaluation then only looks
+# up the variables it references.
+# Also provides a dependency-tracking variable store for deferred expressions.
+
+import ast
+import math
+import re
+from collections.abc import Mapping
+from functools import lru_cache
+
+# Everything 'from math import *' provides, and abs (a MAD-X function)
+MathNamespace = {name: getattr(math, name) for name in dir(math) if not name.startswith('_')}
+MathNamespace['abs'] = abs
+
+# Numbers are matched first so that exponents are not mistaken for names.
+# Names may start with '$' (6DSim) and contain '.' (MAD-X).
+_Token = re.compile(r'(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)|(?P<name>\$?[A-Za-z_][A-Za-z0-9_.]*)')
+
+_AllowedNodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant, ast.Name, ast.Load, ast.Call,
+                 ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.UAdd, ast.USub)
+
+class ExpressionError(ValueError):
+    pass
+
+# ---------------------------------------------------------------------------
+class Expression:
+    """A parsed and compiled expression. Use CompileExpression to get cached instances."""
+
+    __slots__ = ('Text', 'Names', '_Identifiers', '_Code', '_Tokens')
+
+    def __init__(self, text):
+        self.Text = text
+        self.Names = []
+        self._Identifiers = []
+        self._Tokens = []
+        source = []
+        position = 0
+        for match in _Token.finditer(text):
+            source.append(text[position:match.start()])
+            self._Tokens.append(text[position:match.start()])
+            position = match.end()
+            if match.lastgroup == 'name':
+                name = match.group()
+                if name not in self.Names:
+                    self.Names.append(name)
+                    self._Identifiers.append("_v{}".format(len(self.Names)-1))
+                source.append(self._Identifiers[self.Names.index(name)])
+                self._Tokens.append((name,))
+            else:
+                source.append(match.group())
+                self._Tokens.append(match.group())
+        source.append(text[position:])
+        self._Tokens.append(text[position:])
+
+        try:
+            tree = ast.parse(''.join(source).strip().replace('^', '**'), mode='eval')
+        except SyntaxError:
+            raise ExpressionError("Invalid expression '{}'".format(text.strip()))
+        for node in ast.walk(tree):
+            if not isinstance(node, _AllowedNodes):
+                raise ExpressionError("Unsupported syntax in expression '{}'".format(text.strip()))
+            if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+                raise ExpressionError("Unsupported constant in expression '{}'".format(text.strip()))
+            if isinstance(node, ast.Call) and (not isinstance(node.func, ast.Name) or node.keywords):
+                raise ExpressionError("Unsupported function call in expression '{}'".format(text.strip()))
+        self._Code = compile(tree, '<expression>', 'eval')
+
+    def Evaluate(self, variables):
+        """Evaluate against a name -> value table; names not in the table are looked up in the math module."""
+
+        namespace = {}
+        for identifier, name in zip(self._Identifiers, self.Names):
+            if name in variables:
+                namespace[identifier] = variables[name]
+            elif name in MathNamespace:
+                namespace[identifier] = MathNamespace[name]
+            else:
+                raise NameError("name '{}' is not defined".format(name))
+        return eval(self._Code, {'__builtins__': {}}, namespace)
+
+    def Substitute(self, variables):
+        """Return the expression text with whole-name occurrences of variables replaced by their values."""
+
+        return ''.join(str(variables[token[0]]) if isinstance(token, tuple) and token[0] in variables
+                       else token[0] if isinstance(token, tuple) else token
+                       for token in self._Tokens).strip()
+
+# ---------------------------------------------------------------------------
+@lru_cache(maxsize=65536)
+def CompileExpression(text):
+    """Parse and compile an expression, caching the result by its text."""
+    return Expression(text)
+
+# ---------------------------------------------------------------------------
+class VariableStore(Mapping):
+    """Variables defined by expressions of other variables (e.g. MAD-X ':=' deferred assignments).
+
+    The definitions form a dependency graph. Values are evaluated on demand in dependency order,
+    memoized, and circular definitions raise an ExpressionError. Redefining a variable (a knob
+    change) only discards the memoized values of the variables that depend on it."""
+
+    def __init__(self):
+        self._Definitions = {}
+        self._Dependents = {}
+        self._Values = {}
+
+    def Define(self, name, expression, deferred=True):
+        """Define a variable from an expression (text) or a number.
+        Non-deferred expressions are evaluated immediately, like MAD-X '='."""
+
+        if isinstance(expression, str):
+            expression = CompileExpression(expression)
+            if not deferred:
+                expression = expression.Evaluate(self)
+        old = self._Definitions.get(name)
+        if isinstance(old, Expression):
+            for dependency in old.Names:
+                self._Dependents[dependency].discard(name)
+        self._Definitions[name] = expression
+        if isinstance(expression, Expression):
+            for dependency in expression.Names:
+                self._Dependents.setdefault(dependency, set()).add(name)
+        self._Invalidate(name)
+
+    def Set(self, name, value):
+        """Set a variable to a fixed value."""
+        self.Define(name, value)
+
+    def Dependents(self, name):
+        """All variables whose values depend, directly or indirectly, on the named variable."""
+
+        dependents = set()
+        stack = [name]
+        while stack:
+            for dependent in self._Dependents.get(stack.pop(), ()):
+                if dependent not in dependents:
+                    dependents.add(dependent)
+                    stack.append(dependent)
+        return dependents
+
+    def Resolve(self):
+        """Evaluate every variable and return a name -> value dictionary."""
+        return {name: self[name] for name in self._Definitions}
+
+    def _Invalidate(self, name):
+        self._Values.pop(name, None)
+        for dependent in self.Dependents(name):
+            self._Values.pop(dependent, None)
+
+    def _Evaluate(self, name):
+        # Iterative depth-first walk, so long chains do not hit the recursion limit
+        stack = [name]
+        active = {name}
+        while stack:
+            current = stack[-1]
+            definition = self._Definitions[current]
+            pending = [dependency for dependency in definition.Names
+                       if dependency in self._Definitions and dependency not in self._Values] \
+                      if isinstance(definition, Expression) else []
+            if pending:
+                for dependency in pending:
+                    if dependency in active:
+                        raise ExpressionError("Circular definition of variable '{}'".format(dependency))
+                stack.append(pending[0])
+                active.add(pending[0])
+                continue
+            self._Values[current] = definition.Evaluate(self) if isinstance(definition, Expression) else definition
+            stack.pop()
+            active.discard(current)
+        return self._Values[name]
+
+    def __getitem__(self, name):
+        if name in self._Values:
+            return self._Values[name]
+        if name not in self._Definitions:
+            raise KeyError(name)
+        return self._Evaluate(name)
+
+    def __contains__(self, name):
+        return name in self._Definitions
+
+    def __iter__(self):
+        return iter(self._Definitions)
+
+    def __len__(self):
+        return len(self._Definitions)
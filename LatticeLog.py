@@ -0,0 +1,32 @@
+# LatticeLog.py
+#
+# Console output of the LatticeConvert toolkit, through the standard logging module.
+# Messages go to the "LatticeConvert" logger, which prints them to standard output
+# as plain text; quiet mode keeps only warnings (parse error reports) and errors.
+# Applications can attach their own handlers, or remove ours, in the usual way.
+
+import sys
+import logging
+
+Log = logging.getLogger("LatticeConvert")
+
+class StandardOutputHandler(logging.StreamHandler):
+    """Writes to whatever sys.stdout is when a message is emitted, so redirected output is captured."""
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+def ConfigureLogging(quiet=False):
+    """Show all toolkit messages, or only warnings and errors when quiet."""
+    Log.setLevel(logging.WARNING if quiet else logging.INFO)
+
+_handler = StandardOutputHandler()
+_handler.setFormatter(logging.Formatter("%(message)s"))
+Log.addHandler(_handler)
+Log.propagate = False
+ConfigureLogging()
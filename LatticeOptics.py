@@ -0,0 +1,268 @@
+# LatticeOptics.py
+#
+# Linear optics of a lattice: 6x6 transfer maps of the elements, composed with
+# NumPy, and the periodic Twiss functions, tunes and dispersion of a ring.
+# Coordinates are (x, x', y, y', l, delta) in the ultra-relativistic limit.
+# Maps are computed once per element definition, so repeated magnets share one
+# matrix, and the maps of all placements are composed by a parallel prefix
+# product (log2(n) batched matrix multiplications) rather than a loop over
+# the placements.
+
+import math
+import numpy as np
+from LatticeData import *
+
+# ---------------------------------------------------------------------------
+def _Focusing(k, length):
+    """Cosine- and sine-like functions (C, S, C', S') of x'' + k x = 0 over a length,
+    and the integrals (1 - C)/k and (L - S)/k needed for the dispersion of bends."""
+
+    if k > 0.:
+        w = math.sqrt(k)
+        C, S, dC = math.cos(w*length), math.sin(w*length)/w, -w*math.sin(w*length)
+        return C, S, dC, C, (1. - C)/k, (length - S)/k
+    if k < 0.:
+        w = math.sqrt(-k)
+        C, S, dC = math.cosh(w*length), math.sinh(w*length)/w, w*math.sinh(w*length)
+        return C, S, dC, C, (1. - C)/k, (length - S)/k
+    return 1., length, 0., 1., length**2/2., length**3/6.
+
+def DriftMap(length):
+    M = np.eye(6)
+    M[0, 1] = length
+    M[2, 3] = length
+    return M
+
+def QuadMap(length, k1):
+    M = np.eye(6)
+    C, S, dC, dS = _Focusing(k1, length)[:4]
+    M[0:2, 0:2] = [[C, S], [dC, dS]]
+    C, S, dC, dS = _Focusing(-k1, length)[:4]
+    M[2:4, 2:4] = [[C, S], [dC, dS]]
+    return M
+
+def RotationMap(tilt):
+    """Rotation of the transverse coordinates by the tilt angle."""
+
+    c, s = math.cos(tilt), math.sin(tilt)
+    M = np.eye(6)
+    M[0:4, 0:4] = [[c, 0., s, 0.], [0., c, 0., s], [-s, 0., c, 0.], [0., -s, 0., c]]
+    return M
+
+def SkewQuadMap(length, k1, tilt):
+    return RotationMap(-tilt) @ QuadMap(length, k1) @ RotationMap(tilt)
+
+def SectorBendMap(length, angle, k1=0.):
+    """Body of a sector bend of curvature h = angle/length and gradient k1."""
+
+    if not length:
+        return np.eye(6)
+    h = angle / length
+    M = np.eye(6)
+    C, S, dC, dS, D, F = _Focusing(h*h + k1, length)
+    M[0:2, 0:2] = [[C, S], [dC, dS]]
+    M[0, 5] = h*D
+    M[1, 5] = h*S
+    M[4, 0] = -h*S
+    M[4, 1] = -h*D
+    M[4, 5] = -h*h*F
+    C, S, dC, dS = _Focusing(-k1, length)[:4]
+    M[2:4, 2:4] = [[C, S], [dC, dS]]
+    return M
+
+def EdgeMap(h, edge_angle, gap=0., fringek=0.):
+    """Thin pole-face rotation of a bend of curvature h, with the fringe field correction
+    psi = 2 gap h fringek (1 + sin^2 e)/cos e in the vertical plane (gap is the half gap)."""
+
+    M = np.eye(6)
+    if not h:
+        return M
+    edge_angle = edge_angle or 0.
+    psi = 2.*(gap or 0.)*h*(fringek or 0.)*(1. + math.sin(edge_angle)**2)/math.cos(edge_angle)
+    M[1, 0] = h*math.tan(edge_angle)
+    M[3, 2] = -h*math.tan(edge_angle - psi)
+    return M
+
+def SolenoidMap(length, ks):
+    """Solenoid of strength ks (= Bs/(B rho)); a drift if ks is zero."""
+
+    if not ks:
+        return DriftMap(length)
+    K = ks/2.
+    C, S = math.cos(K*length), math.sin(K*length)
+    M = np.eye(6)
+    M[0:4, 0:4] = [[C*C, S*C/K, S*C, S*S/K],
+                   [-K*S*C, C*C, -K*S*S, S*C],
+                   [-S*C, -S*S/K, C*C, S*C/K],
+                   [K*S*S, -S*C, -K*S*C, C*C]]
+    return M
+
+def TransferMap(element):
+    """The 6x6 linear transfer map of an element.
+
+    Sextupoles and octupoles are drifts in the linear limit, as are RF cavities. A dipole includes
+    the focusing of its pole faces (E1, E2) unless its edges are separate DipoleEdge placements
+    (UpEdge/DownEdge set), in which case the edge placements provide it."""
+
+    definition = element.Definition
+    element_type = definition.__class__.__name__
+    if not isinstance(definition, (Drift, RF, Dipole, DipoleEdge, Quad, SQuad, Sext, Octu, Solenoid)):
+        raise TypeError("No transfer map for element {} of type {}".format(element.Name, element_type))
+    length = getattr(definition, 'Length', 0.) or 0.
+
+    if isinstance(definition, Quad):
+        return QuadMap(length, definition.K1 or 0.)
+    if isinstance(definition, SQuad):
+        return SkewQuadMap(length, definition.K1 or 0., definition.Tilt or 0.)
+    if isinstance(definition, Dipole):
+        M = SectorBendMap(length, definition.Angle or 0., definition.K1 or 0.)
+        if definition.UpEdge is None and definition.DownEdge is None and length:
+            h = (definition.Angle or 0.)/length
+            M = (EdgeMap(h, definition.E2, definition.Gap, definition.FringeK) @ M @
+                 EdgeMap(h, definition.E1, definition.Gap, definition.FringeK))
+        return M
+    if isinstance(definition, DipoleEdge):
+        h = definition.Angle if definition.Angle is not None else definition.K0
+        return EdgeMap(h or 0., definition.E1, definition.Gap, definition.FringeK)
+    if isinstance(definition, Solenoid):
+        return SolenoidMap(length, definition.KS or 0.)
+    return DriftMap(length)
+
+# ---------------------------------------------------------------------------
+def ComposeMaps(maps):
+    """Cumulative products of a stack of maps: result[i] = maps[i] @ ... @ maps[0].
+    Computed as a parallel prefix product, in log2(n) batched multiplications."""
+
+    cumulative = np.array(maps, dtype=float, copy=True)
+    offset = 1
+    while offset < len(cumulative):
+        cumulative[offset:] = cumulative[offset:] @ cumulative[:-offset]
+        offset *= 2
+    return cumulative
+
+def ProductMap(maps):
+    """The product maps[n-1] @ ... @ maps[0], by pairwise (tree) reduction."""
+
+    product = np.array(maps, dtype=float)
+    if not len(product):
+        return np.eye(6)
+    while len(product) > 1:
+        if len(product) % 2:
+            product = np.concatenate((product, np.eye(6)[np.newaxis]))
+        product = product[1::2] @ product[0::2]
+    return product[0]
+
+# ---------------------------------------------------------------------------
+class LatticeOptics:
+    """Linear optics of a lattice, with the element maps cached by definition."""
+
+    def __init__(self, lattice):
+        self.Lattice = lattice
+        self._MapCache = {}
+
+    def ElementMap(self, element):
+        key = element.Definition.Name
+        if key not in self._MapCache:
+            self._MapCache[key] = TransferMap(element)
+        return self._MapCache[key]
+
+    def ElementMaps(self):
+        """The distinct maps of the sequence (one per definition) and, for each placement,
+        the index of its map."""
+
+        elements = self.Lattice.Elements
+        keys = {}
+        maps = []
+        indices = np.empty(len(self.Lattice.Sequence), dtype=np.intp)
+        for placement, name in enumerate(self.Lattice.Sequence):
+            index = keys.get(name)
+            if index is None:
+                element = elements[name]
+                definition = element.Definition.Name
+                index = keys.get(definition)
+                if index is None:
+                    index = len(maps)
+                    maps.append(self.ElementMap(element))
+                    keys[definition] = index
+                keys[name] = index
+            indices[placement] = index
+        return np.array(maps).reshape(-1, 6, 6), indices
+
+    def PlacementLengths(self):
+        lengths = {name: getattr(element, 'Length', 0.) or 0. for name, element in self.Lattice.Elements.items()}
+        return np.array([lengths[name] for name in self.Lattice.Sequence], dtype=float)
+
+    def Positions(self):
+        """s at the exit of every placement."""
+        return np.array(self.Lattice.PlacementLocations(), dtype=float) + self.PlacementLengths()
+
+    def PlacementMaps(self):
+        """The map of every placement, including the gap (an implicit drift) before it.
+        The gap between the last placement and the end of the lattice is added before the first,
+        as the lattice is taken to be a ring."""
+
+        maps, indices = self.ElementMaps()
+        placement_maps = maps[indices]
+        if not len(placement_maps):
+            return placement_maps
+        starts = np.array(self.Lattice.PlacementLocations(), dtype=float)
+        ends = starts + self.PlacementLengths()
+        gaps = np.empty(len(starts))
+        gaps[0] = starts[0] + max(0., (self.Lattice.Length or 0.) - ends[-1])
+        gaps[1:] = starts[1:] - ends[:-1]
+        gapped = np.flatnonzero(gaps > 1e-12)
+        if len(gapped):
+            drifts = np.tile(np.eye(6), (len(gapped), 1, 1))
+            drifts[:, 0, 1] = gaps[gapped]
+            drifts[:, 2, 3] = gaps[gapped]
+            placement_maps[gapped] = placement_maps[gapped] @ drifts
+        return placement_maps
+
+    def CumulativeMaps(self):
+        """Map from the start of the lattice to the exit of every placement."""
+        return ComposeMaps(self.PlacementMaps())
+
+    def OneTurnMap(self):
+        return ProductMap(self.PlacementMaps())
+
+    def Twiss(self):
+        """Periodic Twiss functions, phase advances and dispersion at the exit of every placement,
+        and the tunes, as a dictionary of arrays with MAD-X column names (S, BETX, ALFX, MUX, DX,
+        DPX, ... and Q1, Q2).  Phase advances are in units of 2 pi.  The transverse planes are
+        treated as uncoupled (skew quadrupoles and solenoids couple them; their cross terms are
+        ignored).  Raises ValueError if the lattice has no stable periodic solution."""
+
+        cumulative = self.CumulativeMaps()
+        if not len(cumulative):
+            raise ValueError("The lattice has no placements")
+        turn = cumulative[-1]
+
+        twiss = {"S": self.Positions()}
+        for plane, (beta, alpha, mu, tune) in enumerate((("BETX", "ALFX", "MUX", "Q1"), ("BETY", "ALFY", "MUY", "Q2"))):
+            i = 2*plane
+            T11, T12, T21, T22 = turn[i, i], turn[i, i+1], turn[i+1, i], turn[i+1, i+1]
+            cos_mu = (T11 + T22)/2.
+            if abs(cos_mu) >= 1.:
+                raise ValueError("The lattice is unstable in the {} plane (trace/2 = {})".format("xy"[plane], cos_mu))
+            sin_mu = math.copysign(math.sqrt(1. - cos_mu**2), T12)
+            beta0 = T12/sin_mu
+            alpha0 = (T11 - T22)/(2.*sin_mu)
+            gamma0 = (1. + alpha0**2)/beta0
+
+            C, S = cumulative[:, i, i], cumulative[:, i, i+1]
+            dC, dS = cumulative[:, i+1, i], cumulative[:, i+1, i+1]
+            twiss[beta] = C*C*beta0 - 2.*C*S*alpha0 + S*S*gamma0
+            twiss[alpha] = -C*dC*beta0 + (C*dS + S*dC)*alpha0 - S*dS*gamma0
+            phase = np.unwrap(np.arctan2(S, C*beta0 - S*alpha0) % (2.*np.pi))
+            twiss[mu] = phase/(2.*np.pi)
+            twiss[tune] = float(twiss[mu][-1])
+
+        # Periodic dispersion: (I - T) eta = T[:, delta] in the transverse coordinates
+        try:
+            eta0 = np.linalg.solve(np.eye(4) - turn[:4, :4], turn[:4, 5])
+        except np.linalg.LinAlgError:
+            raise ValueError("The one-turn map has no periodic dispersion")
+        eta = cumulative[:, :4, :4] @ eta0 + cumulative[:, :4, 5]
+        for column, label in enumerate(("DX", "DPX", "DY", "DPY")):
+            twiss[label] = eta[:, column]
+        return twiss
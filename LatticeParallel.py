@@ -0,0 +1,111 @@
+# LatticeParallel.py
+#
+# Process-parallel parsing of the element definitions of large lattice files.
+# A byte range of the file (its definitions, or one section of it) is split
+# into chunks which begin on statement boundaries, so that no statement spans
+# two chunks, and the chunks are parsed in a pool of worker processes, each by
+# a fresh parser.  The results and parse errors come back in file order, so
+# merging them chunk by chunk gives the same definitions as a serial parse.
+
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# Smallest chunk worth sending to a worker; ranges with fewer bytes per worker use fewer workers
+MinimumChunkBytes = 1 << 18
+
+# Parse error lists of LatticeParser, and those holding distinct entries
+ParseErrorLists = ("InvalidExpressions", "InvalidVariables", "IgnoredElementTypes", "MissingParameters", "IgnoredElements")
+DistinctErrorLists = ("IgnoredElementTypes",)
+
+# ---------------------------------------------------------------------------
+def _PreviousLine(inFile, position, start):
+    """The line of a file ending at a position (the start of the following line)."""
+
+    begin = position - 1
+    step = 4096
+    while begin > start:
+        block_start = max(start, begin - step)
+        inFile.seek(block_start)
+        newline = inFile.read(begin - block_start).rfind(b'\n')
+        if newline >= 0:
+            begin = block_start + newline + 1
+            break
+        begin = block_start
+    begin = max(begin, start)
+    inFile.seek(begin)
+    return inFile.read(position - begin).decode('utf-8', 'replace')
+
+def ChunkBoundaries(inputFile, start, end, n_chunks, continued=None):
+    """Split the byte range [start, end) of a file into up to n_chunks (first, last) ranges of about
+    equal size, each beginning at the start of a line.  With continued, a function of a line which is
+    true if the statement on it continues on the next line, ranges also begin only on statements."""
+
+    boundaries = [start]
+    with open(inputFile, 'rb') as inFile:
+        for chunk in range(1, n_chunks):
+            position = max(start + (end - start)*chunk//n_chunks, boundaries[-1])
+            inFile.seek(position)
+            inFile.readline()
+            position = inFile.tell()
+            while continued is not None and position < end and continued(_PreviousLine(inFile, position, start)):
+                inFile.seek(position)
+                inFile.readline()
+                position = inFile.tell()
+            if position >= end:
+                break
+            if position > boundaries[-1]:
+                boundaries.append(position)
+    return list(zip(boundaries, boundaries[1:] + [end]))
+
+# ---------------------------------------------------------------------------
+def ReadLines(inputFile, first, last):
+    """The lines of a byte range of a file, decoded as the file would be when opened for reading."""
+
+    with open(inputFile, 'rb') as inFile:
+        inFile.seek(first)
+        data = inFile.read(last - first)
+    return io.TextIOWrapper(io.BytesIO(data))
+
+def _ParseChunk(parserClass, method, inputFile, first, last, arguments):
+    parser = parserClass()
+    result = getattr(parser, method)(ReadLines(inputFile, first, last), *arguments)
+    return result, {errors: getattr(parser, errors) for errors in ParseErrorLists}
+
+def MergeParseErrors(parser, errors):
+    """Append the parse errors of a chunk to those of a parser."""
+
+    for name, entries in errors.items():
+        merged = getattr(parser, name)
+        if name in DistinctErrorLists:
+            merged.extend(entry for entry in entries if entry not in merged)
+        else:
+            merged.extend(entries)
+
+def ParseChunks(parser, method, inputFile, start, end, workers, continued=None, arguments=()):
+    """Parse the byte range [start, end) of a file with parser.<method>(lines, *arguments), in chunks
+    on up to workers processes.  Each chunk is parsed by a new parser of the same class, whose parse
+    errors are merged into those of parser; returns the results of the chunks in file order.
+    Ranges too small to share out, or a single worker, are parsed in this process."""
+
+    workers = max(1, min(workers or 1, (end - start)//MinimumChunkBytes))
+    if workers == 1:
+        return [getattr(parser, method)(ReadLines(inputFile, start, end), *arguments)]
+
+    chunks = ChunkBoundaries(inputFile, start, end, workers, continued)
+    results = []
+    with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+        futures = [executor.submit(_ParseChunk, parser.__class__, method, inputFile, first, last, arguments)
+                   for first, last in chunks]
+        for future in futures:
+            result, errors = future.result()
+            MergeParseErrors(parser, errors)
+            results.append(result)
+    return results
+
+def WorkerCount(workers):
+    """Number of parse workers for an option value: None or 1 for serial, 0 for one per CPU."""
+
+    if workers == 0:
+        return os.cpu_count() or 1
+    return workers or 1
@@ -5,15 +5,34 @@
 # M Wallbank, Fermilab <wallbank@fnal.gov>
 # July 2023
 
-from abc import abstractmethod
-from math import *
 import re
-from LatticeData import Lattice
+from abc import abstractmethod
+from LatticeData import Lattice, LatticeLayout, DriftTolerance
+from LatticeLog import Log
+from LatticeProfile import Instrument
+from LatticeExpression import CompileExpression, ExpressionError
+
+_LineItemPattern = re.compile(r'\s*(-)?\s*(?:(\d+)\s*\*)?\s*(-)?(.+)$')
+
+# ---------------------------------------------------------------------------
+def LineItem(item):
+    """Split a beamline item such as '2*CELL' or '-CELL' into (count, reverse, name)."""
+
+    match = _LineItemPattern.match(item)
+    if match is None:
+        return 1, False, item
+    reverse = bool(match.group(1)) != bool(match.group(3))
+    return int(match.group(2)) if match.group(2) else 1, reverse, match.group(4).strip()
 
 # ---------------------------------------------------------------------------
 class LatticeParser:
-    def __init__(self):
-        self.Lattice = Lattice()
+    def __init__(self, **kwargs):
+        if kwargs.get('columnar', False):
+            # NumPy is only imported when the columnar storage is used
+            from LatticeColumns import ColumnarLattice
+            self.Lattice = ColumnarLattice()
+        else:
+            self.Lattice = Lattice()
 
         self.InvalidExpressions = []
         self.InvalidVariables = []
@@ -21,51 +40,145 @@ class LatticeParser:
         self.MissingParameters = []
         self.IgnoredElements = []
 
+    # ---------------------------------------------------------------------------
+    @Instrument("expression evaluation")
+    def EvaluateExpression(self, expression, variables):
+        value = None
+        try:
+            value = CompileExpression(expression).Evaluate(variables)
+        except NameError as error:
+            if str(error).startswith("name '$"):
+                self.InvalidVariables.append(expression.strip())
+            else:
+                self.InvalidExpressions.append(expression.strip())
+        except (ValueError, ArithmeticError):
+            # ExpressionError, and math errors such as sqrt(-1) or 1/0
+            self.InvalidExpressions.append(expression.strip())
+        return value
+
     # ---------------------------------------------------------------------------
     def ExpandExpression(self, expression, variables):
-        variables_in_expr = re.split('[+ \- * / ( )]', expression)
-        for variable in variables_in_expr:
-            if variable in variables:
-                expression = expression.replace(variable,
-                                                str(variables[variable]),
-                                                1).strip()
+        try:
+            expression = CompileExpression(expression).Substitute(variables)
+        except ExpressionError:
+            expression = expression.strip()
         if '$' in expression:
             self.InvalidVariables.append(expression)
         return expression
 
+    # ---------------------------------------------------------------------------
+    def AddDrifts(self, **kwargs):
+        """Fill the gaps between the placements with drifts if add_drifts is given, sharing a definition
+        between drifts whose lengths agree within drift_tolerance."""
+
+        if kwargs.get("add_drifts", None) != None:
+            tolerance = kwargs.get("drift_tolerance")
+            self.Lattice.InsertDrifts(kwargs.get("add_drifts"), DriftTolerance if tolerance is None else tolerance)
+
     # ---------------------------------------------------------------------------
     def LoadLattice(self, lattice):
         self.Lattice = lattice
 
+    # ---------------------------------------------------------------------------
+    def Layout(self, **kwargs):
+        """The layout passed in to be shared between writers, or one gathered from the lattice."""
+
+        layout = kwargs.get('layout')
+        return layout if layout is not None else LatticeLayout(self.Lattice)
+
+    # ---------------------------------------------------------------------------
+    def ParseErrors(self):
+        """Parse errors found so far, as description -> list of offending items."""
+        return {"Invalid expressions": self.InvalidExpressions,
+                "Lines with invalid variables": self.InvalidVariables,
+                "Ignored element types": self.IgnoredElementTypes,
+                "Missing parameters": self.MissingParameters,
+                "Ignored lattice elements": self.IgnoredElements}
+
     # ---------------------------------------------------------------------------
     def ReportParseErrors(self):
-        self.ReportParseError(self.InvalidExpressions, "Invalid expressions")
-        self.ReportParseError(self.InvalidVariables, "Lines with invalid variables")
-        self.ReportParseError(self.IgnoredElementTypes, "Ignored element types")
-        self.ReportParseError(self.MissingParameters, "Missing parameters")
-        self.ReportParseError(self.IgnoredElements, "Ignored lattice elements")
+        for description, report in self.ParseErrors().items():
+            self.ReportParseError(report, description)
 
     # ---------------------------------------------------------------------------
     def ReportParseError(self, report, description):
         if len(report):
-            print("{} ({}):".format(description, len(report)))
+            Log.warning("{} ({}):".format(description, len(report)))
             for item in report:
-                print('  {}'.format(item))
+                Log.warning("  {}".format(item))
+
+    # ---------------------------------------------------------------------------
+    def WriteText(self, outFile, pieces, chunk_size=65536):
+        """Write a stream of text pieces in large joined chunks, rather than one write per piece."""
+
+        buffer = []
+        for piece in pieces:
+            buffer.append(piece)
+            if len(buffer) >= chunk_size:
+                outFile.write(''.join(buffer))
+                buffer = []
+        outFile.write(''.join(buffer))
+
+    # ---------------------------------------------------------------------------
+    def IterateBeamline(self, elements, beamlines, line):
+        """Generate the elements of a beamline one at a time, given the elements and the beamlines
+        (name -> list of line items), where 'N*ITEM' repeats an item and '-ITEM' reverses it.
+        Only the stack of lines being expanded is held, not the expanded beamline."""
+
+        items = {}
+        def frame(name, reverse, count):
+            if name not in items:
+                items[name] = [LineItem(item) for item in beamlines[name]]
+            return [name, reverse, count, iter(items[name][::-1] if reverse else items[name])]
+
+        ignored = set()
+        stack = [frame(line, False, 1)]
+        active = [line]
+        while stack:
+            current = stack[-1]
+            for count, reverse, name in current[3]:
+                if name in beamlines:
+                    if name in active:
+                        raise RuntimeError("Beamline {} is defined recursively".format(name))
+                    stack.append(frame(name, reverse != current[1], count))
+                    active.append(name)
+                    break
+                elif name in elements:
+                    element = elements[name]
+                    for repeat in range(count):
+                        yield element
+                elif name not in ignored:
+                    ignored.add(name)
+                    self.IgnoredElements.append(name)
+            else:
+                # Repeat the line, or return to the line containing it
+                current[2] -= 1
+                if current[2] > 0:
+                    current[3] = iter(items[current[0]][::-1] if current[1] else items[current[0]])
+                else:
+                    stack.pop()
+                    active.pop()
 
     # ---------------------------------------------------------------------------
     def SolveExpression(self, expression):
-        value = None
-        try:
-            value = eval(expression)
-        except NameError:
-            self.InvalidExpressions.append(expression.strip())
-        return value
+        return self.EvaluateExpression(expression, {})
 
     # ---------------------------------------------------------------------------
     @abstractmethod
     def ParseInput(self):
         pass
 
+    # ---------------------------------------------------------------------------
+    @abstractmethod
+    def Placements(self, **kwargs):
+        """Generate (element, s) pairs in sequence order as the input is parsed, without building the lattice."""
+        pass
+
+    # ---------------------------------------------------------------------------
+    @abstractmethod
+    def FormatLattice(self, **kwargs):
+        pass
+
     # ---------------------------------------------------------------------------
     @abstractmethod
     def WriteLattice(self):
@@ -0,0 +1,193 @@
+# LatticeProfile.py
+#
+# Lightweight instrumentation of the conversion phases.
+# Records the wall time, number of calls and peak traced memory (tracemalloc) of
+# each named phase (tokenization, expression evaluation, element construction,
+# sequence expansion, drift insertion, writing, ...) and reports them as a
+# dictionary or JSON file.  Profiling is off by default; instrumented methods are
+# only wrapped while it is enabled, so they cost nothing otherwise.  cProfile can
+# also be run on request.
+
+import json
+import time
+import threading
+import functools
+import contextlib
+
+class Profiler:
+    """Per-phase timing, call counts and peak memory.
+
+    Phase times are inclusive: a phase nested inside another (e.g. tokenization inside
+    element construction) is counted in both."""
+
+    def __init__(self):
+        self.Enabled = False
+        self.Phases = {}
+        self.MemoryTraced = False
+        self._Memory = False
+        self._OwnTracer = False
+        self._CProfile = None
+        self._CProfileFile = None
+        self._Lock = threading.Lock()
+        self._Local = threading.local()
+
+    def Enable(self, memory=True, cprofile=None):
+        """Start recording. With memory, peak memory is traced (which slows the code down);
+        with cprofile, a cProfile of the whole run is written to that file by Disable.
+        If tracemalloc is already tracing, the caller's tracer is used as it is: it is neither
+        stopped nor has its peak reset, so phase peaks are then the peaks since it started.
+        The traced peak is process-wide, so the peaks of phases running at the same time on several
+        threads include each other's memory; LatticeConverter writes serially while memory is traced."""
+
+        self.Reset()
+        self.Enabled = True
+        for owner, attribute, function, name in _Instrumented:
+            setattr(owner, attribute, _Wrap(function, name))
+        self.MemoryTraced = memory
+        self._Memory = memory
+        if memory:
+            import tracemalloc
+            self._OwnTracer = not tracemalloc.is_tracing()
+            if self._OwnTracer:
+                tracemalloc.start()
+        if cprofile is not None:
+            import cProfile
+            self._CProfile = cProfile.Profile()
+            self._CProfileFile = cprofile
+            self._CProfile.enable()
+
+    def Disable(self):
+        self.Enabled = False
+        for owner, attribute, function, name in _Instrumented:
+            setattr(owner, attribute, function)
+        if self._CProfile is not None:
+            self._CProfile.disable()
+            self._CProfile.dump_stats(self._CProfileFile)
+            self._CProfile = None
+        if self._OwnTracer:
+            import tracemalloc
+            tracemalloc.stop()
+            self._OwnTracer = False
+        self._Memory = False
+
+    def Reset(self):
+        self.Phases = {}
+
+    @contextlib.contextmanager
+    def Phase(self, name):
+        """Time a block of code as (one call of) the named phase."""
+
+        if not self.Enabled:
+            yield
+            return
+        stack = self._Stack()
+        frame = [0]
+        if self._OwnTracer:
+            import tracemalloc
+            # The peak is reset for each phase, so keep the enclosing phase's peak so far
+            if stack:
+                stack[-1][0] = max(stack[-1][0], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            peak = 0
+            if self._Memory:
+                import tracemalloc
+                peak = max(frame[0], tracemalloc.get_traced_memory()[1])
+                if stack:
+                    stack[-1][0] = max(stack[-1][0], peak)
+            self._Record(name, seconds, 1, peak)
+
+    def Iterate(self, name, iterable):
+        """Iterate, counting the time spent producing each item (e.g. by a tokenizer) as the named phase."""
+
+        if not self.Enabled:
+            return iterable
+        return self._Iterate(name, iterable)
+
+    def _Iterate(self, name, iterable):
+        iterator = iter(iterable)
+        seconds = 0.
+        count = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    seconds += time.perf_counter() - start
+                count += 1
+                yield item
+        finally:
+            self._Record(name, seconds, count, 0)
+
+    def _Stack(self):
+        if not hasattr(self._Local, 'Stack'):
+            self._Local.Stack = []
+        return self._Local.Stack
+
+    def _Record(self, name, seconds, calls, peak):
+        with self._Lock:
+            phase = self.Phases.setdefault(name, {"calls": 0, "seconds": 0., "peak_bytes": 0})
+            phase["calls"] += calls
+            phase["seconds"] += seconds
+            phase["peak_bytes"] = max(phase["peak_bytes"], peak)
+
+    def Report(self):
+        """The recorded phases, as a dictionary suitable for JSON."""
+        return {"memory_traced": self.MemoryTraced,
+                "phases": {name: dict(phase) for name, phase in self.Phases.items()}}
+
+    def Write(self, outputFile):
+        with open(outputFile, 'w') as outFile:
+            json.dump(self.Report(), outFile, indent=1)
+
+# The profiler used by the toolkit
+Profile = Profiler()
+
+# (class, attribute, method, phase) of every instrumented method
+_Instrumented = []
+
+def _Wrap(function, name):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with Profile.Phase(name):
+            return function(*args, **kwargs)
+    return wrapper
+
+class _InstrumentedMethod:
+    """Placeholder which registers a method when its class is created, then puts the plain method back."""
+
+    def __init__(self, function, name):
+        self.Function = function
+        self.Name = name
+
+    def __set_name__(self, owner, attribute):
+        _Instrumented.append((owner, attribute, self.Function, self.Name))
+        setattr(owner, attribute, _Wrap(self.Function, self.Name) if Profile.Enabled else self.Function)
+
+def Instrument(name):
+    """Decorator for methods, recording each call as the named phase while profiling is enabled."""
+
+    def decorator(function):
+        return _InstrumentedMethod(function, name)
+    return decorator
+
+def MergeReports(reports):
+    """Combine profile reports (e.g. from batch workers): calls and times are summed, peaks maximized."""
+
+    merged = {"memory_traced": any(report["memory_traced"] for report in reports), "phases": {}}
+    for report in reports:
+        for name, phase in report["phases"].items():
+            total = merged["phases"].setdefault(name, {"calls": 0, "seconds": 0., "peak_bytes": 0})
+            total["calls"] += phase["calls"]
+            total["seconds"] += phase["seconds"]
+            total["peak_bytes"] = max(total["peak_bytes"], phase["peak_bytes"])
+    return merged
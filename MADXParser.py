@@ -1,161 +1,750 @@
 # MADXParser.py
 #
 # Implementation of an interface to MADX-formatted lattice descriptions.
-# Provides input (in development) and output tools.
+# Provides input and output tools.
 # M Wallbank, Fermilab <wallbank@fnal.gov>
 # July 2023
 
-import os, copy
+import os
+import re
+import math
 from LatticeParser import LatticeParser
+from LatticeExpression import VariableStore, CompileExpression, ExpressionError, MathNamespace
 from LatticeData import *
+from LatticeLog import Log
+from LatticeProfile import Profile, Instrument
 from datetime import datetime
 
+_CommentToken = re.compile(r'"|!|//|/\*')
+_Prefix = re.compile(r'\s*(?:(?:const|real|int|shared)\s+)+', re.IGNORECASE)
+# Name (and attribute) followed by '=' or ':=' (an assignment) or ':' (a label)
+_Head = re.compile(r'([a-z_][\w.]*)(?:->([a-z_]\w*))?(:=|=|:)(.*)$', re.DOTALL)
+_Reference = re.compile(r'([a-z_][\w.]*)->([a-z_]\w*)')
+_Group = re.compile(r'(-)?(?:(\d+)\*)?\((.*)\)$', re.DOTALL)
+_Call = re.compile(r'\s*call\s*,\s*file\s*=\s*"?([^"]*?)"?\s*$', re.IGNORECASE | re.DOTALL)
+_Return = re.compile(r'\s*(?:return|stop|exit|quit)\s*$', re.IGNORECASE)
+
+# MAD-X element classes which are read, and the element types they become
+ElementClasses = {"drift": Drift, "sbend": Dipole, "rbend": Dipole, "quadrupole": Quad, "sextupole": Sext,
+                  "octupole": Octu, "dipedge": DipoleEdge, "rfcavity": RF, "solenoid": Solenoid}
+
+# Element classes without a counterpart, which are read as drifts where they have a length
+DriftClasses = ("monitor", "hmonitor", "vmonitor", "instrument", "placeholder", "collimator", "ecollimator",
+                "rcollimator", "kicker", "hkicker", "vkicker", "tkicker", "elseparator")
+
+# Commands which may be labelled like elements, and are skipped
+Commands = ("beam", "twiss", "select", "option", "set", "title", "show", "value", "print", "printf", "match",
+            "survey", "track", "emit", "assign", "system", "exec", "savebeta", "seqedit", "endedit", "install",
+            "move", "remove", "cycle", "flatten", "save", "makethin", "macro")
+
+# Element attributes which are read, and the parameters they set
+ElementAttributes = {"l": "Length", "angle": "Angle", "k1": "K1", "k1s": "K1", "k2": "K2", "k3": "K3",
+                     "e1": "E1", "e2": "E2", "hgap": "Gap", "fint": "FringeK", "tilt": "Tilt", "h": "Angle",
+                     "volt": "Energy", "freq": "Frequency", "ks": "KS"}
+
+# Attributes which only apply to one element type
+_AttributeTypes = {"h": DipoleEdge, "k1s": SQuad}
+
+# Attributes which together give the strength and tilt of a tilted or skew quadrupole (see SetAttribute)
+_QuadAttributes = ("k1", "k1s", "tilt")
+
+# Position of the reference point along an element, as a fraction of its length, for each refer value
+ReferOffsets = {"entry": 0., "centre": 0.5, "center": 0.5, "exit": 1.}
+
+# Constants predefined by MAD-X (pi and e are taken from the math module)
+Constants = {"twopi": 2.*math.pi, "degrad": 180./math.pi, "raddeg": math.pi/180., "clight": 299792458.,
+             "emass": 0.51099895e-3, "pmass": 0.93827208816, "nmass": 0.93956542052, "mumass": 0.1056583755,
+             "qelect": 1.602176634e-19, "hbar": 6.582119569e-25, "erad": 2.8179403262e-15,
+             "prad": 2.8179403262e-15*0.51099895e-3/0.93827208816}
+
+# ---------------------------------------------------------------------------
+def _StripComments(line):
+    """Remove the comments (!, // and /* */) outside of quoted strings from a line.
+    Returns the remaining text and whether a /* comment is left open at the end of the line."""
+
+    pieces = []
+    start = position = 0
+    while True:
+        match = _CommentToken.search(line, position)
+        if match is None:
+            pieces.append(line[start:])
+            return ''.join(pieces), False
+        if match.group() == '"':
+            end = line.find('"', match.end())
+            if end < 0:
+                pieces.append(line[start:])
+                return ''.join(pieces), False
+            position = end + 1
+            continue
+        pieces.append(line[start:match.start()])
+        if match.group() != '/*':
+            return ''.join(pieces), False
+        end = line.find('*/', match.end())
+        if end < 0:
+            return ''.join(pieces), True
+        pieces.append(' ')
+        start = position = end + 2
+
+# ---------------------------------------------------------------------------
+def _SplitStatements(text):
+    """Split text containing braces or quotes at the semicolons outside of them.  A block (macro, if,
+    while) ends at its closing brace; braces after '=' (e.g. knl={...}) are part of a statement.
+    Returns the statements and the incomplete remainder."""
+
+    statements = []
+    depth = 0
+    start = 0
+    block = False
+    in_quotes = False
+    for index, character in enumerate(text):
+        if character == '"':
+            in_quotes = not in_quotes
+        elif in_quotes:
+            continue
+        elif character == '{':
+            if not depth:
+                before = text[start:index].rstrip()
+                block = not before.endswith('=') or before[:-1].rstrip().lower().endswith('macro')
+            depth += 1
+        elif character == '}':
+            depth -= 1
+            if not depth and block:
+                statements.append(text[start:index+1])
+                start = index + 1
+        elif character == ';' and not depth:
+            statements.append(text[start:index])
+            start = index + 1
+    return statements, text[start:]
+
+# ---------------------------------------------------------------------------
+def TokenizeMADX(lines):
+    """Split MAD-X input into statements, which may span lines, with the comments removed.
+    Macro, if and while blocks are returned whole, as one statement."""
+
+    pending = []
+    in_comment = False
+    for line in lines:
+        if in_comment:
+            end = line.find('*/')
+            if end < 0:
+                continue
+            line = line[end+2:]
+            in_comment = False
+        if '!' in line or '/' in line or '"' in line:
+            line, in_comment = _StripComments(line)
+        pending.append(line)
+        if ';' not in line and '}' not in line:
+            continue
+
+        text = ' '.join(pending)
+        if '{' in text or '"' in text:
+            statements, remainder = _SplitStatements(text)
+        else:
+            statements = text.split(';')
+            remainder = statements.pop()
+        pending = [remainder] if remainder.strip() else []
+        for statement in statements:
+            statement = statement.strip()
+            if statement:
+                yield statement
+
+    statement = ' '.join(pending).strip()
+    if statement:
+        yield statement
+
+# ---------------------------------------------------------------------------
+def _SplitFields(text):
+    """Split a statement at the commas outside of parentheses and braces."""
+
+    if '(' not in text and '{' not in text:
+        return text.split(',')
+    fields = []
+    depth = 0
+    start = 0
+    for index, character in enumerate(text):
+        if character in '({':
+            depth += 1
+        elif character in ')}':
+            depth -= 1
+        elif character == ',' and not depth:
+            fields.append(text[start:index])
+            start = index + 1
+    fields.append(text[start:])
+    return fields
+
+# ---------------------------------------------------------------------------
+def _Attributes(fields):
+    """Read 'attribute=value' and 'attribute:=value' fields as attribute -> (value, deferred).
+    Flags (fields without a value) have the value None."""
+
+    attributes = {}
+    for field in fields:
+        position = field.find('=')
+        if position < 0:
+            if field:
+                attributes[field] = (None, False)
+        elif position and field[position-1] == ':':
+            attributes[field[:position-1]] = (field[position+1:], True)
+        else:
+            attributes[field[:position]] = (field[position+1:], False)
+    return attributes
+
+# ---------------------------------------------------------------------------
+class _Sequence:
+    """A sequence being read: its reference system, the positions of its placements for 'from' and
+    'refpos', and its placements unless they are streamed."""
+
+    __slots__ = ('Name', 'Length', 'Refer', 'RefPos', 'Positions', 'Placements', 'Location')
+
+    def __init__(self, name, length, refer, refpos, stored):
+        self.Name = name
+        self.Length = length
+        self.Refer = refer
+        self.RefPos = refpos
+        self.Positions = {}
+        self.Placements = [] if stored else None
+        self.Location = 0.
+
 # ---------------------------------------------------------------------------
 class MADXParser(LatticeParser):
     def __init__(self, **kwargs):
-        LatticeParser.__init__(self)
+        LatticeParser.__init__(self, **kwargs)
+        self.Variables = VariableStore()
+        for name, value in Constants.items():
+            self.Variables.Set(name, value)
+
+        # Element definitions as name -> (class, attributes, parent), and the elements built from them
+        self.Definitions = {}
+        self.Elements = {}
+        self.Beamlines = {}
+        self.Sequences = {}
+
+        self._Sequence = None
+        self._Selected = None
+        self._Streamed = False
+        self._Used = None
+        self._LastLine = None
+        self._Aliases = {}
+        self._Deferred = {}
+        self._QuadAttributes = {}
+        self._Exported = set()
+        self._IgnoredNames = set()
 
     # ---------------------------------------------------------------------------
+    @Instrument("parse")
     def ParseInput(self, **kwargs):
         inputFile = kwargs.get('inputFile')
         beamline = kwargs.get('beamline')
-        print('''
+        Log.info('''
 -----------------------------------------------------
 Importing lattice in MAD-X format from\n{}
 '''.format(inputFile))
 
-        self.Lattice.Name = os.path.basename(inputFile).strip('.seq')
-
-        variables = {}
-        elements = {}
-        in_sequence = False
-
-        for line in open(inputFile, 'r'):
-            lte_line = line.strip()
-            if not lte_line or lte_line.startswith('!') or not lte_line.endswith(';'): continue
-            lte_line = lte_line.strip(';')
-
-            # Sequence
-            if lte_line.startswith("endsequence"):
-                in_sequence = False
-                continue
-            if in_sequence:
-                if ':' in lte_line:
-                    line_split = lte_line.split(':')
-                    element_name = line_split[0].strip()
-                    element_type = line_split[1].split(',')[0].strip()
-                    element_params = line_split[1].split(',')[1:]
-                    element_params = [e.strip() for e in element_params]
-                else:
-                    element_name = lte_line.split(',')[0].strip()
-                    element_type = element_name
-                    element_params = lte_line.split(',')[1:]
-                    element_params = [e.strip() for e in element_params]
-                if element_type in elements:
-                    lattice_element = copy.deepcopy(elements[element_type])
-                    at = self.ElementParameter(element_params, 'at', variables)
-                    lattice_element.Name = element_name
-                    lattice_element.Center = at
-                    self.Lattice.AddElement(lattice_element, measure_length=False)
-                else:
-                    self.IgnoredElements.append(element_name)
-
-            # Variables
-            first_colon = lte_line.find(':')
-            if first_colon < 0 or lte_line[first_colon+1] == '=':
-                parameter = lte_line.split(':=') if ':' in lte_line else lte_line.split('=')
-                variables[parameter[0].strip()] = parameter[1].strip()
-                continue
-
-            # Elements
-            line_split = lte_line.split(':')
-            element_name = line_split[0].strip()
-            element_variables = lte_line.strip(element_name+':').strip()
-            element_params = element_variables.split(',')[1:]
-            element_params = [e.strip() for e in element_params]
-
-            if len(element_params) and element_params[0] in elements:
-                element = copy.deepcopy(elements[element_params[0]])
-                elements[element_name] = element
-
-            if element_variables.startswith("drift"):
-                print("Inputting drift {}".format(element_name))
-                length = self.ElementParameter(element_parames, 'l', variables)
-                drift = Drift(element_name, length=length)
-                elements[element_name] = drift
-
-            if element_variables.startswith("sbend") or element_variables.startswith("rbend"):
-                length = self.ElementParameter(element_params, 'l', variables)
-                angle = self.ElementParameter(element_params, 'angle', variables)
-                e1 = self.ElementParameter(element_params, 'e1', variables)
-                e2 = self.ElementParameter(element_params, 'e2', variables)
-                dipole = Dipole(element_name, length=length, angle=angle, e1=e1, e2=e2)
-                if element_variables.startswith("rbend"):
-                    dipole.Sector = False
-                elements[element_name] = dipole
-
-            if element_variables.startswith("dipedge"):
-                e1 = self.ElementParameter(element_params, 'e1', variables)
-                angle = self.ElementParameter(element_params, 'h', variables)
-                hgap = self.ElementParameter(element_params, 'hgap', variables)
-                fint = self.ElementParameter(element_params, 'fint', variables)
-                dipole_edge = DipoleEdge(element_name, angle=angle, e1=e1, gap=hgap, fringek=fint)
-                elements[element_name] = dipole_edge
-
-            if element_variables.startswith("quad"):
-                length = self.ElementParameter(element_params, 'l', variables)
-                k1 = self.ElementParameter(element_params, 'k1', variables)
-                quad = Quad(element_name, length=length, k1=k1)
-                elements[element_name] = quad
-
-            if element_variables.startswith("sequence"):
-                self.Lattice.Name = element_name
-                length = self.ElementParameter(element_params, 'l', variables)
-                self.Lattice.Length = length
-                refer = self.ElementParameter(element_params, 'refer', variables)
-                if refer is not None and refer != 'center':
-                    raise RuntimeError("MADXParser currently works with coordinates referring to the element center.")
-                in_sequence = True
+        with Profile.Phase("element construction"):
+            # Deferred attributes are only final once the whole file is read, and a columnar
+            # lattice copies the parameters of the elements as they are added
+            placements = list(self.Placements(**kwargs))
+            for element, location in placements:
+                self.Lattice.AddElement(element, measure_length=False)
+        if not self._Streamed:
+            self.Lattice.MeasureLength()
 
         # Associate edges to dipoles after reading in complete lattice
-        non_edge_dipoles = self.Lattice.AssociateDipoleEdges()
+        non_edge_dipoles = self.Lattice.DescribePlacements(self.Lattice.AssociateDipoleEdges())
 
         # Set the lattice length
         if kwargs.get("length", None) != None:
-            self.Length = kwargs.get("length")
+            self.Lattice.Length = kwargs.get("length")
 
         # Insert drifts into lattice
-        if kwargs.get("add_drifts", None) != None:
-            self.Lattice.InsertDrifts(kwargs.get("add_drifts"))
+        self.AddDrifts(**kwargs)
 
         if kwargs.get('verbose'):
             self.ReportParseErrors()
             if non_edge_dipoles:
                 self.ReportParseError(non_edge_dipoles, "Dipoles with no edges in the lattice")
 
-        print('''
+        Log.info("Total lattice length {}m.".format(self.Lattice.Length))
+
+        Log.info('''
 Completed.
 -----------------------------------------------------
 ''')
 
+    # ---------------------------------------------------------------------------
+    def Placements(self, **kwargs):
+        """Generate the placements of a sequence as (element, s) pairs as the statements are read, in one pass.
+
+        The sequence is the one named by beamline (case-insensitive), or else the first in the file; only
+        the element definitions (and any other sequences) are held in memory.  If the file has no such
+        sequence, the named (else the used, else the last) LINE is expanded once the whole file is read.
+        Attributes set with ':=' are evaluated again at the end of the file, when all of the variables
+        they use are known, and the elements already generated are updated."""
+
+        inputFile = kwargs.get('inputFile')
+        beamline = kwargs.get('beamline')
+        self.Lattice.Name = os.path.splitext(os.path.basename(inputFile))[0]
+        self._Selected = beamline.lower() if beamline else None
+
+        for statement in Profile.Iterate("tokenize", self.Statements(inputFile)):
+            placements = self.Statement(statement)
+            if placements:
+                yield from placements
+
+        if not self._Streamed:
+            line = self._Selected or self._Used or self._LastLine
+            if line in self.Beamlines:
+                self.Lattice.Name = line
+                location = 0.
+                for element in self.IterateBeamline(self.Elements, self.Beamlines, line):
+                    yield element, location
+                    location += getattr(element, 'Length', 0.) or 0.
+            elif line is not None:
+                Log.warning("Sequence or line {} is not defined in {}".format(line, inputFile))
+
+        self.ResolveDeferred()
 
     # ---------------------------------------------------------------------------
-    def ElementParameter(self, elements, parameter, variables):
-        value = None
-        for element in elements:
-            if element.startswith(parameter):
-                param_value = element.split(':=')[1].strip() if ':' in element else element.split('=')[1].strip()
-                value = self.VariableValue(param_value, variables)
-        return value
+    def Statements(self, inputFile):
+        """Generate the statements of a file, including those of the files it calls, up to any RETURN."""
+
+        with open(inputFile, 'r') as inFile:
+            for statement in TokenizeMADX(inFile):
+                keyword = statement[:4].lower()
+                if keyword == 'call':
+                    call = _Call.match(statement)
+                    if call is not None:
+                        calledFile = os.path.join(os.path.dirname(inputFile), call.group(1))
+                        if not os.path.isfile(calledFile):
+                            calledFile = call.group(1)
+                        if os.path.isfile(calledFile):
+                            yield from self.Statements(calledFile)
+                        else:
+                            Log.warning("Unable to open called file {}".format(call.group(1)))
+                        continue
+                elif keyword in ('retu', 'stop', 'exit', 'quit') and _Return.match(statement):
+                    return
+                yield statement
 
     # ---------------------------------------------------------------------------
-    def VariableValue(self, parameter, variables):
-        loop_parameter = parameter
-        while loop_parameter in variables:
-            loop_parameter = variables[loop_parameter]
-        return float(loop_parameter)
+    def Statement(self, statement):
+        """Interpret one statement, returning the (element, s) placements it adds to the streamed sequence."""
+
+        prefix = _Prefix.match(statement)
+        if prefix is not None:
+            statement = statement[prefix.end():]
+        text = ''.join(statement.split()).lower()
+
+        head = _Head.match(text)
+        if head is not None:
+            name, attribute, operator, rest = head.groups()
+
+            # Variables and element attributes
+            if operator != ':':
+                if attribute is None:
+                    self.DefineVariable(name, rest, operator == ':=')
+                elif name in self.Definitions:
+                    self.UpdateElement(name, {attribute: (rest, operator == ':=')})
+                return None
+
+            # Labelled statements: elements, lines, sequences and placements
+            if attribute is not None:
+                return None
+            if rest.startswith('line='):
+                self.DefineLine(name, rest[5:])
+                return None
+            fields = _SplitFields(rest)
+            element_class = fields[0]
+            if element_class in Commands or '=' in element_class:
+                return None
+            attributes = _Attributes(fields[1:])
+            if element_class == 'sequence':
+                self.BeginSequence(name, attributes)
+                return None
+            self.DefineElement(name, element_class, attributes)
+            if self._Sequence is not None:
+                return self.Place(name, attributes)
+            return None
+
+        # Unlabelled statements: placements, element updates and commands
+        fields = _SplitFields(text)
+        name = fields[0]
+        if name == 'endsequence':
+            self.EndSequence()
+        elif self._Sequence is not None and (name in self.Definitions or name in self.Sequences):
+            return self.Place(name, _Attributes(fields[1:]))
+        elif name in self.Definitions:
+            self.UpdateElement(name, _Attributes(fields[1:]))
+        elif name == 'use':
+            for attribute, (value, deferred) in _Attributes(fields[1:]).items():
+                if attribute in ('sequence', 'period'):
+                    self._Used = value
+                elif value is None:
+                    self._Used = attribute
+        return None
+
+    # ---------------------------------------------------------------------------
+    def DefineVariable(self, name, expression, deferred):
+        try:
+            self.Variables.Define(name, float(expression))
+            return
+        except ValueError:
+            pass
+        if '->' in expression:
+            expression = self.ReferenceAttributes(expression)
+        try:
+            self.Variables.Define(name, expression, deferred=deferred)
+        except (NameError, ValueError, ArithmeticError):
+            # ExpressionError, and math errors such as sqrt(-1) or 1/0
+            self.InvalidVariables.append("{} {} {}".format(name, ':=' if deferred else '=', expression))
+
+    # ---------------------------------------------------------------------------
+    def ReferenceAttributes(self, expression):
+        """Replace references to element attributes (QF->K1) by variables holding their values."""
+
+        def reference(match):
+            element, attribute = match.groups()
+            if (element, attribute) not in self._Exported:
+                self._Exported.add((element, attribute))
+                self.ExportAttribute(element, attribute)
+            return "{}..{}".format(element, attribute)
+        return _Reference.sub(reference, expression)
+
+    def ExportAttribute(self, element, attribute):
+        definition = self.Attribute(element, attribute)
+        variable = "{}..{}".format(element, attribute)
+        if definition is None or definition[0] is None:
+            self.Variables.Set(variable, 0.)
+        else:
+            self.DefineVariable(variable, definition[0], True)
 
     # ---------------------------------------------------------------------------
+    def Attribute(self, name, attribute):
+        """The (value, deferred) of an element attribute, following the element's parents, or None."""
+
+        while name in self.Definitions:
+            element_class, attributes, parent = self.Definitions[name]
+            if attribute in attributes:
+                return attributes[attribute]
+            name = parent
+        return None
+
+    def AllAttributes(self, name):
+        """The attributes of an element, including those inherited from its parents."""
+
+        chain = []
+        while name in self.Definitions:
+            chain.append(self.Definitions[name][1])
+            name = self.Definitions[name][2]
+        attributes = {}
+        for own in reversed(chain):
+            attributes.update(own)
+        return attributes
+
+    # ---------------------------------------------------------------------------
+    def DefineElement(self, name, element_class, attributes):
+        """Define an element from a class or a parent element.  An element which only inherits (sets none of the
+        attributes read) shares its parent's element, so repeated magnets are not copied."""
+
+        parent = None
+        if element_class in self.Definitions:
+            parent = element_class
+            element_class = self.Definitions[parent][0]
+        self.Definitions[name] = (element_class, attributes, parent)
+
+        if parent is not None and ElementAttributes.keys().isdisjoint(attributes):
+            element = self.Elements.get(parent)
+            self._Aliases[name] = []
+        else:
+            self._Aliases.pop(name, None)
+            element = self.BuildElement(name, element_class, self.AllAttributes(name))
+        if element is not None:
+            self.Elements[name] = element
+        else:
+            self.Elements.pop(name, None)
+
+    # ---------------------------------------------------------------------------
+    def BuildElement(self, name, element_class, attributes):
+        element_type = ElementClasses.get(element_class)
+        if element_type is None and element_class in DriftClasses:
+            element_type = Drift
+        if element_type is None:
+            if element_class not in self.IgnoredElementTypes and element_class != "marker":
+                self.IgnoredElementTypes.append(element_class)
+            return None
+        if element_type is Quad and ('k1s' in attributes or 'tilt' in attributes):
+            element_type = SQuad
+
+        element = element_type(name, length=0.)
+        if element_class == "rbend":
+            element.Sector = False
+        self.SetAttributes(element, attributes)
+
+        if element_class in DriftClasses and not element.Length:
+            return None
+        return element
+
+    # ---------------------------------------------------------------------------
+    def SetAttributes(self, element, attributes):
+        for attribute, (value, deferred) in attributes.items():
+            parameter = ElementAttributes.get(attribute)
+            if parameter is None or value is None or not hasattr(element.__class__, parameter):
+                continue
+            if attribute in _AttributeTypes and not isinstance(element, _AttributeTypes[attribute]):
+                continue
+            if deferred:
+                self._Deferred[(element, attribute)] = value
+                value = self.TryValue(value)
+            else:
+                # A plain assignment replaces any earlier deferred expression of the attribute
+                self._Deferred.pop((element, attribute), None)
+                value = self.Value(value)
+            if value is not None:
+                self.SetAttribute(element, attribute, value)
+
+    def SetAttribute(self, element, attribute, value):
+        """Set an attribute of an element, and return the names of the parameters it changed."""
+
+        if attribute in _QuadAttributes and isinstance(element, SQuad):
+            self.SetQuadAttribute(element, attribute, value)
+            return ('K1', 'Tilt')
+        parameter = ElementAttributes[attribute]
+        setattr(element, parameter, value)
+        if isinstance(element, Dipole) and attribute in ('l', 'angle'):
+            element.K0 = element.Angle/element.Length if element.Length else 0.
+            return (parameter, 'K0')
+        return (parameter,)
+
+    def SetQuadAttribute(self, element, attribute, value):
+        """Set k1, k1s or tilt of a quadrupole read as an SQuad, which holds one strength and tilt: a skew
+        strength alone is a quadrupole tilted by pi/4, and normal and skew strengths together are a quadrupole
+        of their combined strength, tilted by half the angle between them."""
+
+        values = self._QuadAttributes.setdefault(element, {"k1": 0., "k1s": 0., "tilt": 0.})
+        values[attribute] = value
+        k1, k1s, tilt = values["k1"], values["k1s"], values["tilt"]
+        if not k1s:
+            element.K1, element.Tilt = k1, tilt
+        elif not k1:
+            element.K1, element.Tilt = k1s, tilt + math.pi/4.
+        else:
+            element.K1, element.Tilt = math.hypot(k1, k1s), tilt + math.atan2(k1s, k1)/2.
+
+    # ---------------------------------------------------------------------------
+    def UpdateElement(self, name, attributes):
+        """Set attributes of a defined element (QF, K1=...; or QF->K1 = ...;)."""
+
+        element_class, current, parent = self.Definitions[name]
+        self.Definitions[name] = (element_class, dict(current, **attributes), parent)
+
+        if name in self._Aliases:
+            if not ElementAttributes.keys().isdisjoint(attributes):
+                # The element no longer only inherits, so it gets its own element
+                element = self.BuildElement(name, element_class, self.AllAttributes(name))
+                if element is not None:
+                    for placement in self._Aliases.pop(name):
+                        placement.Definition = element
+                    self.Elements[name] = element
+        elif name in self.Elements:
+            self.SetAttributes(self.Elements[name], attributes)
+
+        for attribute in attributes:
+            if (name, attribute) in self._Exported:
+                self.ExportAttribute(name, attribute)
+
+    # ---------------------------------------------------------------------------
+    def Value(self, expression):
+        try:
+            return float(expression)
+        except ValueError:
+            pass
+        if '->' in expression:
+            expression = self.ReferenceAttributes(expression)
+        value = self.EvaluateExpression(expression, self.Variables)
+        return float(value) if value is not None else None
+
+    def TryValue(self, expression):
+        """The value of an expression, or None (without reporting it) if it cannot be evaluated yet."""
+
+        try:
+            return float(expression)
+        except ValueError:
+            pass
+        if '->' in expression:
+            expression = self.ReferenceAttributes(expression)
+        try:
+            expression = CompileExpression(expression)
+            for name in expression.Names:
+                if name not in self.Variables and name not in MathNamespace:
+                    return None
+            return float(expression.Evaluate(self.Variables))
+        except (NameError, ValueError, ArithmeticError, TypeError):
+            return None
+
+    def ResolveDeferred(self, names=None):
+        """Evaluate the deferred attributes of the elements with the final values of the variables.
+
+        The deferred attributes are kept, so that after variables are changed (e.g. a knob, with
+        Variables.Set) the attributes which depend on them are updated by passing their names; the
+        lattice is updated too, if it holds copies of the elements (a columnar lattice)."""
+
+        if names is not None:
+            changed = set(names)
+            for name in names:
+                changed |= self.Variables.Dependents(name)
+
+        updated = {}
+        for (element, attribute), expression in self._Deferred.items():
+            if names is not None and changed.isdisjoint(self.ExpressionNames(expression)):
+                continue
+            value = self.Value(expression)
+            if value is not None:
+                updated.setdefault(element, set()).update(self.SetAttribute(element, attribute, value))
+
+        if names is not None and updated:
+            self.UpdateLattice(updated)
+
+    def ExpressionNames(self, expression):
+        """The names of the variables an expression uses (all of them, if it cannot be parsed)."""
+
+        try:
+            float(expression)
+            return ()
+        except ValueError:
+            pass
+        if '->' in expression:
+            expression = self.ReferenceAttributes(expression)
+        try:
+            return CompileExpression(expression).Names
+        except ExpressionError:
+            return self.Variables
+
+    def UpdateLattice(self, updated):
+        """Copy the changed parameters of elements (element -> parameter names) to the definitions of the lattice
+        that are copies of them."""
+
+        parameters = {element.Name: (element, names) for element, names in updated.items()}
+        copied = set()
+        for stored in self.Lattice.Elements.values():
+            definition = stored.Definition
+            element, names = parameters.get(definition.Name, (None, ()))
+            if element is None or definition is element or definition in copied:
+                continue
+            copied.add(definition)
+            for parameter in names:
+                setattr(definition, parameter, getattr(element, parameter))
+
+    # ---------------------------------------------------------------------------
+    def DefineLine(self, name, items):
+        """Define a LINE from its parenthesized list of items.  Anonymous sub-lines (e.g. 2*(A,B))
+        become lines of their own, named after the line."""
+
+        if items.startswith('(') and items.endswith(')'):
+            items = items[1:-1]
+        line = []
+        for item in _SplitFields(items):
+            group = _Group.match(item) if '(' in item else None
+            if group is not None:
+                sub_line = "{}({})".format(name, len(line))
+                self.DefineLine(sub_line, group.group(3))
+                item = "{}{}{}".format(group.group(1) or '', group.group(2) + '*' if group.group(2) else '', sub_line)
+            if item:
+                line.append(item)
+        self.Beamlines[name] = line
+        if '(' not in name:
+            self._LastLine = name
+
+    # ---------------------------------------------------------------------------
+    def BeginSequence(self, name, attributes):
+        refer = attributes.get('refer', ('centre', False))[0]
+        if refer not in ReferOffsets:
+            Log.warning("Unknown REFER={} for sequence {}; using CENTRE".format(refer, name))
+            refer = 'centre'
+        length = self.Value(attributes['l'][0]) if 'l' in attributes else None
+        refpos = attributes.get('refpos', (None, False))[0]
+
+        stream = not self._Streamed and self._Selected in (None, name)
+        self._Sequence = _Sequence(name, length or 0., ReferOffsets[refer], refpos, not stream)
+        if stream:
+            self._Streamed = True
+            self.Lattice.Name = name
+            self.Lattice.Length = length
+
+    def EndSequence(self):
+        sequence = self._Sequence
+        if sequence is None:
+            return
+        if sequence.Placements is not None:
+            self.Sequences[sequence.Name] = sequence
+        elif not self.Lattice.Length:
+            # A streamed sequence without L ends at its last placement
+            self.Lattice.Length = sequence.Location
+        self._Sequence = None
+
+    # ---------------------------------------------------------------------------
+    def Place(self, name, attributes):
+        """Place an element (or a sequence) in the current sequence at its AT (and FROM) position."""
+
+        sequence = self._Sequence
+        at = self.Value(attributes['at'][0]) if attributes.get('at', (None,))[0] is not None else None
+        origin = attributes.get('from', (None,))[0]
+        if at is not None and origin is not None:
+            if origin == '#s':
+                pass
+            elif origin == '#e':
+                at += sequence.Length
+            elif origin in sequence.Positions:
+                at += sequence.Positions[origin]
+            else:
+                Log.warning("Element {} is placed from {}, which is not in sequence {}".format(name, origin, sequence.Name))
+
+        if name in self.Sequences:
+            return self.PlaceSequence(self.Sequences[name], at)
+
+        element = self.Elements.get(name)
+        length = getattr(element, 'Length', 0.) or 0.
+        start = sequence.Location if at is None else at - sequence.Refer*length
+        sequence.Positions[name] = start + sequence.Refer*length
+        sequence.Location = start + length
+        if element is None:
+            if name not in self._IgnoredNames:
+                self._IgnoredNames.add(name)
+                self.IgnoredElements.append(name)
+            return None
+
+        placement = Placement(name, element, center=start + length/2.)
+        if name in self._Aliases:
+            self._Aliases[name].append(placement)
+        if sequence.Placements is not None:
+            sequence.Placements.append(placement)
+            return None
+        return ((placement, start),)
+
+    def PlaceSequence(self, subsequence, at):
+        """Place the elements of a sequence read earlier, positioned by its REFPOS element if it has one."""
+
+        sequence = self._Sequence
+        if subsequence.RefPos in subsequence.Positions:
+            reference = subsequence.Positions[subsequence.RefPos]
+        else:
+            reference = sequence.Refer*subsequence.Length
+        start = sequence.Location if at is None else at - reference
+        sequence.Positions[subsequence.Name] = start + reference
+        sequence.Location = start + subsequence.Length
+
+        placements = []
+        for placement in subsequence.Placements:
+            moved = Placement(placement.Name, placement, center=placement.Center + start)
+            if placement.Name in self._Aliases:
+                self._Aliases[placement.Name].append(moved)
+            placements.append(moved)
+        if sequence.Placements is not None:
+            sequence.Placements.extend(placements)
+            return None
+        return [(placement, placement.Center - (getattr(placement, 'Length', 0.) or 0.)/2.) for placement in placements]
+
+    # ---------------------------------------------------------------------------
+    @Instrument("write")
     def WriteLattice(self, **kwargs):
 
         if 'outputFile' in kwargs and kwargs.get('outputFile') is not None:
@@ -164,80 +753,88 @@ Completed.
             outputFile = "{}.seq".format(self.Lattice.Name)
         beamline = kwargs.get('beamline')
 
-        print('''
+        Log.info('''
 -----------------------------------------------------
 Writing lattice in MAD-X format to\n{}
 '''.format(outputFile))
 
         outFile = open(outputFile, 'w')
-        outFile.write('''
+        self.WriteText(outFile, self.FormatLattice(beamline=beamline, layout=kwargs.get('layout')))
+        outFile.close()
+        Log.info('''
+Completed.
+-----------------------------------------------------
+''')
+
+    # ---------------------------------------------------------------------------
+    def FormatLattice(self, **kwargs):
+        """Generate the text of the MAD-X sequence file."""
+
+        layout = self.Layout(**kwargs)
+        # Placements sharing a definition are written as named placements of it
+        groups, definitions = SharedDefinitions(layout.Groups)
+        yield '''
 ! Written by LatticeConvert. \n! {}\n
-'''.format(datetime.now()))
+'''.format(datetime.now())
 
         # Write drifts
-        outFile.write('! Drifts\n')
-        for drift in self.Lattice.Drifts:
-            self.Lattice.Drifts[drift].WriteMADX(outFile)
-        outFile.write('\n')
+        yield '! Drifts\n'
+        for drift in groups["Drifts"]:
+            yield drift.FormatMADX()
+        yield '\n'
 
         # Write dipoles
-        outFile.write('! Dipoles\n')
-        for dipole in self.Lattice.Dipoles:
-            self.Lattice.Dipoles[dipole].WriteMADX(outFile)
-        outFile.write('\n')
+        yield '! Dipoles\n'
+        for dipole in groups["Dipoles"]:
+            yield dipole.FormatMADX()
+        yield '\n'
 
         # Write quads
-        outFile.write('! Quads\n')
-        for quad in self.Lattice.Quads:
-            self.Lattice.Quads[quad].WriteMADX(outFile)
-        outFile.write('\n')
+        yield '! Quads\n'
+        for quad in groups["Quads"]:
+            yield quad.FormatMADX()
+        yield '\n'
 
         # Write skew quads
-        outFile.write('! Skew quads\n')
-        for squad in self.Lattice.SkewQuads:
-            self.Lattice.SkewQuads[squad].WriteMADX(outFile)
-        outFile.write('\n')
+        yield '! Skew quads\n'
+        for squad in groups["SkewQuads"]:
+            yield squad.FormatMADX()
+        yield '\n'
 
         # Write sextupoles
-        outFile.write('! Sextupoles\n')
-        for sext in self.Lattice.Sexts:
-            self.Lattice.Sexts[sext].WriteMADX(outFile)
-        outFile.write('\n')
-            
+        yield '! Sextupoles\n'
+        for sext in groups["Sexts"]:
+            yield sext.FormatMADX()
+        yield '\n'
+
         # Write octupoles
-        outFile.write('! Octupoles\n')
-        for octu in self.Lattice.Octus:
-            self.Lattice.Octus[octu].WriteMADX(outFile)
-        outFile.write('\n')
+        yield '! Octupoles\n'
+        for octu in groups["Octus"]:
+            yield octu.FormatMADX()
+        yield '\n'
 
         # Write RF
-        outFile.write('! RF\n')
-        for rf in self.Lattice.RF:
-            self.Lattice.RF[rf].WriteMADX(outFile)
-        outFile.write('\n')
+        yield '! RF\n'
+        for rf in groups["RF"]:
+            yield rf.FormatMADX()
+        yield '\n'
 
         # Write other stuff
-        outFile.write('! Others\n')
-        for solenoid in self.Lattice.Solenoids:
-            self.Lattice.Solenoids[solenoid].WriteMADX(outFile)
-        outFile.write('\n')
+        yield '! Others\n'
+        for solenoid in groups["Solenoids"]:
+            yield solenoid.FormatMADX()
+        yield '\n'
 
         # Write lattice
-        outFile.write('! Lines\n')
-        outFile.write("{}: SEQUENCE, L={}, REFER=ENTRY;\n".format(beamline, self.Lattice.Length))
-        for i,element in enumerate(self.Lattice.Sequence):
-            if element in self.Lattice.DipoleEdges:
-                continue
-            location = self.Lattice.Locations[element][self.Lattice.Sequence[:i].count(element)]
-            if element in self.Lattice.Dipoles:
-                outFile.write("IN{}, AT={};\n{}, AT={};\nOUT{}, AT={};\n"
-                              .format(element, location, element, location, element, location+self.Lattice.Dipoles[element].Length))
+        yield '! Lines\n'
+        yield "{}: SEQUENCE, L={}, REFER=ENTRY;\n".format(kwargs.get('beamline'), layout.Length)
+        dipoles = layout.Dipoles
+        for element, location in layout.Beamline:
+            definition = definitions.get(element, element)
+            placement = element if definition == element else "{}: {}".format(element, definition)
+            if element in dipoles:
+                yield ("IN{}, AT={};\n{}, AT={};\nOUT{}, AT={};\n"
+                       .format(definition, location, placement, location, definition, location+dipoles[element].Length))
             else:
-                outFile.write("{}, AT={};\n".format(element, location))
-        outFile.write("ENDSEQUENCE;")
-
-        outFile.close()
-        print('''
-Completed.
------------------------------------------------------
-''')
+                yield "{}, AT={};\n".format(placement, location)
+        yield "ENDSEQUENCE;"
@@ -6,158 +6,54 @@
 # July 2023
 
 import os
+import re
+import math
+import mmap
 from LatticeParser import LatticeParser
+from LatticeParallel import ParseChunks, WorkerCount
 from LatticeData import *
+from LatticeLog import Log
+from LatticeProfile import Profile, Instrument
 from datetime import datetime
 
+# Section headers, as they are matched once stripped
+_SectionHeader = re.compile(rb'^[ \t\r\f\v]*(INFO:|ELEMENTS:|LATTICE:|END)[ \t\r\f\v]*$', re.MULTILINE)
+
+# ---------------------------------------------------------------------------
+def ElementSections(inputFile):
+    """Byte ranges of the ELEMENTS sections of a 6DSim file, in file order."""
+
+    sections = []
+    with open(inputFile, 'rb') as inFile:
+        if not os.fstat(inFile.fileno()).st_size:
+            return sections
+        with mmap.mmap(inFile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            headers = list(_SectionHeader.finditer(data))
+            for header, following in zip(headers, headers[1:] + [None]):
+                if header.group(1) == b'ELEMENTS:':
+                    sections.append((header.end(), following.start() if following is not None else len(data)))
+    return sections
+
 # ---------------------------------------------------------------------------
 class SixDSimParser(LatticeParser):
     def __init__(self, **kwargs):
-        LatticeParser.__init__(self)
+        LatticeParser.__init__(self, **kwargs)
 
     # ---------------------------------------------------------------------------
+    @Instrument("parse")
     def ParseInput(self, **kwargs):
         inputFile = kwargs.get('inputFile')
-        print('''
+        Log.info('''
 -----------------------------------------------------
 Importing lattice in 6DSim format from\n{}
 '''.format(inputFile))
         
-        self.Lattice.Name = os.path.basename(inputFile).strip('.6ds')
-
-        mode = ''
-        variables = {}
-        elements = {}
-
-        for line in open(inputFile, 'r'):
-            line = line.strip()
-            if line.startswith('//'): continue
-
-            # Set mode
-            if line == "INFO:":
-                mode = 'INFO'
-                continue
-            if line == "ELEMENTS:":
-                mode = 'ELEMENTS'
-                continue
-            if line == "LATTICE:":
-                mode = 'LATTICE'
-                continue
-            if line == "END":
-                mode = 'END'
-                break
-
-            # Variables
-            if mode == 'INFO' and line.startswith('$'):
-                line_split = line.split('=')
-                if '$' in line_split[1]:
-                    line_split[1] = self.ExpandExpression(line_split[1], variables)
-                variables[line_split[0].strip()] = self.SolveExpression(line_split[1])
-
-            # Add variables
-            if mode != 'INFO':
-                if '$c' not in variables:
-                    print('INFO (SixDSimParser): Adding \'$c\' = 2.99792458E10 to variables')
-                    variables['$c'] = 2.99792458E10
-                if '$rigidity' not in variables:
-                    if '$pc' not in variables:
-                        print("ERROR (SixDSimParser): momentum ($pc) not found in variable list")
-                        exit()
-                variables['rigidity'] = (variables['$pc']*1.e6) / (variables['$c']*1e-2)
-
-            # Elements
-            if mode == 'ELEMENTS' and line.startswith('ID'):
-                line_split = line.split()
-                element_name = line_split[1]
-                element_type = line_split[2]
-
-                if element_type == "Gap":
-                    length = self.ElementParameter(line_split, 'L', variables) * 0.01
-                    drift = Drift(element_name, length=length)
-                    elements[element_name] = drift
-
-                elif element_type == "Dipole":
-                    length = self.ElementParameter(line_split, 'L', variables) * 0.01
-                    curvature = self.ElementParameter(line_split, 'Hy', variables)
-                    # convert kG to SI and normalize
-                    k0 = curvature * 1.e-1 / variables['rigidity']
-                    gradient = self.ElementParameter(line_split, 'G', variables)
-                    # convert kG/cm to SI and normalize
-                    k1 = gradient * 1.e1 / variables['rigidity'] if gradient else 0.
-                    inA = self.ElementParameter(line_split, 'inA', variables)
-                    outA = self.ElementParameter(line_split, 'outA', variables)
-                    gap = self.ElementParameter(line_split, 'poleGap', variables)
-                    if gap: gap *= 0.01
-                    fringek = self.ElementParameter(line_split, 'fringeK', variables)
-                    if fringek: fringek /= 2.
-                    dipole = Dipole(element_name, length=length, k0=k0, k1=k1, gap=gap, fringek=fringek)
-                    elements[element_name] = dipole
-
-                elif element_type == "DipEdge":
-                    curvature = self.ElementParameter(line_split, 'Hy', variables)
-                    gap = self.ElementParameter(line_split, 'poleGap', variables)
-                    if gap: gap *= 0.01
-                    inA = self.ElementParameter(line_split, 'inA', variables)
-                    fringek = self.ElementParameter(line_split, 'fringeK', variables)
-                    if fringek: fringek /= 2.
-                    dipedge = DipoleEdge(element_name, angle=curvature, gap=gap, fringek=fringek)
-                    elements[element_name] = dipedge
-
-                elif element_type == "Quad":
-                    length = self.ElementParameter(line_split, 'L', variables) * 0.01
-                    gradient = self.ElementParameter(line_split, 'G', variables)
-                    # convert kG/cm to SI and normalize
-                    k1 = gradient * 1.e1 / variables['rigidity']
-                    quad = Quad(element_name, length=length, k1=k1)
-                    elements[element_name] = quad
-
-                elif element_type == "SQuad":
-                    length = self.ElementParameter(line_split, 'L', variables) * 0.01
-                    gradient = self.ElementParameter(line_split, 'G', variables)
-                    k1 = gradient * 1.e1 / variables['rigidity']
-                    angle = self.ElementParameter(line_split, 'rotA', variables)
-                    squad = SQuad(element_name, length=length, k1=k1, angle=angle)
-                    elements[element_name] = squad
-
-                elif element_type == "Mult":
-                    length = self.ElementParameter(line_split, 'L', variables) * 0.01
-
-                    if 'M2N' in line_split:
-                        gradient = self.ElementParameter(line_split, 'M2N', variables)
-                        # convert kG/cm2 to SI and normalize
-                        k2 = gradient * 1.e3 / variables['rigidity']
-                        sext = Sext(element_name, length=length, k2=k2)
-                        elements[element_name] = sext
-
-                    elif 'M3N' in line_split:
-                        gradient = self.ElementParameter(line_split, 'M3N', variables)
-                        # convert kG/cm3 to SI and normalize
-                        k3 = gradient * 1.e5 / variables['rigidity']
-                        octu = Octu(element_name, length=length, k3=k3)
-                        elements[element_name] = octu
-
-                elif element_type == "Acc":
-                    length = self.ElementParameter(line_split, 'L', variables) * 0.01
-                    energy = self.ElementParameter(line_split, 'U', variables)
-                    frequency = self.ElementParameter(line_split, 'F', variables)
-                    rf = RF(element_name, length=length, energy=energy, frequency=frequency)
-                    elements[element_name] = rf
-
-                else:
-                    if element_type not in self.IgnoredElementTypes:
-                        self.IgnoredElementTypes.append(element_type)
-
-            # Lattice
-            if mode == 'LATTICE':
-                line_split = line.split()
-                for lattice_element in line_split:
-                    if lattice_element in elements:
-                        self.Lattice.AddElement(elements[lattice_element])
-                    else:
-                        self.IgnoredElements.append(lattice_element)
+        with Profile.Phase("element construction"):
+            for element, location in self.Placements(**kwargs):
+                self.Lattice.AddElement(element)
 
         # Associate edges to dipoles after reading in complete lattice
-        non_edge_dipoles = self.Lattice.AssociateDipoleEdges()
+        non_edge_dipoles = self.Lattice.DescribePlacements(self.Lattice.AssociateDipoleEdges())
 
         # Measure the length of the lattice
         self.Lattice.MeasureLength()
@@ -168,26 +64,202 @@ Importing lattice in 6DSim format from\n{}
             if non_edge_dipoles:
                 self.ReportParseError(non_edge_dipoles, "Dipoles with no edges in the lattice")
 
-        print("Total lattice length {}m.".format(self.Lattice.Length))
+        Log.info("Total lattice length {}m.".format(self.Lattice.Length))
 
-        print('''
+        Log.info('''
 Completed.
 -----------------------------------------------------
 ''')
 
+    # ---------------------------------------------------------------------------
+    def Placements(self, **kwargs):
+        """Generate the placements of the LATTICE section as (element, s) pairs as they are read,
+        without building the lattice.  Only the element definitions are held in memory.
+        With more than one parse worker, the ELEMENTS sections are parsed in chunks on a pool
+        of processes (see LatticeParallel), with the same result."""
+
+        inputFile = kwargs.get('inputFile')
+        self.Lattice.Name = os.path.basename(inputFile).strip('.6ds')
+
+        mode = ''
+        variables = {}
+        elements = {}
+
+        workers = WorkerCount(kwargs.get('parse_workers'))
+        sections = iter(ElementSections(inputFile) if workers > 1 else [])
+        parallel = False
+
+        location = 0.
+        with open(inputFile, 'r') as inFile:
+            for line in inFile:
+                line = line.strip()
+                if line.startswith('//'): continue
+
+                # Set mode
+                if line == "INFO:":
+                    mode = 'INFO'
+                    continue
+                if line == "ELEMENTS:":
+                    mode = 'ELEMENTS'
+                    section = next(sections, None)
+                    parallel = section is not None
+                    if parallel:
+                        self.AddVariables(variables)
+                        for chunk in ParseChunks(self, "ReadElements", inputFile, *section, workers,
+                                                 arguments=(variables,)):
+                            elements.update(chunk)
+                    continue
+                if line == "LATTICE:":
+                    mode = 'LATTICE'
+                    continue
+                if line == "END":
+                    mode = 'END'
+                    break
+
+                # Variables
+                if mode == 'INFO' and line.startswith('$'):
+                    line_split = line.split('=')
+                    variables[line_split[0].strip()] = self.EvaluateExpression(line_split[1], variables)
+
+                # Add variables
+                if mode != 'INFO':
+                    self.AddVariables(variables)
+
+                # Elements (parsed separately when in parallel)
+                if mode == 'ELEMENTS' and line.startswith('ID') and not parallel:
+                    self.DefineElement(line.split(), variables, elements)
+
+                # Lattice
+                if mode == 'LATTICE':
+                    line_split = line.split()
+                    for lattice_element in line_split:
+                        if lattice_element in elements:
+                            element = elements[lattice_element]
+                            yield element, location
+                            location += getattr(element, 'Length', 0.)
+                        else:
+                            self.IgnoredElements.append(lattice_element)
+
+    # ---------------------------------------------------------------------------
+    def AddVariables(self, variables):
+        """Add the speed of light (if not given) and the rigidity to the variables of the INFO section."""
+
+        if '$c' not in variables:
+            Log.info('INFO (SixDSimParser): Adding \'$c\' = 2.99792458E10 to variables')
+            variables['$c'] = 2.99792458E10
+        if '$rigidity' not in variables:
+            if '$pc' not in variables:
+                raise RuntimeError("Momentum ($pc) not found in the 6DSim variable list.")
+        variables['rigidity'] = (variables['$pc']*1.e6) / (variables['$c']*1e-2)
+
+    # ---------------------------------------------------------------------------
+    def DefineElement(self, line_split, variables, elements):
+        """Build the element of an 'ID name type ...' line of the ELEMENTS section."""
+
+        element_name = line_split[1]
+        element_type = line_split[2]
+
+        if element_type == "Gap":
+            length = self.ElementParameter(line_split, 'L', variables) * 0.01
+            drift = Drift(element_name, length=length)
+            elements[element_name] = drift
+
+        elif element_type == "Dipole":
+            length = self.ElementParameter(line_split, 'L', variables) * 0.01
+            curvature = self.ElementParameter(line_split, 'Hy', variables)
+            # convert kG to SI and normalize
+            k0 = curvature * 1.e-1 / variables['rigidity']
+            gradient = self.ElementParameter(line_split, 'G', variables)
+            # convert kG/cm to SI and normalize
+            k1 = gradient * 1.e1 / variables['rigidity'] if gradient else 0.
+            inA = self.ElementParameter(line_split, 'inA', variables)
+            outA = self.ElementParameter(line_split, 'outA', variables)
+            gap = self.ElementParameter(line_split, 'poleGap', variables)
+            if gap: gap *= 0.01
+            fringek = self.ElementParameter(line_split, 'fringeK', variables)
+            if fringek: fringek /= 2.
+            dipole = Dipole(element_name, length=length, k0=k0, k1=k1, gap=gap, fringek=fringek)
+            elements[element_name] = dipole
+
+        elif element_type == "DipEdge":
+            curvature = self.ElementParameter(line_split, 'Hy', variables)
+            gap = self.ElementParameter(line_split, 'poleGap', variables)
+            if gap: gap *= 0.01
+            inA = self.ElementParameter(line_split, 'inA', variables)
+            fringek = self.ElementParameter(line_split, 'fringeK', variables)
+            if fringek: fringek /= 2.
+            dipedge = DipoleEdge(element_name, angle=curvature, gap=gap, fringek=fringek)
+            elements[element_name] = dipedge
+
+        elif element_type == "Quad":
+            length = self.ElementParameter(line_split, 'L', variables) * 0.01
+            gradient = self.ElementParameter(line_split, 'G', variables)
+            # convert kG/cm to SI and normalize
+            k1 = gradient * 1.e1 / variables['rigidity']
+            quad = Quad(element_name, length=length, k1=k1)
+            elements[element_name] = quad
+
+        elif element_type == "SQuad":
+            length = self.ElementParameter(line_split, 'L', variables) * 0.01
+            gradient = self.ElementParameter(line_split, 'G', variables)
+            k1 = gradient * 1.e1 / variables['rigidity']
+            # rotation angle is given in degrees
+            tilt = math.radians(self.ElementParameter(line_split, 'rotA', variables))
+            squad = SQuad(element_name, length=length, k1=k1, tilt=tilt)
+            elements[element_name] = squad
+
+        elif element_type == "Mult":
+            length = self.ElementParameter(line_split, 'L', variables) * 0.01
+
+            if 'M2N' in line_split:
+                gradient = self.ElementParameter(line_split, 'M2N', variables)
+                # convert kG/cm2 to SI and normalize
+                k2 = gradient * 1.e3 / variables['rigidity']
+                sext = Sext(element_name, length=length, k2=k2)
+                elements[element_name] = sext
+
+            elif 'M3N' in line_split:
+                gradient = self.ElementParameter(line_split, 'M3N', variables)
+                # convert kG/cm3 to SI and normalize
+                k3 = gradient * 1.e5 / variables['rigidity']
+                octu = Octu(element_name, length=length, k3=k3)
+                elements[element_name] = octu
+
+        elif element_type == "Acc":
+            length = self.ElementParameter(line_split, 'L', variables) * 0.01
+            energy = self.ElementParameter(line_split, 'U', variables)
+            frequency = self.ElementParameter(line_split, 'F', variables)
+            rf = RF(element_name, length=length, energy=energy, frequency=frequency)
+            elements[element_name] = rf
+
+        else:
+            if element_type not in self.IgnoredElementTypes:
+                self.IgnoredElementTypes.append(element_type)
+
+    # ---------------------------------------------------------------------------
+    def ReadElements(self, lines, variables):
+        """Build the element definitions of the lines of an ELEMENTS section (or of a part of it)."""
+
+        elements = {}
+        for line in lines:
+            line = line.strip()
+            if line.startswith('ID'):
+                self.DefineElement(line.split(), variables, elements)
+        return elements
+
     # ---------------------------------------------------------------------------
     def ElementParameter(self, line, parameter, variables):
         value = 0 #Default to zero since 6Dsim does not require input values
         try:
             index = line.index(parameter)
-            value_str = self.ExpandExpression(line[index+1], variables)
-            value = self.SolveExpression(value_str)
+            value = self.EvaluateExpression(line[index+1], variables)
         except ValueError:
             self.MissingParameters.append("Parameter {} not found for element {} ({})"
                                           .format(parameter, line[1], line[2]))
         return value
 
     # ---------------------------------------------------------------------------
+    @Instrument("write")
     def WriteLattice(self, **kwargs):
 
         if 'outputFile' in kwargs and kwargs.get('outputFile') is not None:
@@ -195,21 +267,29 @@ Completed.
         else:
             outputFile = "{}.6ds".format(self.Lattice.Name)
 
-        print('''
+        Log.info('''
 -----------------------------------------------------
 Writing lattice in 6DSim format to\n{}
 '''.format(outputFile))
 
         outFile = open(outputFile, 'w')
-        outFile.write('''
+        self.WriteText(outFile, self.FormatLattice(**kwargs))
+        outFile.close()
+
+    # ---------------------------------------------------------------------------
+    def FormatLattice(self, **kwargs):
+        """Generate the text of the 6DSim lattice file."""
+
+        layout = self.Layout(**kwargs)
+        yield '''
 // Written by LatticeConvert. \n// {}\n
-'''.format(datetime.now()))
+'''.format(datetime.now())
 
-        outFile.write('''
+        yield '''
 // LatticeConvert is not fully ready to produce complete 6DSim files.
 // Currently the output consists of unnormalized gradients which can
 // be used to modify an existing 6DSim lattice file.\n\n
-''')
+'''
 
         # Hard-code for now, 150 MeV
         rigidity = 150.e6 / 2.99792458E8
@@ -217,10 +297,8 @@ Writing lattice in 6DSim format to\n{}
         kRB = 0.016449
 
         # Write quads
-        outFile.write('// Quads\n')
-        for quad in self.Lattice.Quads:
-            q = self.Lattice.Quads[quad]
+        yield '// Quads\n'
+        for q in layout.Groups["Quads"]:
             gradient = q.K1*rigidity/1.e1
-            outFile.write("ID: {} QUAD L {} G {} (kASQA: {}, kRB: {})\n".format(q.Name, q.Length/0.01, gradient, gradient/kASQA, gradient/kRB))
-        outFile.write('\n')
-
+            yield "ID: {} QUAD L {} G {} (kASQA: {}, kRB: {})\n".format(q.Name, q.Length/0.01, gradient, gradient/kASQA, gradient/kRB)
+        yield '\n'
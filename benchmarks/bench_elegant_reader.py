@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# bench_elegant_reader.py
+#
+# Throughput of the ELEGANT statement tokenizer, in lines per second, compared
+# with the line splitting and parameter scanning used by the previous reader.
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ElegantParser import TokenizeElegant
+
+def write_synthetic_lte(fileName, n_elements):
+    with open(fileName, 'w') as outFile:
+        outFile.write("! Synthetic lattice for benchmarking\n")
+        for i in range(n_elements):
+            kind = i % 4
+            if kind == 0:
+                outFile.write("D{}: DRIF, L={}\n".format(i, 0.1 + i*1e-6))
+            elif kind == 1:
+                outFile.write("Q{}: KQUAD, L=0.2, K1={}, N_SLICES=10, &\n    SYNCH_RAD=1 ! focusing\n".format(i, 1.5 - i*1e-6))
+            elif kind == 2:
+                outFile.write("\"B{}\": CSBEND, L=1.0, ANGLE=0.1, K1=0.0, E1=0.05, E2=0.05, HGAP=0.01, FINT=0.5\n".format(i))
+            else:
+                outFile.write("S{}: KSEXT, L=0.1, K2={}\n".format(i, 3.0 + i*1e-6))
+
+def legacy_reader(fileName):
+    """The reader replaced by TokenizeElegant: manual splitting and a startswith scan per parameter."""
+
+    def parameter(params, key):
+        value = None
+        for param in params:
+            if param.startswith(key):
+                value = float(param.split('=')[1].strip().strip(','))
+        return value
+
+    line_buffer = ''
+    for line in open(fileName, 'r'):
+        lte_line = line.strip()
+        if not lte_line or lte_line.startswith('!'): continue
+        if lte_line.endswith('&'):
+            line_buffer += lte_line.strip('&')
+            continue
+        if line_buffer:
+            lte_line = line_buffer + lte_line
+            line_buffer = ''
+        line_split = lte_line.split(':')
+        element_name = line_split[0].strip().strip('\"')
+        element_params = [e.strip() for e in line_split[1].strip().split(',')[1:]]
+        for key in ('L', 'ANGLE', 'K1', 'K2', 'E1', 'E2', 'HGAP', 'FINT'):
+            parameter(element_params, key)
+
+def tokenizer_reader(fileName):
+    with open(fileName, 'r') as inFile:
+        for name, element_type, params in TokenizeElegant(inFile):
+            for key in ('L', 'ANGLE', 'K1', 'K2', 'E1', 'E2', 'HGAP', 'FINT'):
+                params.get(key)
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_elegant_reader",
+                                     description="Compare ELEGANT reader throughput.")
+    parser.add_argument('-n', '--n_elements', type=int, default=200000)
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    config = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        fileName = os.path.join(directory, "synthetic.lte")
+        write_synthetic_lte(fileName, config.n_elements)
+        n_lines = sum(1 for line in open(fileName, 'r'))
+        for label, reader in (("legacy", legacy_reader), ("tokenizer", tokenizer_reader)):
+            best = min(timed(reader, fileName) for i in range(config.repeat))
+            print("{:10s} {:10d} lines  {:8.3f} s  {:12.0f} lines/s".format(label, n_lines, best, n_lines/best))
+
+def timed(reader, fileName):
+    start = time.perf_counter()
+    reader(fileName)
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# bench_interning.py
+#
+# Definition interning on a 6DSim-style lattice in which every magnet has its
+# own definition but the magnets come in a few families, with gaps between
+# them filled by InsertDrifts.  Reports the time of the interning pass, the
+# definitions left and the size of the ELEGANT and MAD-X files written before
+# and after, for object and columnar lattices and with or without keeping the
+# placement names, and checks that the lattice is unchanged.
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from SixDSimParser import SixDSimParser
+from ElegantParser import ElegantParser
+from MADXParser import MADXParser
+from LatticeColumns import ColumnarLattice
+from LatticeCompare import CompareLattices
+from LatticeLog import ConfigureLogging
+
+def write_families_6ds(fileName, n_elements, n_families=8):
+    """Quads and sextupoles of a few families, each magnet with its own definition."""
+
+    with open(fileName, 'w') as outFile:
+        outFile.write("INFO:\n$pc = 8000.\nELEMENTS:\n")
+        for i in range(n_elements):
+            family = i % n_families
+            if i % 2:
+                outFile.write("ID q{} Quad L {} G {}\n".format(i, 20. + family, 0.1*(family - n_families/2.)))
+            else:
+                outFile.write("ID s{} Mult L 10 M2N {}\n".format(i, 0.01*family))
+        outFile.write("LATTICE:\n")
+        for i in range(0, n_elements, 10):
+            outFile.write(" ".join(("s", "q")[j % 2] + str(j) for j in range(i, min(i + 10, n_elements))) + "\n")
+        outFile.write("END\n")
+
+def load(fileName, columnar):
+    parser = SixDSimParser()
+    parser.ParseInput(inputFile=fileName)
+    lattice = parser.Lattice
+    # Place the magnets 30 cm apart, leaving gaps for InsertDrifts
+    lattice.Locations = {name: [0.3*index] for index, name in enumerate(lattice.Sequence)}
+    lattice.Length = 0.3*len(lattice.Sequence)
+    lattice.InsertDrifts("end")
+    return ColumnarLattice.FromLattice(lattice) if columnar else lattice
+
+def output_sizes(lattice, directory):
+    sizes = []
+    for parserClass, extension in ((ElegantParser, ".lte"), (MADXParser, ".seq")):
+        fileName = os.path.join(directory, "output" + extension)
+        parser = parserClass()
+        parser.LoadLattice(lattice)
+        parser.WriteLattice(outputFile=fileName, beamline="ring")
+        sizes.append(os.path.getsize(fileName))
+    return sizes
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_interning", description="Measure definition interning.")
+    parser.add_argument('-n', '--n_elements', type=int, default=200000)
+    config = parser.parse_args()
+    ConfigureLogging(quiet=True)
+
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        fileName = os.path.join(directory, "families.6ds")
+        write_families_6ds(fileName, config.n_elements)
+        for columnar, keep_names in ((False, False), (False, True), (True, False), (True, True)):
+            lattice = load(fileName, columnar)
+            reference = load(fileName, columnar)
+            definitions = len(lattice.Elements)
+            before = output_sizes(lattice, directory)
+            start = time.perf_counter()
+            lattice.InternDefinitions(keep_names=keep_names)
+            seconds = time.perf_counter() - start
+            after = output_sizes(lattice, directory)
+            same = not CompareLattices(reference, lattice)
+            failed = failed or not same
+            print("{:8s} keep_names={:1d}  {:8.3f} s  definitions {:7d} -> {:7d}  "
+                  "elegant {:6.2f} -> {:6.2f} MB  madx {:6.2f} -> {:6.2f} MB  {}"
+                  .format("columnar" if columnar else "objects", keep_names, seconds, definitions,
+                          len({element.Definition for element in lattice.Elements.values()}),
+                          before[0]/1e6, after[0]/1e6, before[1]/1e6, after[1]/1e6,
+                          "same" if same else "DIFFERENT"))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# bench_madx_reader.py
+#
+# Throughput of the MAD-X reader on a synthetic machine file in the style of
+# large machine descriptions: class definitions, a sequence of inheriting
+# placements (some spanning lines, some placed FROM another element), comments,
+# and strengths set with deferred expressions in a file called after the
+# sequence.  Reports statements per second for the tokenizer alone, and
+# placements per second for the single-pass reader and for building the lattice.
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from MADXParser import MADXParser, TokenizeMADX
+from LatticeLog import ConfigureLogging
+
+# Placements per cell
+CellSize = 6
+
+def write_machine_madx(fileName, n_elements):
+    n_cells = max(1, n_elements // CellSize)
+    cell_length = 50.
+    strengthFile = os.path.join(os.path.dirname(fileName), "strengths.madx")
+    with open(fileName, 'w') as outFile:
+        outFile.write("/* Synthetic machine description,\n   {} cells */\n".format(n_cells))
+        outFile.write("const real lmb = 14.3;  // dipole length\n")
+        outFile.write("mb: sbend, l=lmb, angle:=ab, e1:=ab/2, e2:=ab/2, hgap=0.025, fint=0.5;\n")
+        outFile.write("mq: quadrupole, l=3.1;\nms: sextupole, l=0.369;\n")
+        outFile.write("bpm: monitor, l=0.5;\nmk: marker;\n")
+        outFile.write("ring: sequence, l={}, refer=entry;\n".format(n_cells*cell_length))
+        for cell in range(n_cells):
+            s = cell*cell_length
+            outFile.write("mq.{0}: mq, k1:=kq{1}, at={2};\n".format(cell, "fd"[cell % 2], s))
+            outFile.write("ms.{0}: ms, k2:=ks{1}, at=3.5, from=mq.{0};  ! corrector\n".format(cell, "fd"[cell % 2]))
+            outFile.write("mb.{0}.a: mb,\n    at={1};\n".format(cell, s + 5.))
+            outFile.write("mb.{0}.b: mb, at={1};\nbpm.{0}: bpm, at={2};\nmk.{0}: mk, at={3};\n"
+                          .format(cell, s + 20., s + 35., s + 40.))
+        outFile.write("endsequence;\n")
+        outFile.write("call, file=\"{}\";\n".format(os.path.basename(strengthFile)))
+    with open(strengthFile, 'w') as outFile:
+        outFile.write("ab := twopi/{};\nkqf := 0.0088*scale;\nkqd := -kqf;\nksf = 0.1;\nksd = -0.2;\nscale = 1.0;\n"
+                      .format(2*n_cells))
+    return n_cells*CellSize
+
+def tokenize(fileName):
+    with open(fileName, 'r') as inFile:
+        return sum(1 for statement in TokenizeMADX(inFile))
+
+def placements(fileName):
+    return sum(1 for placement in MADXParser().Placements(inputFile=fileName, beamline="ring"))
+
+def parse(fileName):
+    parser = MADXParser()
+    parser.ParseInput(inputFile=fileName, beamline="ring")
+    return len(parser.Lattice.Sequence)
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_madx_reader",
+                                     description="Measure MAD-X reader throughput.")
+    parser.add_argument('-n', '--n_elements', type=int, default=300000)
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    config = parser.parse_args()
+    ConfigureLogging(quiet=True)
+
+    with tempfile.TemporaryDirectory() as directory:
+        fileName = os.path.join(directory, "machine.seq")
+        write_machine_madx(fileName, config.n_elements)
+        n_lines = sum(1 for line in open(fileName, 'r'))
+        print("{} lines".format(n_lines))
+        for label, reader, unit in (("tokenize", tokenize, "statements"), ("placements", placements, "placements"),
+                                    ("parse", parse, "placements")):
+            best, count = min(timed(reader, fileName) for i in range(config.repeat))
+            print("{:10s} {:10d} {:10s} {:8.3f} s  {:12.0f} {}/s".format(label, count, unit, best, count/best, unit))
+
+def timed(reader, fileName):
+    start = time.perf_counter()
+    count = reader(fileName)
+    return time.perf_counter() - start, count
+
+if __name__ == "__main__":
+    main()
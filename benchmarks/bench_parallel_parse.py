@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# bench_parallel_parse.py
+#
+# Parse time of definition-heavy ELEGANT and 6DSim files (every placement
+# with its own element definition, as in files exported with per-magnet
+# strengths) serially and with parse worker pools of increasing size, and a
+# check that every parallel parse gives the same lattice and parse errors as
+# the serial one.
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ElegantParser import ElegantParser
+from SixDSimParser import SixDSimParser
+from LatticeData import ElementType, DefinitionParameters
+from LatticeLog import ConfigureLogging
+
+def write_definitions_lte(fileName, n_elements):
+    names = []
+    with open(fileName, 'w') as outFile:
+        outFile.write("! Synthetic lattice with one definition per placement\n")
+        for i in range(n_elements):
+            kind = i % 4
+            if kind == 0:
+                names.append("D{}".format(i))
+                outFile.write("D{}: DRIF, L={}\n".format(i, 0.1 + i*1e-6))
+            elif kind == 1:
+                names.append("Q{}".format(i))
+                outFile.write("Q{}: KQUAD, L=0.2, K1={}, N_SLICES=10, &\n    SYNCH_RAD=1 ! focusing &\n".format(i, 1.5 - i*1e-6))
+            elif kind == 2:
+                names.append("B{}".format(i))
+                outFile.write("\"B{}\": CSBEND, L=1.0, ANGLE=0.01, E1=0.005, E2=0.005, HGAP=0.01, FINT=0.5\n".format(i))
+            else:
+                names.append("S{}".format(i))
+                outFile.write("S{}: KSEXT, L=0.1, K2={}, ORDER=2\n".format(i, 3.0 + i*1e-6))
+        outFile.write("RING: LINE=({})\n".format(", &\n  ".join(", ".join(names[i:i+8]) for i in range(0, len(names), 8))))
+
+def write_definitions_6ds(fileName, n_elements):
+    names = []
+    with open(fileName, 'w') as outFile:
+        outFile.write("// Synthetic lattice with one definition per placement\nINFO:\n$pc = 8000.\n$g = 0.1\nELEMENTS:\n")
+        for i in range(n_elements):
+            kind = i % 4
+            if kind == 0:
+                outFile.write("ID o{0} Gap L {1}\n".format(i, 10. + i*1e-4))
+            elif kind == 1:
+                outFile.write("ID q{0} Quad L 20 G $g*{1}\n".format(i, 1. - i*1e-7))
+            elif kind == 2:
+                outFile.write("ID b{0} Dipole L 100 Hy 5 G 0 poleGap 1 fringeK 0.5\n".format(i))
+            else:
+                outFile.write("ID s{0} Mult L 10 M2N {1}\n".format(i, 0.01 + i*1e-8))
+            names.append(("o", "q", "b", "s")[kind] + str(i))
+        outFile.write("LATTICE:\n")
+        for i in range(0, len(names), 10):
+            outFile.write(" ".join(names[i:i+10]) + "\n")
+        outFile.write("END\n")
+
+def signature(parser):
+    """Everything the parse produced: the sequence, definitions and parse errors."""
+
+    lattice = parser.Lattice
+    definitions = [(name, element.Definition.Name, ElementType(element), DefinitionParameters(element))
+                   for name, element in lattice.Elements.items()]
+    return list(lattice.Sequence), lattice.Length, repr(definitions), parser.ParseErrors()
+
+def parse(parserClass, fileName, workers):
+    parser = parserClass()
+    start = time.perf_counter()
+    parser.ParseInput(inputFile=fileName, beamline="RING", parse_workers=workers)
+    return time.perf_counter() - start, signature(parser)
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_parallel_parse",
+                                     description="Measure parallel parsing of element definitions.")
+    parser.add_argument('-n', '--n_elements', type=int, default=400000)
+    parser.add_argument('-w', '--workers', type=int, nargs='+', default=[2, 4, 8])
+    config = parser.parse_args()
+    ConfigureLogging(quiet=True)
+    print("{} CPUs".format(os.cpu_count()))
+
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        for label, parserClass, writer, extension in (("elegant", ElegantParser, write_definitions_lte, ".lte"),
+                                                      ("6dsim", SixDSimParser, write_definitions_6ds, ".6ds")):
+            fileName = os.path.join(directory, "definitions" + extension)
+            writer(fileName, config.n_elements)
+            serial, expected = parse(parserClass, fileName, None)
+            print("{:8s} {:8.1f} MB  serial    {:8.3f} s".format(label, os.path.getsize(fileName)/1e6, serial))
+            for workers in config.workers:
+                seconds, result = parse(parserClass, fileName, workers)
+                same = result == expected
+                failed = failed or not same
+                print("{:8s} {:11s}  {} workers {:8.3f} s  speedup {:5.2f}  {}"
+                      .format(label, "", workers, seconds, serial/seconds, "same" if same else "DIFFERENT"))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+# bench_scaling.py
+#
+# Scaling benchmark of the lattice pipeline on synthetic lattices (see lattice_generator.py).
+# For each input format and lattice size, times the stages: parse, AddElement (rebuilding
+# the parsed lattice placement by placement), AssociateDipoleEdges, InsertDrifts and each
+# writer.  Results are written as JSON; with --compare, stages that are slower than in a
+# stored baseline by more than the threshold are flagged and the exit status is non-zero.
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lattice_generator import Writers, generate
+from LatticeLog import ConfigureLogging
+from LatticeData import Lattice
+from ElegantParser import ElegantParser
+from MADXParser import MADXParser
+from SixDSimParser import SixDSimParser
+
+Parsers = {"elegant": (ElegantParser, {"beamline": "RING"}),
+           "madx": (MADXParser, {}),
+           "6dsim": (SixDSimParser, {})}
+
+OutputParsers = {"elegant": ElegantParser, "madx": MADXParser, "6dsim": SixDSimParser}
+
+def timed(function):
+    start = time.perf_counter()
+    value = function()
+    return time.perf_counter() - start, value
+
+def rebuild(lattice, lattice_class):
+    """Add every placement of a parsed lattice to a new one."""
+
+    rebuilt = lattice_class()
+    rebuilt.Name = lattice.Name
+    elements = lattice.Elements
+    for name in lattice.Sequence:
+        rebuilt.AddElement(elements[name])
+    rebuilt.Length = lattice.Length
+    return rebuilt
+
+def write(lattice, output_format, fileName):
+    parser = OutputParsers[output_format]()
+    parser.LoadLattice(lattice)
+    parser.WriteLattice(outputFile=fileName, beamline="ring")
+
+def benchmark(input_format, n_elements, directory, columnar=False):
+    """Time each stage for one format and size; returns a list of result records."""
+
+    inputFile = os.path.join(directory, "synthetic_{}{}".format(n_elements, Writers[input_format][1]))
+    generate(input_format, inputFile, n_elements)
+    parserClass, options = Parsers[input_format]
+
+    stages = []
+    parser = parserClass(columnar=columnar)
+    stages.append(("parse", timed(lambda: parser.ParseInput(inputFile=inputFile, **options))[0]))
+    lattice = parser.Lattice
+
+    lattice_class = type(lattice)
+    seconds, rebuilt = timed(lambda: rebuild(lattice, lattice_class))
+    stages.append(("AddElement", seconds))
+    stages.append(("AssociateDipoleEdges", timed(rebuilt.AssociateDipoleEdges)[0]))
+    for output_format in OutputParsers:
+        outputFile = os.path.join(directory, "output" + Writers[output_format][1])
+        stages.append(("write_" + output_format, timed(lambda: write(lattice, output_format, outputFile))[0]))
+    stages.append(("InsertDrifts", timed(lambda: rebuilt.InsertDrifts("both"))[0]))
+
+    placements = len(lattice.Sequence)
+    return [{"format": input_format, "size": n_elements, "placements": placements, "columnar": columnar,
+             "stage": stage, "seconds": seconds} for stage, seconds in stages]
+
+def result_key(result):
+    return (result["format"], result["size"], result["columnar"], result["stage"])
+
+def compare(results, baseline, threshold, min_seconds):
+    """Return the results slower than their baseline by more than the threshold ratio.
+    Stages faster than min_seconds in both runs are too noisy to compare."""
+
+    reference = {result_key(result): result["seconds"] for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = reference.get(result_key(result))
+        if before is None or max(before, result["seconds"]) < min_seconds:
+            continue
+        ratio = result["seconds"] / max(before, 1e-9)
+        if ratio > threshold:
+            regressions.append(dict(result, baseline=before, ratio=ratio))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_scaling",
+                                     description="Time the lattice pipeline on synthetic lattices of increasing size.")
+    parser.add_argument('-i', '--formats', nargs='+', choices=list(Parsers), default=list(Parsers))
+    parser.add_argument('-n', '--sizes', nargs='+', type=int, default=[100, 1000, 10000, 100000],
+                        help="Lattice sizes in elements (up to 1000000)")
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help="Repetitions of each benchmark; the fastest time of each stage is kept")
+    parser.add_argument('--columnar', action='store_true')
+    parser.add_argument('-o', '--output', type=str, default=None, help="JSON file for the results")
+    parser.add_argument('--compare', type=str, default=None, help="Baseline JSON file to compare against")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="Slowdown ratio against the baseline flagged as a regression")
+    parser.add_argument('--min_seconds', type=float, default=0.05,
+                        help="Stages faster than this in both runs are not compared")
+    config = parser.parse_args()
+
+    ConfigureLogging(quiet=True)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for input_format in config.formats:
+            for n_elements in config.sizes:
+                runs = [benchmark(input_format, n_elements, directory, config.columnar) for i in range(config.repeat)]
+                for stage_results in zip(*runs):
+                    best = min(stage_results, key=lambda result: result["seconds"])
+                    results.append(best)
+                    print("{:8s} {:8d} {:22s} {:10.4f} s".format(best["format"], best["size"], best["stage"], best["seconds"]))
+
+    report = {"timestamp": datetime.now().isoformat(), "python": platform.python_version(),
+              "machine": platform.machine(), "results": results}
+    if config.output is not None:
+        with open(config.output, 'w') as outFile:
+            json.dump(report, outFile, indent=1)
+
+    if config.compare is not None:
+        with open(config.compare) as inFile:
+            baseline = json.load(inFile)
+        regressions = compare(results, baseline, config.threshold, config.min_seconds)
+        for regression in regressions:
+            print("REGRESSION {format} {size} {stage}: {seconds:.4f} s vs {baseline:.4f} s ({ratio:.2f}x)"
+                  .format(**regression))
+        if regressions:
+            return 1
+        print("No regressions against {}".format(config.compare))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+# bench_startup.py
+#
+# Start-up cost of the command line tool: wall time of 'convert-lattice.py --help'
+# and of a quiet conversion of a small ELEGANT lattice, each in a fresh process.
+# Exits with a non-zero status if either exceeds its time budget.
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+package = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+script = os.path.join(package, 'convert-lattice.py')
+
+def write_small_lte(fileName):
+    with open(fileName, 'w') as outFile:
+        outFile.write("! Small lattice for start-up benchmarking\n")
+        outFile.write("D1: DRIF, L=0.5\nQF: KQUAD, L=0.2, K1=1.2\nQD: KQUAD, L=0.2, K1=-1.2\n")
+        outFile.write("B1: CSBEND, L=1.0, ANGLE=0.1, E1=0.05, E2=0.05\n")
+        outFile.write("CELL: LINE=(QF, D1, B1, D1, QD, D1, B1, D1)\nRING: LINE=(4*CELL)\n")
+
+def timed(command):
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_startup",
+                                     description="Check the start-up time of convert-lattice.py against a budget.")
+    parser.add_argument('-r', '--repeat', type=int, default=10)
+    parser.add_argument('--help_budget', type=float, default=0.25,
+                        help="Budget for 'convert-lattice.py --help', in seconds")
+    parser.add_argument('--convert_budget', type=float, default=0.5,
+                        help="Budget for converting a small lattice, in seconds")
+    config = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        inputFile = os.path.join(directory, "small.lte")
+        write_small_lte(inputFile)
+        commands = (("--help", [sys.executable, script, '--help'], config.help_budget),
+                    ("convert", [sys.executable, script, '-q', '-i', 'elegant', '-s', inputFile, '--beamline', 'ring',
+                                 '-o', 'madx', '-f', os.path.join(directory, "small.seq")], config.convert_budget))
+        over_budget = False
+        for label, command, budget in commands:
+            times = sorted(timed(command) for i in range(config.repeat))
+            median = times[len(times)//2]
+            status = "ok" if median <= budget else "OVER BUDGET"
+            over_budget |= median > budget
+            print("{:10s} median {:6.3f} s  best {:6.3f} s  budget {:6.3f} s  {}".format(label, median, times[0], budget, status))
+    return 1 if over_budget else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# lattice_generator.py
+#
+# Synthetic lattices for benchmarking, in ELEGANT, MAD-X and 6DSim formats.
+# Each lattice is a ring of repeated FODO-like cells of ten placements with
+# dipoles between edges; the cells use variables where the format has them,
+# and ELEGANT rings are built from nested, repeated lines.
+
+import argparse
+
+# Placements per cell (MAD-X cells have no drifts, as positions are explicit)
+CellSize = 10
+MADXCellSize = 8
+
+def cell_count(n_elements, cell_size=CellSize):
+    return max(1, n_elements // cell_size)
+
+# ---------------------------------------------------------------------------
+def write_elegant(fileName, n_elements, cells_per_arc=100):
+    """ELEGANT lattice: cells nested into arcs (N*CELL), arcs into the ring, with a few distinct
+    cell variants so that the definitions do not all collapse to one."""
+
+    n_cells = cell_count(n_elements)
+    variants = min(n_cells, 8)
+    with open(fileName, 'w') as outFile:
+        outFile.write("! Synthetic ELEGANT lattice, {} cells\n".format(n_cells))
+        outFile.write("D1: DRIF, L=0.5\nD2: EDRIFT, L=0.25\n")
+        for variant in range(variants):
+            outFile.write("QF{0}: KQUAD, L=0.2, K1={1}\nQD{0}: KQUAD, L=0.2, K1={2}\n"
+                          .format(variant, 1.5 + 0.01*variant, -1.5 - 0.01*variant))
+            outFile.write("B{0}: CSBEND, L=1.0, ANGLE={1}, E1=0.05, &\n    E2=0.05, HGAP=0.01, FINT=0.5\n"
+                          .format(variant, 0.1 + 0.001*variant))
+            outFile.write("S{0}: KSEXT, L=0.1, K2={1}\n".format(variant, 3.0 + 0.1*variant))
+            outFile.write("CELL{0}: LINE=(QF{0}, D1, B{0}, D2, S{0}, D1, QD{0}, D1, B{0}, D2)\n".format(variant))
+
+        # Arcs of repeated cells, and the ring of arcs
+        arcs = []
+        remaining = n_cells
+        while remaining:
+            cells = min(cells_per_arc, remaining)
+            variant = len(arcs) % variants
+            outFile.write("ARC{}: LINE=({}*CELL{})\n".format(len(arcs), cells, variant))
+            arcs.append("ARC{}".format(len(arcs)))
+            remaining -= cells
+        outFile.write("RF1: RFCA, L=0.3\n")
+        for first in range(0, len(arcs), 50):
+            outFile.write("SECTION{}: LINE=({})\n".format(first//50, ", ".join(arcs[first:first+50])))
+        sections = ", ".join("SECTION{}".format(section) for section in range((len(arcs)+49)//50))
+        outFile.write("RING: LINE=({}, RF1)\nUSE, RING\n".format(sections))
+
+# ---------------------------------------------------------------------------
+def write_madx(fileName, n_elements):
+    """MAD-X sequence with every placement at an explicit (center) position, and the quadrupole
+    strengths given by immediate and deferred variables."""
+
+    n_cells = cell_count(n_elements, MADXCellSize)
+    cell_length = 8.
+    with open(fileName, 'w') as outFile:
+        outFile.write("! Synthetic MAD-X lattice, {} cells\n".format(n_cells))
+        outFile.write("kfoc := kbase * scale;\nkdef := -kbase * scale;\nkbase = 0.5;\nscale = 1.0;\n")
+        outFile.write("qf: quadrupole, l=0.5, k1:=kfoc;\nqd: quadrupole, l=0.5, k1:=kdef;\n")
+        outFile.write("bend: sbend, l=1.0, angle=0.1, e1=0.0, e2=0.0;\n")
+        outFile.write("ein: dipedge, e1=0.05, h=0.1, hgap=0.01, fint=0.5;\n")
+        outFile.write("ring: sequence, l={};\n".format(n_cells*cell_length))
+        for cell in range(n_cells):
+            s = cell*cell_length
+            outFile.write("qf.{0}: qf, at={1};\nein.{0}.1: ein, at={2};\nbend.{0}.1: bend, at={3};\n"
+                          "ein.{0}.2: ein, at={4};\nqd.{0}: qd, at={5};\nein.{0}.3: ein, at={6};\n"
+                          "bend.{0}.2: bend, at={7};\nein.{0}.4: ein, at={8};\n"
+                          .format(cell, s+0.25, s+1.0, s+1.5, s+2.0, s+4.25, s+5.0, s+5.5, s+6.0))
+        outFile.write("endsequence;\n")
+
+# ---------------------------------------------------------------------------
+def write_6dsim(fileName, n_elements):
+    """6DSim lattice with variables in the INFO block and one LATTICE line per cell."""
+
+    n_cells = cell_count(n_elements)
+    with open(fileName, 'w') as outFile:
+        outFile.write("// Synthetic 6DSim lattice, {} cells\n".format(n_cells))
+        outFile.write("INFO:\n$pc = 150\n$L = 20\n$G = 0.5*2\n$half = $L/2\n")
+        outFile.write("ELEMENTS:\n")
+        outFile.write("ID d1 Gap L $L\nID d2 Gap L $half\n")
+        outFile.write("ID q1 Quad L 20 G $G\nID q2 Quad L 20 G -1.0\n")
+        outFile.write("ID b1 Dipole L 100 Hy 1.5 G 0.0 poleGap 2 fringeK 0.5 inA 0.05 outA 0.05\n")
+        outFile.write("ID e1 DipEdge Hy 1.5 poleGap 2 inA 0.05 fringeK 0.5\n")
+        outFile.write("ID e2 DipEdge Hy 1.5 poleGap 2 inA 0.05 fringeK 0.5\n")
+        outFile.write("ID s1 Mult L 10 M2N 0.3\n")
+        outFile.write("LATTICE:\n")
+        for cell in range(n_cells):
+            outFile.write("d1 q1 d2 e1 b1 e2 d2 q2 d1 s1\n")
+        outFile.write("END\n")
+
+Writers = {"elegant": (write_elegant, ".lte"),
+           "madx": (write_madx, ".seq"),
+           "6dsim": (write_6dsim, ".6ds")}
+
+def generate(lattice_format, fileName, n_elements):
+    Writers[lattice_format][0](fileName, n_elements)
+
+def main():
+    parser = argparse.ArgumentParser(prog="lattice_generator",
+                                     description="Write a synthetic lattice for benchmarking.")
+    parser.add_argument('-i', '--format', choices=list(Writers), required=True)
+    parser.add_argument('-n', '--n_elements', type=int, default=10000)
+    parser.add_argument('-f', '--output_filename', type=str, default=None)
+    config = parser.parse_args()
+
+    fileName = config.output_filename or "synthetic_{}{}".format(config.n_elements, Writers[config.format][1])
+    generate(config.format, fileName, config.n_elements)
+    print("Wrote {}".format(fileName))
+
+if __name__ == "__main__":
+    main()
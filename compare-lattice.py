@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+# compare-lattice.py
+#
+# Check that two lattice files, in any of the supported formats, describe the
+# same beamline, e.g. a lattice and its conversion.  Exits with status 1 if
+# they differ and 2 if either cannot be loaded, so that it can be used as a
+# gate after conversions.
+
+import sys
+import argparse
+
+def main():
+    parser = argparse.ArgumentParser(prog = "compare-lattice",
+                                     description = "Compare two lattices, possibly in different formats.")
+
+    parser.add_argument('-i', '--input_format', choices=['elegant','madx','6dsim','binary'], nargs=2, required=True,
+                        help="Formats of the two lattices")
+    parser.add_argument('-s', '--input_filename', type=str, nargs=2, required=True,
+                        help="Files of the two lattices")
+    parser.add_argument('--beamline', type=str, nargs='+', default=[None],
+                        help="Beamline to use from ELEGANT lattices, for both lattices or for each")
+    parser.add_argument('--rtol', type=float, default=1e-9, help="Relative tolerance of the comparisons")
+    parser.add_argument('--atol', type=float, default=1e-9, help="Absolute tolerance of the comparisons")
+    parser.add_argument('--relative', action='store_true',
+                        help="Measure s-positions from the first element of each lattice (other than drifts and edges)")
+    parser.add_argument('-n', '--max_divergences', type=int, default=10,
+                        help="Number of divergences to report")
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="Only print the divergences")
+    parser.add_argument('--columnar', action='store_true',
+                        help="Store the lattices in columnar (NumPy array) form")
+    config = parser.parse_args()
+    if len(config.beamline) > 2:
+        parser.error("--beamline takes one beamline, or one for each lattice")
+
+    # Imported here so that --help and argument errors do not pay for loading the toolkit
+    from LatticeLog import ConfigureLogging, Log
+    from LatticeCompare import CompareFiles, ReportDivergences
+    ConfigureLogging(quiet=config.quiet)
+    beamlines = config.beamline * (3 - len(config.beamline))
+    try:
+        divergences = CompareFiles(*zip(config.input_format, config.input_filename, beamlines),
+                                   columnar=config.columnar, rtol=config.rtol, atol=config.atol,
+                                   relative=config.relative, max_divergences=config.max_divergences)
+    except (Exception, SystemExit) as error:
+        # A lattice which cannot be loaded fails the gate, also when its reader exits
+        Log.error("Unable to compare the lattices: {}: {}".format(type(error).__name__, error))
+        sys.exit(2)
+    sys.exit(0 if ReportDivergences(divergences) else 1)
+
+if __name__ == "__main__":
+    main();
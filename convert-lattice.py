@@ -9,40 +9,105 @@
 # July 2023
 
 import os
+import sys
+import json
 import argparse
-from LatticeConvert import LatticeConverter
 
 def main():
     parser = argparse.ArgumentParser(prog = "convert-lattice",
                                      description = "Simple lattice conversion between different formats.")
 
-    parser.add_argument('-i', '--input_format', choices=['elegant','madx','6dsim'], required=True)
-    parser.add_argument('-s', '--input_filename', type=str, required=True)
+    parser.add_argument('-i', '--input_format', choices=['elegant','madx','6dsim','binary'], required=True)
+    parser.add_argument('-s', '--input_filename', type=str)
     parser.add_argument('--beamline', type=str, required=True)
-    parser.add_argument('-o', '--output_format', choices=['elegant','madx','6dsim'], required=True)
-    parser.add_argument('-f', '--output_filename', type=str, required=True)
+    parser.add_argument('-o', '--output_format', choices=['elegant','madx','6dsim','binary'], nargs='+', required=True,
+                        help="One or more output formats, written concurrently from a single load")
+    parser.add_argument('-f', '--output_filename', type=str, nargs='+',
+                        help="One output file per output format")
     parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="Only print warnings (parse error reports) and errors")
+    parser.add_argument('--columnar', action='store_true',
+                        help="Store the lattice in columnar (NumPy array) form while converting")
+    parser.add_argument('--stream', action='store_true',
+                        help="Stream the placements from the reader to the writers instead of building the lattice in memory")
+    parser.add_argument('--parse_workers', type=int, default=None, metavar='N',
+                        help="Parse the element definitions of ELEGANT and 6DSim files on N processes (0: one per CPU)")
+    parser.add_argument('--intern', type=float, nargs='?', const=0., default=None, metavar='TOLERANCE',
+                        dest='intern_tolerance',
+                        help="Merge element definitions whose parameters agree (within TOLERANCE, default exactly) before writing")
+    parser.add_argument('--drift_tolerance', type=float, default=None, metavar='TOLERANCE',
+                        help="Drifts filling the gaps of a MAD-X or binary lattice share a definition if their lengths "
+                             "agree within TOLERANCE (default 1e-9 m)")
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help="Directory in which to cache parsed lattices between runs")
+    parser.add_argument('--cache_size', type=float, default=1024.,
+                        help="Maximum size of the lattice cache in MB")
+    parser.add_argument('--profile', type=str, default=None, metavar='REPORT_JSON',
+                        help="Record the time, calls and peak memory of each conversion phase in a JSON report")
+    parser.add_argument('--cprofile', type=str, default=None, metavar='STATS_FILE',
+                        help="Run cProfile over the conversion and write its statistics to this file")
+    batch = parser.add_argument_group("batch mode", "Convert many files in parallel, instead of -s/-f")
+    batch.add_argument('--manifest', type=str, default=None,
+                       help="File listing 'input_file [output_file]' per line")
+    batch.add_argument('--glob', type=str, action='append', default=[], dest='patterns',
+                       help="Glob pattern of input files (may be repeated)")
+    batch.add_argument('--output_dir', type=str, default=None,
+                       help="Directory for output files not named in the manifest (default: alongside the inputs)")
+    batch.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                       help="Number of worker processes")
     config = parser.parse_args()
 
-    converter = LatticeConverter(verbose=config.verbose);
-    if config.input_format in ['madx']:
-        raise RuntimeError("LatticeConvert is not yet able to input MAD-X lattices.")
-    if not config.input_filename or not os.path.isfile(config.input_filename):
-        raise RuntimeError("Unable to open input file {}.".format(config.input_filename))
-    if config.input_format == "elegant":
-        converter.LoadElegant(inputFile=config.input_filename,
-                              beamline=config.beamline)
-    elif config.input_format == "madx":
-        converter.LoadMADX(inputFile=config.input_filename)
-    elif config.input_format == "6dsim":
-        converter.Load6DSim(inputFile=config.input_filename)
-    if config.output_format == "elegant":
-        converter.WriteElegant(outputFile=config.output_filename)
-    elif config.output_format == "madx":
-        converter.WriteMADX(outputFile=config.output_filename,
-                            beamline=config.beamline)
-    elif config.output_format == "6dsim":
-        converter.Write6DSim(outputFile=config.output_filename)
+    if config.manifest is not None or config.patterns:
+        if config.cprofile is not None:
+            parser.error("--cprofile is not available in batch mode")
+        sys.exit(RunBatch(config))
+    if not config.input_filename or not config.output_filename:
+        parser.error("-s/--input_filename and -f/--output_filename are required outside batch mode")
+    if len(config.output_filename) != len(config.output_format):
+        parser.error("-f/--output_filename needs one file for each -o/--output_format")
+    if config.stream and config.intern_tolerance is not None:
+        parser.error("--intern needs the whole lattice, so cannot be used with --stream")
+
+    # Imported here so that --help and argument errors do not pay for loading the toolkit
+    from LatticeConvert import LatticeConverter
+    from LatticeProfile import Profile
+    converter = LatticeConverter(verbose=config.verbose, quiet=config.quiet, columnar=config.columnar,
+                                 parse_workers=config.parse_workers, intern_tolerance=config.intern_tolerance,
+                                 drift_tolerance=config.drift_tolerance, cache_dir=config.cache_dir,
+                                 cache_size=int(config.cache_size*(1<<20)));
+    profiling = config.profile is not None or config.cprofile is not None
+    if profiling:
+        Profile.Enable(memory=config.profile is not None, cprofile=config.cprofile)
+    try:
+        convert = converter.ConvertStream if config.stream else converter.Convert
+        convert(config.input_format, config.input_filename,
+                list(zip(config.output_format, config.output_filename)), config.beamline)
+    finally:
+        if profiling:
+            Profile.Disable()
+            if config.profile is not None:
+                Profile.Write(config.profile)
+
+def RunBatch(config):
+    from LatticeBatch import BatchInputs, BatchJobs, ConvertBatch, ReportBatch
+    from LatticeProfile import MergeReports
+
+    entries = BatchInputs(config.manifest, config.patterns)
+    if config.output_dir is not None:
+        os.makedirs(config.output_dir, exist_ok=True)
+    jobs = BatchJobs(entries, config.output_format, config.output_dir,
+                     input_format=config.input_format, beamline=config.beamline, verbose=config.verbose,
+                     columnar=config.columnar, stream=config.stream, intern_tolerance=config.intern_tolerance,
+                     drift_tolerance=config.drift_tolerance,
+                     cache_dir=config.cache_dir,
+                     cache_size=int(config.cache_size*(1<<20)), profile=config.profile is not None)
+    print("Converting {} files with {} workers".format(len(jobs), config.workers))
+    results = ConvertBatch(jobs, config.workers)
+    if config.profile is not None:
+        with open(config.profile, 'w') as outFile:
+            json.dump(MergeReports([result["profile"] for result in results if result.get("profile")]), outFile, indent=1)
+    return 1 if ReportBatch(results) or not jobs else 0
 
 if __name__ == "__main__":
     main();
@@ -0,0 +1,30 @@
+# conftest.py
+#
+# Shared test setup: the modules are imported from the repository root,
+# and parse_madx reads a MAD-X lattice (given as text or as a file) with
+# the messages of the readers silenced.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from MADXParser import MADXParser
+from LatticeLog import ConfigureLogging
+
+@pytest.fixture
+def parse_madx(tmp_path):
+    """Return a function parsing MAD-X text (written to a file first) or a MAD-X file, with beamline
+    "ring", into a MADXParser."""
+
+    ConfigureLogging(quiet=True)
+    def parse(source, columnar=False):
+        if not isinstance(source, os.PathLike):
+            inputFile = tmp_path / "lattice.madx"
+            inputFile.write_text(source)
+            source = inputFile
+        parser = MADXParser(columnar=columnar)
+        parser.ParseInput(inputFile=str(source), beamline="ring")
+        return parser
+    return parse
@@ -0,0 +1,98 @@
+# test_columnar.py
+#
+# Tests of the columnar storage mode (ColumnarLattice): names placed as the
+# same definition share a parameter table row, so that the columnar path
+# writes the same MAD-X as the object path.
+
+import pickle
+
+import pytest
+
+from MADXParser import MADXParser
+from LatticeBinary import LoadBinary, SaveBinary
+from LatticeColumns import ColumnarLattice, ElementTypes
+
+LATTICE = """
+qf: quadrupole, l=0.5, k1=0.6;
+qd: quadrupole, l=0.5, k1=-0.5;
+mb: sbend, l=2, angle=0.1;
+ea: dipedge, h=0.05, e1=0.1;
+qf.1: qf;
+qf.2: qf;
+mb.1: mb;
+mb.2: mb;
+ring: sequence, l=20;
+qf.1, at=0;
+ea, at=1;
+mb.1, at=2;
+ea, at=4;
+qd, at=5;
+qf.2, at=6;
+mb.2, at=8;
+qf, at=12;
+endsequence;
+"""
+
+def madx(lattice):
+    writer = MADXParser()
+    writer.LoadLattice(lattice)
+    return [line for line in "".join(writer.FormatLattice(beamline="ring")).splitlines() if not line.startswith("! 2")]
+
+def test_placements_share_rows(parse_madx):
+    lattice = parse_madx(LATTICE, True).Lattice
+    assert len(lattice.ParameterTable("Quad")) == 2
+    assert lattice.Quads["qf.1"].Definition == lattice.Quads["qf"].Definition
+    assert lattice.Quads["qf.2"].Definition.Name == "qf"
+    assert lattice.Quads["qf.2"].Name == "qf.2"
+    # mb.1 has edges and mb.2 does not, so they no longer share a row
+    assert lattice.Dipoles["mb.1"].Definition != lattice.Dipoles["mb.2"].Definition
+    assert (lattice.Dipoles["mb.1"].E1, lattice.Dipoles["mb.2"].E1) == (0.1, 0.)
+
+def test_madx_output_matches_objects(parse_madx):
+    objects = parse_madx(LATTICE, False).Lattice
+    assert madx(parse_madx(LATTICE, True).Lattice) == madx(objects)
+    assert madx(ColumnarLattice.FromLattice(objects)) == madx(objects)
+
+def test_edge_placements(parse_madx):
+    objects, lattice = parse_madx(LATTICE, False).Lattice, parse_madx(LATTICE, True).Lattice
+    assert dict(lattice.DipoleEdgePlacements) == objects.DipoleEdgePlacements
+
+def test_binary_keeps_shared_rows(tmp_path, parse_madx):
+    lattice = parse_madx(LATTICE, True).Lattice
+    SaveBinary(lattice, str(tmp_path / "ring.ltb"))
+    loaded = LoadBinary(str(tmp_path / "ring.ltb"))
+    assert len(loaded.ParameterTable("Quad")) == 2
+    assert madx(loaded) == madx(lattice)
+
+def test_derived_columns(parse_madx):
+    objects, lattice = parse_madx(LATTICE, False).Lattice, parse_madx(LATTICE, True).Lattice
+    assert list(lattice.Lengths) == list(objects.PlacementExtents()[1])
+    assert [ElementTypes[code] for code in lattice.Types] == [type(objects.Elements[name].Definition).__name__
+                                                              for name in objects.Sequence]
+
+def test_pickled_names(parse_madx):
+    lattice = pickle.loads(pickle.dumps(parse_madx(LATTICE, True).Lattice))
+    assert "qf.2" in lattice.Elements and "qf.3" not in lattice.Elements
+    assert lattice.Quads["qf.2"].Definition.Name == "qf"
+    assert madx(lattice) == madx(parse_madx(LATTICE, True).Lattice)
+
+@pytest.mark.parametrize("contents", [b"", b"LATTBIN", b"not a lattice" * 8])
+def test_binary_rejects_other_files(tmp_path, contents):
+    (tmp_path / "ring.ltb").write_bytes(contents)
+    with pytest.raises(RuntimeError):
+        LoadBinary(str(tmp_path / "ring.ltb"))
+
+def test_binary_rejects_truncated_files(tmp_path, parse_madx):
+    SaveBinary(parse_madx(LATTICE, True).Lattice, str(tmp_path / "ring.ltb"))
+    data = (tmp_path / "ring.ltb").read_bytes()
+    (tmp_path / "ring.ltb").write_bytes(data[:-10])
+    with pytest.raises(RuntimeError):
+        LoadBinary(str(tmp_path / "ring.ltb"))
+
+@pytest.mark.parametrize("keep_names", [False, True])
+def test_intern_definitions(parse_madx, keep_names):
+    objects, lattice = parse_madx(LATTICE, False).Lattice, parse_madx(LATTICE, True).Lattice
+    objects.InternDefinitions(keep_names=keep_names)
+    lattice.InternDefinitions(keep_names=keep_names)
+    assert sorted(lattice.Elements) == sorted(objects.Elements)
+    assert madx(lattice) == madx(objects)
@@ -0,0 +1,32 @@
+# test_convert.py
+#
+# Tests of whole conversions (LatticeConverter.Convert) between formats,
+# checked against the input with CompareFiles.
+
+import pytest
+
+from LatticeConvert import LatticeConverter
+from LatticeCompare import CompareFiles
+
+LATTICE = """
+qs: quadrupole, l=0.5, k1=0.1;
+qk: quadrupole, l=0.5, k1=-0.1;
+ring: sequence, l=5;
+qs, at=1;
+qk, at=3;
+endsequence;
+"""
+
+@pytest.mark.parametrize("columnar", [False, True])
+def test_madx_to_elegant_keeps_positions(tmp_path, columnar):
+    inputFile = tmp_path / "ring.madx"
+    inputFile.write_text(LATTICE)
+    outputFile = str(tmp_path / "ring.lte")
+    LatticeConverter(quiet=True, columnar=columnar).Convert("madx", str(inputFile), [("elegant", outputFile)], "ring")
+    assert CompareFiles(("madx", str(inputFile)), ("elegant", outputFile), beamline="ring") == []
+
+def test_madx_stream_to_line_format_is_refused(tmp_path):
+    inputFile = tmp_path / "ring.madx"
+    inputFile.write_text(LATTICE)
+    with pytest.raises(RuntimeError):
+        LatticeConverter(quiet=True).ConvertStream("madx", str(inputFile), [("elegant", str(tmp_path / "ring.lte"))], "ring")
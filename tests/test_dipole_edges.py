@@ -0,0 +1,65 @@
+# test_dipole_edges.py
+#
+# Tests of the association of dipole edges with dipoles which share a
+# definition but sit between different edges.
+
+import pytest
+
+from MADXParser import MADXParser
+from LatticeCompare import CompareLattices
+from LatticeData import StreamLayout
+
+LATTICE = """
+mb: sbend, l=2, angle=0.1;
+ea: dipedge, h=0.05, e1=0.1;
+eb: dipedge, h=0.05, e1=0.2;
+mb.1: mb;
+mb.2: mb;
+mb.3: mb;
+ring: sequence, l=20;
+ea, at=0;
+mb.1, at=1;
+ea, at=2;
+eb, at=4;
+mb.2, at=5;
+eb, at=6;
+ea, at=8;
+mb.3, at=9;
+ea, at=10;
+mb, at=14;
+endsequence;
+"""
+
+@pytest.fixture
+def lattice_file(tmp_path):
+    inputFile = tmp_path / "edges.madx"
+    inputFile.write_text(LATTICE)
+    return inputFile
+
+@pytest.mark.parametrize("columnar", [False, True])
+def test_edges_per_placement(lattice_file, columnar, parse_madx):
+    dipoles = parse_madx(lattice_file, columnar).Lattice.Dipoles
+    assert [(dipoles[name].E1, dipoles[name].E2) for name in ("mb.1", "mb.2", "mb.3", "mb")] == \
+        [(0.1, 0.1), (0.2, 0.2), (0.1, 0.1), (0., 0.)]
+
+def test_edges_not_set_on_shared_definition(lattice_file, parse_madx):
+    lattice = parse_madx(lattice_file).Lattice
+    definitions = {name: lattice.Elements[name].Definition for name in ("mb.1", "mb.2", "mb.3", "mb")}
+    assert definitions["mb.1"] is definitions["mb.3"]
+    assert len({id(definition) for definition in definitions.values()}) == 3
+    assert len({definition.Name for definition in definitions.values()}) == 3
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_madx_output_keeps_edges(lattice_file, tmp_path, stream, parse_madx):
+    reference = parse_madx(lattice_file)
+    writer = MADXParser()
+    outputFile = tmp_path / "edges.seq"
+    if stream:
+        layout = StreamLayout(MADXParser().Placements(inputFile=str(lattice_file), beamline="ring"))
+        layout.Length = reference.Lattice.Length
+        writer.WriteLattice(outputFile=str(outputFile), beamline="ring", layout=layout)
+        layout.Close()
+    else:
+        writer.LoadLattice(reference.Lattice)
+        writer.WriteLattice(outputFile=str(outputFile), beamline="ring")
+    assert CompareLattices(reference.Lattice, parse_madx(outputFile).Lattice) == []
@@ -0,0 +1,32 @@
+# test_drift_groups.py
+#
+# Tests of the grouping of drift lengths by InsertDrifts (GroupLengths).
+
+import numpy as np
+import pytest
+
+from LatticeData import GroupLengths
+from LatticeConvert import LatticeConverter
+
+def test_groups_do_not_chain():
+    lengths = np.array([1.0, 1.0009, 1.0018, 1.0027, 1.0036])
+    group_lengths, groups = GroupLengths(lengths, 1e-3)
+    assert group_lengths.tolist() == [1.0, 1.0018, 1.0036]
+    assert groups.tolist() == [0, 0, 1, 1, 2]
+
+@pytest.mark.parametrize("tolerance", [0., 1e-9, 1e-3])
+def test_every_length_within_tolerance(tolerance):
+    lengths = np.random.default_rng(0).uniform(0., 0.01, 1000)
+    group_lengths, groups = GroupLengths(lengths, tolerance)
+    assert np.abs(group_lengths[groups] - lengths).max() <= tolerance
+    assert groups[0] == 0 and np.all(np.diff(np.maximum.accumulate(groups)) <= 1)
+
+@pytest.mark.parametrize("columnar", [False, True])
+@pytest.mark.parametrize("drift_tolerance, drifts", [(None, 3), (1e-3, 2)])
+def test_drift_tolerance_option(tmp_path, columnar, drift_tolerance, drifts):
+    inputFile = tmp_path / "ring.madx"
+    inputFile.write_text("q: quadrupole, l=1, k1=0.1;\nring: sequence, l=6.0005;\n"
+                         "q, at=0.5;\nq, at=2.5;\nq, at=4.5005;\nendsequence;\n")
+    converter = LatticeConverter(quiet=True, columnar=columnar, drift_tolerance=drift_tolerance)
+    lattice = converter.LoadFormat("madx", str(inputFile), "ring", add_drifts="end")
+    assert len(lattice.Drifts) == drifts
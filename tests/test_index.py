@@ -0,0 +1,70 @@
+# test_index.py
+#
+# Tests of the query index of a lattice (LatticeIndex): placements at an s and
+# over an s-range, with overlapping, zero-length and missing placements, and
+# the discarding of the index when the lattice changes.
+
+import pytest
+
+from LatticeData import Quad
+
+# Sequence indices: q1 [0, 2], ea 2, q2 [1.5, 3.5], q3 [5, 7], ea 7; gaps [3.5, 5) and [7, 10)
+LATTICE = """
+q1: quadrupole, l=2, k1=0.1;
+q2: quadrupole, l=2, k1=0.2;
+q3: quadrupole, l={}, k1=0.1;
+ea: dipedge, h=0.05, e1=0.1;
+ring: sequence, l=10;
+q1, at=1;
+ea, at=2;
+q2, at=2.5;
+q3, at=6;
+ea, at=7;
+endsequence;
+"""
+
+@pytest.fixture(params=[False, True], ids=["objects", "columnar"])
+def lattice(request, parse_madx):
+    return parse_madx(LATTICE.format(2), request.param).Lattice
+
+@pytest.mark.parametrize("s, index", [(0., 0), (0.5, 0), (1.8, 2), (2., 2), (3.49, 2), (3.5, None), (4., None),
+                                      (5., 3), (6.99, 3), (7., None), (9., None), (-1., None), (10.5, None)])
+def test_at(lattice, s, index):
+    # Overlapping placements give the last starting one, and zero-length placements contain no s
+    assert lattice.PlacementAt(s) == index
+
+@pytest.mark.parametrize("s_min, s_max, indices", [(2., 5., [2, 1]), (0., 2., [0, 2]), (5., 7., [3]), (7., 8., [4]),
+                                                   (3.6, 4.9, []), (1.9, 2., [0, 2]), (0., 10., [0, 2, 1, 3, 4])])
+def test_between(lattice, s_min, s_max, indices):
+    # Zero-length placements are included at the start of the range but not at its end
+    assert list(lattice.PlacementsBetween(s_min, s_max)) == indices
+
+def test_occurrences(lattice):
+    assert list(lattice.PlacementsOf("ea")) == [1, 4]
+    assert list(lattice.PlacementsOf("q4")) == []
+
+def test_add_element_discards_index(lattice):
+    assert lattice.PlacementAt(8.2) is None
+    lattice.AddElement(Quad("q4", length=1., k1=0.3, center=8.5))
+    assert lattice.PlacementAt(8.2) == 5
+    assert list(lattice.PlacementsOf("q4")) == [5]
+
+def test_insert_drifts_discards_index(lattice):
+    assert lattice.PlacementAt(4.) is None
+    lattice.InsertDrifts("end")
+    assert lattice.Sequence[lattice.PlacementAt(4.)].startswith("drift")
+    assert lattice.Sequence[lattice.PlacementAt(9.)] == "drift_end"
+
+def test_intern_definitions_discards_index(lattice):
+    assert list(lattice.PlacementsOf("q3")) == [3]
+    lattice.InternDefinitions()
+    assert list(lattice.PlacementsOf("q3")) == []
+    assert list(lattice.PlacementsOf("q1")) == [0, 3]
+
+@pytest.mark.parametrize("columnar", [False, True])
+def test_intern_definitions_with_names_discards_index(parse_madx, columnar):
+    # q3 (l=2.04, so [4.98, 7.02]) shares the definition of q1 within the tolerance, so becomes 2 long
+    lattice = parse_madx(LATTICE.format(2.04), columnar).Lattice
+    assert lattice.PlacementAt(7.) == 3
+    lattice.InternDefinitions(tolerance=0.1, keep_names=True)
+    assert lattice.PlacementAt(7.) is None
@@ -0,0 +1,74 @@
+# test_madx_reader.py
+#
+# Tests of the statement-level MAD-X reader (MADXParser): deferred (':=')
+# attributes and their interaction with later plain assignments.
+
+import math
+
+import pytest
+
+from MADXParser import MADXParser
+
+def k1(parser, name):
+    return parser.Lattice.Elements[name].K1
+
+SEQUENCE = """
+ring: sequence, l=2;
+qf, at=0.5;
+endsequence;
+"""
+
+@pytest.mark.parametrize("columnar", [False, True])
+@pytest.mark.parametrize("update", ["qf, k1=0.5;", "qf->k1 = 0.5;"])
+def test_plain_assignment_replaces_deferred(parse_madx, update, columnar):
+    parser = parse_madx("kf = 0.3;\nqf: quadrupole, l=1, k1:=kf;\n" + update + SEQUENCE, columnar)
+    assert k1(parser, "qf") == pytest.approx(0.5)
+
+@pytest.mark.parametrize("columnar", [False, True])
+def test_deferred_uses_final_variables(parse_madx, columnar):
+    parser = parse_madx("kf = 0.3;\nqf: quadrupole, l=1, k1:=kf;\n" + SEQUENCE + "kf = 0.4;\n", columnar)
+    assert k1(parser, "qf") == pytest.approx(0.4)
+
+def test_deferred_after_plain_assignment(parse_madx):
+    parser = parse_madx("kf = 0.3;\nqf: quadrupole, l=1, k1=0.5;\nqf->k1 := kf;\n" + SEQUENCE + "kf = 0.4;\n")
+    assert k1(parser, "qf") == pytest.approx(0.4)
+
+def test_plain_assignment_keeps_other_deferred_attributes(parse_madx):
+    parser = parse_madx("kf = 0.3;\nlq = 1;\nqf: quadrupole, l:=lq, k1:=kf;\nqf, k1=0.5;\n" + SEQUENCE + "lq = 0.8;\n")
+    assert k1(parser, "qf") == pytest.approx(0.5)
+    assert parser.Lattice.Elements["qf"].Length == pytest.approx(0.8)
+
+def test_math_errors_are_reported(parse_madx):
+    parser = parse_madx("x = sqrt(-1);\nkf = 0.3;\nqf: quadrupole, l=1, k1=1/0;\n"
+                        "qd: quadrupole, l=1, k1:=log(-kf);\n" + SEQUENCE)
+    assert parser.InvalidVariables == ["x = sqrt(-1)"]
+    assert parser.InvalidExpressions == ["1/0", "log(-kf)"]
+    assert k1(parser, "qf") == 0.
+
+@pytest.mark.parametrize("columnar", [False, True])
+@pytest.mark.parametrize("quad, strength, tilt", [
+    ("k1=0.2, tilt=0.3", 0.2, 0.3),
+    ("k1s=-0.1", -0.1, math.pi/4.),
+    ("k1=0.3, k1s=0.4", 0.5, math.atan2(0.4, 0.3)/2.)])
+def test_tilted_quad_round_trip(parse_madx, quad, strength, tilt, columnar):
+    parser = parse_madx("qf: quadrupole, l=1, {};\n".format(quad) + SEQUENCE, columnar)
+    assert (k1(parser, "qf"), parser.Lattice.Elements["qf"].Tilt) == pytest.approx((strength, tilt))
+    writer = MADXParser()
+    writer.LoadLattice(parser.Lattice)
+    reread = parse_madx("".join(writer.FormatLattice(beamline="ring")))
+    assert (k1(reread, "qf"), reread.Lattice.Elements["qf"].Tilt) == pytest.approx((strength, tilt))
+
+@pytest.mark.parametrize("columnar", [False, True])
+def test_deferred_resolved_after_knob_change(parse_madx, columnar):
+    parser = parse_madx("kf = 0.3;\nkq := 2*kf;\nkd = 0.1;\nqf: quadrupole, l=1, k1:=kq;\n"
+                             "qd: quadrupole, l=1, k1:=kd;\nring: sequence, l=4;\nqf, at=0.5;\nqd, at=2.5;\n"
+                             "endsequence;\n", columnar)
+    parser.Variables.Set("kf", 0.25)
+    parser.ResolveDeferred(["kf"])
+    assert parser.Variables["kq"] == pytest.approx(0.5)
+    assert k1(parser, "qf") == pytest.approx(0.5)
+    parser.Variables.Set("kd", 0.2)
+    parser.ResolveDeferred(["kf"])
+    assert k1(parser, "qd") == pytest.approx(0.1)
+    parser.ResolveDeferred(["kd"])
+    assert k1(parser, "qd") == pytest.approx(0.2)
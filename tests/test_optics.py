@@ -0,0 +1,62 @@
+# test_optics.py
+#
+# Tests of the linear optics (LatticeOptics) against closed-form results:
+# a thin-lens FODO cell, a weak-focusing ring of combined-function bends,
+# and solenoids read from MAD-X and ELEGANT.
+
+import math
+
+import numpy as np
+import pytest
+
+from LatticeConvert import LatticeConverter
+from LatticeOptics import LatticeOptics, ComposeMaps, ProductMap, SolenoidMap, TransferMap
+
+@pytest.mark.parametrize("columnar", [False, True])
+def test_fodo_tune_and_beta(parse_madx, columnar):
+    # Quadrupoles short enough to be thin lenses of focal length f, a half cell L apart
+    L, f, lq = 5., 5., 1e-4
+    lattice = parse_madx("qf: quadrupole, l={0}, k1={1};\nqd: quadrupole, l={0}, k1=-{1};\n"
+                         "ring: sequence, l={2};\nqf, at={3};\nqd, at={4};\nendsequence;\n"
+                         .format(lq, 1./(f*lq), 2.*L, lq/2., L + lq/2.), columnar).Lattice
+    twiss = LatticeOptics(lattice).Twiss()
+    mu = math.acos(1. - L*L/(2.*f*f))
+    beta_max = 2.*L*(1. + math.sin(mu/2.))/math.sin(mu)
+    beta_min = 2.*L*(1. - math.sin(mu/2.))/math.sin(mu)
+    assert (twiss["Q1"], twiss["Q2"]) == pytest.approx((mu/(2.*math.pi),)*2, rel=1e-3)
+    assert (twiss["BETX"][0], twiss["BETY"][0]) == pytest.approx((beta_max, beta_min), rel=1e-3)
+    assert (twiss["BETX"][1], twiss["BETY"][1]) == pytest.approx((beta_min, beta_max), rel=1e-3)
+
+def test_weak_focusing_ring_dispersion(parse_madx):
+    # Bends of field index n: Qx = sqrt(1 - n), Qy = sqrt(n) and constant dispersion rho/(1 - n)
+    n_bends, n = 8, 0.3
+    rho = n_bends/(2.*math.pi)
+    lattice = parse_madx("mb: sbend, l=1, angle={}, k1={};\nring: sequence, l={};\n".format(1./rho, -n/rho**2, n_bends)
+                         + "".join("mb, at={};\n".format(i + 0.5) for i in range(n_bends)) + "endsequence;\n").Lattice
+    twiss = LatticeOptics(lattice).Twiss()
+    assert (twiss["Q1"], twiss["Q2"]) == pytest.approx((math.sqrt(1. - n), math.sqrt(n)))
+    assert twiss["BETX"] == pytest.approx(rho/math.sqrt(1. - n))
+    assert twiss["DX"] == pytest.approx(rho/(1. - n))
+    assert twiss["DPX"] == pytest.approx(0., abs=1e-12)
+
+def test_compose_maps_matches_loop():
+    maps = np.random.default_rng(1).normal(size=(13, 6, 6))
+    expected = [maps[0]]
+    for M in maps[1:]:
+        expected.append(M @ expected[-1])
+    assert ComposeMaps(maps) == pytest.approx(np.array(expected))
+    assert ProductMap(maps) == pytest.approx(expected[-1])
+
+def test_solenoid_strength(tmp_path, parse_madx):
+    madx = parse_madx("sol: solenoid, l=2, ks=0.4;\nring: sequence, l=2;\nsol, at=1;\nendsequence;\n").Lattice
+    elegantFile = tmp_path / "ring.lte"
+    elegantFile.write_text("sol: SOLE, L=2, KS=0.4\nring: LINE=(sol)\n")
+    elegant = LatticeConverter(quiet=True).LoadFormat("elegant", str(elegantFile), "ring")
+    for lattice in (madx, elegant):
+        M = TransferMap(lattice.Elements["sol"])
+        assert M == pytest.approx(SolenoidMap(2., 0.4))
+        assert M[0, 2] != 0.
+    # The map is symplectic: M^T J M = J
+    J = np.kron(np.eye(3), [[0., 1.], [-1., 0.]])
+    M = SolenoidMap(2., 0.4)
+    assert M.T @ J @ M == pytest.approx(J, abs=1e-12)